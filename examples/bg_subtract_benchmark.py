@@ -0,0 +1,46 @@
+"""
+Compares the speed of the background subtraction models on the prius video,
+including the adapters for the native opencv MOG2 and KNN subtractors.
+"""
+import time
+import pyvision3 as pv3
+
+
+def benchmark(model_factory, buffer_size, frames):
+    ib = pv3.ImageBuffer(N=buffer_size)
+    for img in frames[:buffer_size]:
+        ib.add(img)
+    model = model_factory(ib)
+    model.foreground_mask()  # first frame may include one-time initialization
+
+    start = time.perf_counter()
+    for img in frames[buffer_size:]:
+        ib.add(img)
+        model.foreground_mask()
+    elapsed = time.perf_counter() - start
+    return 1000.0 * elapsed / (len(frames) - buffer_size)
+
+
+def demo(size=None, n_frames=150):
+    vid = pv3.Video(pv3.VID_PRIUS, size=size)
+    frames = [img for (_, img) in zip(range(n_frames), vid)]
+    print("Frame size: {}".format(frames[0].size))
+
+    models = [
+        ("Frame Difference", pv3.FrameDifferenceModel, 5),
+        ("Motion Comp. FD", pv3.MotionCompensatedFrameDifferenceModel, 5),
+        ("Median (20 frames)", pv3.MedianModel, 20),
+        ("Approximate Median", pv3.ApproximateMedianModel, 5),
+        ("Running Gaussian", pv3.RunningGaussianModel, 1),
+        ("Samples (ViBe)", pv3.SampleModel, 5),
+        ("OpenCV MOG2", pv3.MOG2Model, 1),
+        ("OpenCV KNN", pv3.KNNModel, 1),
+    ]
+    for (name, factory, buffer_size) in models:
+        ms = benchmark(factory, buffer_size, frames)
+        print("{:<20s} {:8.2f} ms/frame".format(name, ms))
+
+
+if __name__ == "__main__":
+    demo()
+    demo(size=(320, 240))
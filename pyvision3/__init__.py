@@ -23,9 +23,24 @@ from .geometry import (
     integer_bounds,
     integer_coords_array,
 )
-from .image import Image, matplot_fig_to_image
-from .affine import AffineTransformer, AffineRotation, AffineTranslate
-from .imagebuffer import ImageBuffer
+from .image import Image, matplot_fig_to_image, images_to_tensor
+from .affine import (
+    AffineTransformer,
+    AffineRotation,
+    AffineTranslate,
+    AffineFromPoints,
+    AffineFromRect,
+    AffineChain,
+    affine_from_points_batch,
+    align_to_template,
+)
+from .imagebuffer import (
+    ImageBuffer,
+    ArrayImageBuffer,
+    MemmapImageBuffer,
+    CompressedImageBuffer,
+    ThreadSafeImageBuffer,
+)
 from .video import (
     VideoInterface,
     Video,
@@ -37,14 +52,25 @@ from .montage import ImageMontage, VideoMontage
 
 from pyvision3.video_proc.backgroundsubtract import (
     FrameDifferenceModel,
+    MotionCompensatedFrameDifferenceModel,
     MedianModel,
     ApproximateMedianModel,
+    RunningGaussianModel,
+    SampleModel,
+    MOG2Model,
+    KNNModel,
     AbstractBGModel,
     StaticModel,
     BG_SUBTRACT_STATIC,
     BG_SUBTRACT_FRAME_DIFF,
+    BG_SUBTRACT_MCFD,
     BG_SUBTRACT_MEDIAN,
     BG_SUBTRACT_APPROX_MEDIAN,
+    BG_SUBTRACT_RUNNING_GAUSSIAN,
+    BG_SUBTRACT_SAMPLES,
+    BG_SUBTRACT_MOG2,
+    BG_SUBTRACT_KNN,
+    bg_subtract_video,
 )
 from pyvision3.video_proc.motiondetection import (
     MotionDetector,
@@ -57,6 +83,11 @@ from pyvision3.dataset_tools.crops import (
     crop_negative_regions,
     random_rect_gen,
 )
+from pyvision3.dataset_tools.augmentation import (
+    augment_crops,
+    random_affine_matrices,
+    image_dir_writer,
+)
 from pyvision3.dataset_tools.tile_selection import (
     TileSelector,
     tiles_from_dir,
@@ -7,6 +7,22 @@ import cv2
 import pyvision3 as pv3
 import math
 import numpy as np
+import shapely.geometry as sg
+
+
+def _interpolation_margin(interpolation):
+    """
+    Internal function that returns how many extra source pixels, on each side of
+    the region that maps into an output tile, the interpolation kernel reads: the
+    half-width of the kernel, plus one for the rounding of the coordinates.
+    """
+    half_widths = {
+        cv2.INTER_NEAREST: 1,
+        cv2.INTER_LINEAR: 1,
+        cv2.INTER_CUBIC: 2,
+        cv2.INTER_LANCZOS4: 4,
+    }
+    return half_widths.get(interpolation & cv2.INTER_MAX, 4) + 1
 
 
 class AffineTransformer(object):
@@ -75,7 +91,9 @@ class AffineTransformer(object):
 
         return fit_width, fit_height
 
-    def __call__(self, source_img, invert=False):
+    def __call__(
+        self, source_img, invert=False, interpolation=cv2.INTER_LINEAR, annotations=True
+    ):
         """
 
         Parameters
@@ -86,6 +104,14 @@ class AffineTransformer(object):
             If true, the inverse transformation is applied to the source_img
             instead of the forward transformation.
 
+        interpolation: cv2 interpolation flag
+            Default is cv2.INTER_LINEAR.
+
+        annotations: boolean
+            If True (default), the annotation layer of the source_img is warped
+            along with the pixel data, so the result keeps its annotations. If the
+            source_img has never been annotated, there is nothing extra to warp.
+
         Returns
         -------
         A pyvision3 image resulting from applying the transformation
@@ -99,10 +125,258 @@ class AffineTransformer(object):
         else:
             dest_size = self.dest_size
 
-        flags = cv2.WARP_INVERSE_MAP if invert else 0
-        warped = cv2.warpAffine(input_array, self.affine_matrix, dest_size, flags=flags)
+        flags = (interpolation | cv2.WARP_INVERSE_MAP) if invert else interpolation
+
+        if not (annotations and source_img.has_annotation_layer()):
+            warped = cv2.warpAffine(
+                input_array, self.affine_matrix, dest_size, flags=flags
+            )
+            return pv3.Image(warped)
+
+        annotation_data = source_img.annotation_data
+        if input_array.dtype == annotation_data.dtype:
+            # stack the annotation channels behind the image channels so that
+            # both layers are resampled in a single warp
+            nchannels = source_img.nchannels
+            stacked = np.dstack((input_array, annotation_data))
+            warped = cv2.warpAffine(stacked, self.affine_matrix, dest_size, flags=flags)
+            warped_data = warped[:, :, 0:nchannels]
+            if nchannels == 1:
+                warped_data = warped_data[:, :, 0]
+            warped_data = np.ascontiguousarray(warped_data)
+            warped_annotations = np.ascontiguousarray(warped[:, :, nchannels:])
+        else:
+            warped_data = cv2.warpAffine(
+                input_array, self.affine_matrix, dest_size, flags=flags
+            )
+            warped_annotations = cv2.warpAffine(
+                annotation_data, self.affine_matrix, dest_size, flags=flags
+            )
+
+        out = pv3.Image(warped_data)
+        out.annotation_data = warped_annotations
+        return out
+
+    def warp_tiled(
+        self,
+        source,
+        out=None,
+        invert=False,
+        interpolation=cv2.INTER_LINEAR,
+        tile_size=None,
+        max_memory=256 * 2 ** 20,
+    ):
+        """
+        Applies the transformation one output tile at a time, so that very large
+        images (such as ortho-mosaics) can be warped with bounded working memory.
+        Each tile is produced by warping only the region of the source that maps
+        into it, and the output can be written directly into a memory-mapped file.
+        Annotations are not warped.
+
+        Parameters
+        ----------
+        source: pyvision3 image or ndarray
+            A raw ndarray, which may itself be a np.memmap, can be used to avoid
+            allocating the annotation layer of a pyvision3 image.
+        out: None, str, or ndarray
+            If None, the output is allocated in memory. If a string, it is the path
+            of a new np.memmap file to hold the output. Otherwise, an ndarray (or
+            np.memmap) of the correct shape and dtype to write into.
+        invert: boolean
+            If true, the inverse transformation is applied
+        interpolation: cv2 interpolation flag
+            Default is cv2.INTER_LINEAR.
+        tile_size: tuple (w, h) or None
+            The size of the output tiles. If None, the largest square tiles whose
+            working memory is within max_memory will be used.
+        max_memory: int
+            Approximate cap, in bytes, on the working memory used per tile
+            (the output tile plus the source region read to produce it).
+
+        Returns
+        -------
+        The output ndarray (or np.memmap, if out was a file name).
+        """
+        src = source.data if isinstance(source, pv3.Image) else source
+        (src_h, src_w) = src.shape[0:2]
+
+        if self.dest_size is None:
+            dest_size = (src_w, src_h)
+        elif self.dest_size == "fit":
+            dest_size = self._get_fit((src_w, src_h), invert=invert)
+        else:
+            dest_size = self.dest_size
+        (dest_w, dest_h) = dest_size
+
+        # forward (source to output) and inverse (output to source) matrices
+        fwd = np.vstack((self._get_matrix(invert=invert), [0.0, 0.0, 1.0]))
+        inv = np.linalg.inv(fwd)
+
+        out_shape = (dest_h, dest_w) + src.shape[2:]
+        if out is None:
+            out = np.zeros(out_shape, dtype=src.dtype)
+        elif isinstance(out, str):
+            out = np.memmap(out, dtype=src.dtype, mode="w+", shape=out_shape)
+        elif out.shape != out_shape:
+            raise ValueError("Output array must have shape {}".format(out_shape))
+
+        if tile_size is None:
+            # source area needed per output pixel, allowing for rotation
+            src_ratio = 2.0 / max(abs(np.linalg.det(fwd[0:2, 0:2])), 1e-6)
+            pix_bytes = src.dtype.itemsize * (1 if src.ndim == 2 else src.shape[2])
+            side = int(math.sqrt(max_memory / (pix_bytes * (1.0 + src_ratio))))
+            side = max(side, 64)
+            tile_size = (min(side, dest_w), min(side, dest_h))
+        (tile_w, tile_h) = tile_size
+
+        margin = _interpolation_margin(interpolation)
+        for ty in range(0, dest_h, tile_h):
+            th = min(tile_h, dest_h - ty)
+            for tx in range(0, dest_w, tile_w):
+                tw = min(tile_w, dest_w - tx)
+                corners = np.array(
+                    [
+                        [tx, ty, 1],
+                        [tx + tw, ty, 1],
+                        [tx, ty + th, 1],
+                        [tx + tw, ty + th, 1],
+                    ]
+                ).T
+                src_pts = np.dot(inv, corners)
+                x0 = max(int(math.floor(src_pts[0].min())) - margin, 0)
+                y0 = max(int(math.floor(src_pts[1].min())) - margin, 0)
+                x1 = min(int(math.ceil(src_pts[0].max())) + margin, src_w)
+                y1 = min(int(math.ceil(src_pts[1].max())) + margin, src_h)
+
+                out_tile = out[ty : ty + th, tx : tx + tw]
+                if x0 >= x1 or y0 >= y1:
+                    out_tile[...] = 0  # this tile maps outside the source
+                    continue
+
+                # shift the matrix so that it maps the source roi into the tile
+                shift_src = np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1.0]])
+                shift_dst = np.array([[1, 0, -tx], [0, 1, -ty], [0, 0, 1.0]])
+                tile_mat = np.dot(shift_dst, np.dot(fwd, shift_src))[0:2, :]
+                out_tile[...] = cv2.warpAffine(
+                    src[y0:y1, x0:x1], tile_mat, (tw, th), flags=interpolation
+                )
+
+        return out
+
+    def _get_matrix(self, invert=False):
+        """
+        Internal method that returns the 2x3 matrix used to transform coordinates,
+        the forward matrix or the inverse matrix, as float64.
+        """
+        if invert:
+            return np.linalg.inv(self.get_augmented_matrix())[0:2, :]
+        return np.asarray(self.affine_matrix, dtype="float64")
+
+    def transform_points(self, points, invert=False):
+        """
+        Applies the transformation to an array of points, all at once.
+
+        Parameters
+        ----------
+        points: array-like, shape (N, 2)
+            The (x, y) coordinates of the points
+        invert: boolean
+            If True, the inverse transformation is applied
 
-        return pv3.Image(warped)
+        Returns
+        -------
+        An (N, 2) float64 ndarray of the transformed points.
+
+        Note
+        ----
+        When dest_size='fit', the translation that keeps the output in positive
+        coordinates is only added to the matrix on the first forward call to
+        the transformer, so apply the transformer to the image first.
+        """
+        pts = np.asarray(points, dtype="float64").reshape(-1, 2)
+        mat = self._get_matrix(invert=invert)
+        return np.dot(pts, mat[:, 0:2].T) + mat[:, 2]
+
+    def transform_rects(self, rects, invert=False):
+        """
+        Applies the transformation to an array of rectangles, all at once.
+
+        Parameters
+        ----------
+        rects: array-like, shape (N, 4)
+            The rectangles as (x, y, w, h) rows, following the same pixel
+            convention as pv3.Rect
+        invert: boolean
+            If True, the inverse transformation is applied
+
+        Returns
+        -------
+        An (N, 4) float64 ndarray of (x, y, w, h) rows, which are the axis-aligned
+        bounding rectangles of the transformed corners of each input rectangle.
+        """
+        rects = np.asarray(rects, dtype="float64").reshape(-1, 4)
+        (x, y, w, h) = rects.T
+        maxx = x + w - 1
+        maxy = y + h - 1
+        # (N, 4 corners, 2)
+        corners = np.stack(
+            [
+                np.stack([x, y], axis=1),
+                np.stack([maxx, y], axis=1),
+                np.stack([maxx, maxy], axis=1),
+                np.stack([x, maxy], axis=1),
+            ],
+            axis=1,
+        )
+        new_corners = self.transform_points(corners, invert=invert).reshape(-1, 4, 2)
+        mins = new_corners.min(axis=1)
+        maxs = new_corners.max(axis=1)
+        return np.hstack((mins, maxs - mins + 1))
+
+    def transform_polygons(self, polygons, invert=False):
+        """
+        Applies the transformation to a list of polygons. The vertices of all the
+        polygons are transformed together in a single matrix product.
+
+        Parameters
+        ----------
+        polygons: list
+            Either a list of (Ni, 2) arrays of vertices, or a list of shapely polygons.
+            For shapely polygons, both the exterior and any interior rings are
+            transformed.
+        invert: boolean
+            If True, the inverse transformation is applied
+
+        Returns
+        -------
+        A list of the transformed polygons, of the same type as the inputs.
+        """
+        rings = []
+        for poly in polygons:
+            if isinstance(poly, sg.Polygon):
+                rings.append(np.array(poly.exterior.coords))
+                rings += [np.array(r.coords) for r in poly.interiors]
+            else:
+                rings.append(np.asarray(poly, dtype="float64").reshape(-1, 2))
+
+        if len(rings) == 0:
+            return []
+
+        splits = np.cumsum([len(r) for r in rings])[:-1]
+        new_rings = np.split(self.transform_points(np.vstack(rings), invert), splits)
+
+        out = []
+        idx = 0
+        for poly in polygons:
+            if isinstance(poly, sg.Polygon):
+                n_holes = len(poly.interiors)
+                holes = new_rings[idx + 1 : idx + 1 + n_holes]
+                out.append(sg.Polygon(new_rings[idx], holes))
+                idx += 1 + n_holes
+            else:
+                out.append(new_rings[idx])
+                idx += 1
+        return out
 
     def get_augmented_matrix(self):
         """
@@ -204,4 +478,287 @@ class AffineRotation(AffineTransformer):
         AffineTransformer.__init__(self, mat, **kwargs)
 
 
-# TODO AffineFromPoints, AffineFromRect
+class AffineChain(object):
+    """
+    A lazy sequence of affine operations (translate, rotate, scale, resize, crop)
+    applied to a source image. Each operation only updates a single 3x3 matrix
+    and the output size, so no pixels are touched until apply() is called, at
+    which point the source image is resampled exactly once, directly into the
+    output size of the final operation. Compared to applying each step as its
+    own AffineTransformer, this is faster and avoids accumulating interpolation
+    blur.
+
+    Typically created via Image.affine_chain().
+
+    Example
+    -------
+    out = img.affine_chain().translate(20, 10).rotate(15).resize((128, 128)).apply()
+    """
+
+    def __init__(self, source_img):
+        """
+        Parameters
+        ----------
+        source_img: pyvision3 image
+            The image that the chain of operations will eventually be applied to.
+        """
+        self.source_img = source_img
+        self.size = source_img.size
+        self._matrix = np.eye(3)
+
+    def _push(self, mat, size=None):
+        """
+        Internal method to append an (augmented, 3x3) matrix to the chain,
+        optionally changing the output size. Returns self to allow for
+        chaining method calls.
+        """
+        self._matrix = np.dot(mat, self._matrix)
+        if size is not None:
+            self.size = (int(size[0]), int(size[1]))
+        return self
+
+    def translate(self, dx, dy):
+        """
+        Translate by dx, dy. The output size is unchanged.
+        """
+        return self._push(np.array([[1.0, 0, dx], [0, 1.0, dy], [0, 0, 1.0]]))
+
+    def rotate(self, theta_degrees, center=None):
+        """
+        Rotate clockwise by theta_degrees about the center point. The output
+        size is unchanged, so corners may be clipped.
+
+        Parameters
+        ----------
+        theta_degrees: int or float
+        center: tuple (x, y) or None
+            If None, the rotation is about the center of the current output frame.
+        """
+        if center is None:
+            center = (self.size[0] / 2.0, self.size[1] / 2.0)
+        (cx, cy) = center
+        theta = float(theta_degrees) * math.pi / 180.0
+        cos_t = math.cos(theta)
+        sin_t = math.sin(theta)
+        mat = np.array(
+            [
+                [cos_t, -sin_t, cx - cos_t * cx + sin_t * cy],
+                [sin_t, cos_t, cy - sin_t * cx - cos_t * cy],
+                [0, 0, 1.0],
+            ]
+        )
+        return self._push(mat)
+
+    def scale(self, sx, sy=None):
+        """
+        Scale by sx, sy (sy defaults to sx). The output size is scaled accordingly.
+        Pixel centers are aligned in the same way as cv2.resize.
+        """
+        sy = sx if sy is None else sy
+        mat = np.array([[sx, 0, 0.5 * (sx - 1)], [0, sy, 0.5 * (sy - 1)], [0, 0, 1.0]])
+        new_size = (round(self.size[0] * sx), round(self.size[1] * sy))
+        return self._push(mat, new_size)
+
+    def resize(self, new_size):
+        """
+        Scale the current output frame to exactly new_size (w, h).
+        """
+        self.scale(new_size[0] / self.size[0], new_size[1] / self.size[1])
+        self.size = (int(new_size[0]), int(new_size[1]))
+        return self
+
+    def crop(self, rect):
+        """
+        Crop to a rectangle, specified in the coordinates of the current output frame,
+        using the same integer bounds as Image.crop(). Unlike Image.crop(), pixels
+        outside of the source image are filled with zeros instead of raising an error.
+
+        Parameters
+        ----------
+        rect: shapely rectangle (polygon)
+        """
+        (minx, miny, maxx, maxy) = pv3.integer_bounds(rect)
+        self.translate(-minx, -miny)
+        self.size = (maxx - minx + 1, maxy - miny + 1)
+        return self
+
+    def transform(self, aff, dest_size=None):
+        """
+        Append an arbitrary AffineTransformer (or subclass) to the chain.
+
+        Parameters
+        ----------
+        aff: AffineTransformer
+        dest_size: tuple (w, h) or None
+            The new output size, if None then the output size is unchanged.
+        """
+        return self._push(aff.get_augmented_matrix(), dest_size)
+
+    def get_augmented_matrix(self):
+        """
+        Returns
+        -------
+        The product of all operations in the chain as a 3x3 ndarray
+        """
+        return self._matrix.copy()
+
+    def as_transformer(self):
+        """
+        Returns
+        -------
+        An AffineTransformer equivalent to the entire chain, with dest_size
+        set to the output size of the final operation.
+        """
+        return AffineTransformer(self._matrix[0:2, :].copy(), dest_size=self.size)
+
+    def apply(self, interpolation=cv2.INTER_LINEAR):
+        """
+        Resamples the source image once, using the combined matrix of the chain.
+
+        Parameters
+        ----------
+        interpolation: cv2 interpolation flag
+            Default is cv2.INTER_LINEAR.
+
+        Returns
+        -------
+        A pyvision3 image of the output size. The .metadata of the source is copied,
+        with a key "affine_matrix" added that holds the combined 2x3 matrix.
+        """
+        aff = self.as_transformer()
+        out = aff(self.source_img, interpolation=interpolation)
+        out.metadata = self.source_img.metadata.copy()
+        out.metadata["affine_matrix"] = aff.affine_matrix
+        return out
+
+
+class AffineFromPoints(AffineTransformer):
+    """
+    Convenience subclass of AffineTransformer that computes the least-squares
+    affine transformation mapping a set of source points onto a set of
+    corresponding destination points.
+    """
+
+    def __init__(self, src_points, dest_points, **kwargs):
+        """
+        Parameters
+        ----------
+        src_points: array-like, shape (N, 2)
+            The (x, y) coordinates in the source image, N >= 3
+        dest_points: array-like, shape (N, 2)
+            The corresponding (x, y) coordinates in the destination image
+        """
+        mat = affine_from_points_batch(src_points, dest_points)
+        AffineTransformer.__init__(self, mat, **kwargs)
+
+
+class AffineFromRect(AffineTransformer):
+    """
+    Convenience subclass of AffineTransformer that maps a rectangular region
+    of the source image onto the full destination frame, i.e., a crop and
+    resize performed as a single warp.
+    """
+
+    def __init__(self, rect, dest_size, **kwargs):
+        """
+        Parameters
+        ----------
+        rect: shapely rectangle (polygon)
+            The region of the source image, using the same integer bounds as
+            Image.crop()
+        dest_size: tuple (w, h)
+            The size of the output image
+        """
+        (minx, miny, maxx, maxy) = pv3.integer_bounds(rect)
+        sx = dest_size[0] / (maxx - minx + 1)
+        sy = dest_size[1] / (maxy - miny + 1)
+        # pixel centers are aligned in the same way as cv2.resize
+        mat = np.array(
+            [[sx, 0, 0.5 * (sx - 1) - sx * minx], [0, sy, 0.5 * (sy - 1) - sy * miny]]
+        )
+        AffineTransformer.__init__(self, mat, dest_size=dest_size, **kwargs)
+
+
+def affine_from_points_batch(src_points, dest_points):
+    """
+    Solves for the least-squares affine transformations of many sets of
+    corresponding points at once, using a single batched numpy call.
+
+    Parameters
+    ----------
+    src_points: array-like, shape (B, N, 2) or (N, 2)
+        B sets of N source points each (N >= 3)
+    dest_points: array-like, shape (B, N, 2) or (N, 2)
+        The corresponding destination points. A single (N, 2) set, of either the
+        source or destination points, will be used with every set of the other,
+        such as when aligning to a template.
+
+    Returns
+    -------
+    A (B, 2, 3) float64 ndarray of affine matrices, or a single (2, 3) matrix
+    if both inputs were (N, 2).
+    """
+    src = np.asarray(src_points, dtype="float64")
+    dst = np.asarray(dest_points, dtype="float64")
+    single = src.ndim == 2 and dst.ndim == 2
+    (src, dst) = np.broadcast_arrays(src, dst)
+    if single:
+        (src, dst) = (src[np.newaxis, ...], dst[np.newaxis, ...])
+
+    # centering the points separates the translation from the linear part,
+    # and improves the conditioning of the least-squares problem
+    src_mean = src.mean(axis=1)
+    dst_mean = dst.mean(axis=1)
+    src_c = src - src_mean[:, np.newaxis, :]
+    dst_c = dst - dst_mean[:, np.newaxis, :]
+
+    # for each set, solve src_c @ L.T = dst_c for the 2x2 linear part L
+    lin = np.matmul(np.linalg.pinv(src_c), dst_c).transpose(0, 2, 1)
+    trans = dst_mean - np.matmul(lin, src_mean[..., np.newaxis])[..., 0]
+    mats = np.concatenate((lin, trans[..., np.newaxis]), axis=2)
+    return mats[0] if single else mats
+
+
+def align_to_template(
+    images, point_sets, template_points, dest_size, interpolation=cv2.INTER_LINEAR
+):
+    """
+    Aligns many objects to a canonical frame. The affine transformations from each
+    set of points (such as landmarks of detected objects) to the template points
+    are solved together, and then each aligned crop is produced by a single warp
+    directly from its source image, without any intermediate cropping.
+
+    Parameters
+    ----------
+    images: pyvision3 image, or list of pyvision3 images
+        Either one image that contains all of the objects, or a list with one
+        image per set of points.
+    point_sets: array-like, shape (B, N, 2)
+        The points of each of the B objects in source image coordinates
+    template_points: array-like, shape (N, 2)
+        The corresponding points in the canonical (output) frame
+    dest_size: tuple (w, h)
+        The size of each aligned crop
+    interpolation: cv2 interpolation flag
+        Default is cv2.INTER_LINEAR.
+
+    Returns
+    -------
+    A list of B pyvision3 images. The .metadata of each has a key
+    "affine_matrix" with the 2x3 matrix that was applied.
+    """
+    mats = affine_from_points_batch(point_sets, template_points)
+    if isinstance(images, pv3.Image):
+        images = [images] * len(mats)
+    elif len(images) != len(mats):
+        msg = "Got {} images for {} sets of points.".format(len(images), len(mats))
+        raise ValueError(msg)
+
+    crops = []
+    for img, mat in zip(images, mats):
+        warped = cv2.warpAffine(img.data, mat, tuple(dest_size), flags=interpolation)
+        crop = pv3.Image(warped)
+        crop.metadata = img.metadata.copy()
+        crop.metadata["affine_matrix"] = mat
+        crops.append(crop)
+    return crops
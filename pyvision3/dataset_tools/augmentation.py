@@ -0,0 +1,204 @@
+"""
+This module contains tools to generate randomized affine variants
+("augmentations") of training crops, such as those produced by
+crop_regions(...). The random matrices are built in vectorized form
+from a seeded random generator, and the warps are performed in a pool
+of threads (cv2 releases the GIL), streaming the results back to the
+caller in order.
+"""
+
+import concurrent.futures
+import math
+import os
+from collections import deque
+
+import cv2
+import numpy as np
+import pyvision3 as pv3
+
+
+def random_affine_matrices(
+    N,
+    crop_size,
+    max_rotation=15.0,
+    scale_range=(0.9, 1.1),
+    max_shift=0.1,
+    flip=True,
+    rng=None,
+):
+    """
+    Builds N random affine matrices, each a combination of a rotation about the
+    center of the crop, a scaling, a shift, and an optional horizontal flip.
+
+    Parameters
+    ----------
+    N: integer
+        The number of matrices to generate
+    crop_size: tuple (w, h), or an (N, 2) array of sizes
+        The size of the crop(s) the matrices will be applied to. Rotation, scaling
+        and flipping are about the center of the crop.
+    max_rotation: float
+        Rotations are drawn uniformly from +/- max_rotation degrees
+    scale_range: tuple (min, max)
+        Scale factors are drawn uniformly from this range
+    max_shift: float
+        Shifts are drawn uniformly from +/- max_shift times the crop width (for x)
+        and height (for y)
+    flip: boolean
+        If True, half of the matrices (on average) include a horizontal flip
+    rng: numpy RandomState or None
+        The random generator to use. If None, a new unseeded generator is used.
+
+    Returns
+    -------
+    An (N, 2, 3) float64 ndarray of affine matrices, suitable for cv2.warpAffine
+    or pv3.AffineTransformer.
+    """
+    rng = np.random.RandomState() if rng is None else rng
+    sizes = np.broadcast_to(np.asarray(crop_size, dtype="float64"), (N, 2))
+
+    theta = rng.uniform(-max_rotation, max_rotation, size=N) * math.pi / 180.0
+    scale = rng.uniform(scale_range[0], scale_range[1], size=N)
+    shift = rng.uniform(-max_shift, max_shift, size=(N, 2)) * sizes
+    flip_x = np.where(rng.random_sample(N) < 0.5, -1.0, 1.0) if flip else np.ones(N)
+
+    cos_t = np.cos(theta) * scale
+    sin_t = np.sin(theta) * scale
+    cx = (sizes[:, 0] - 1) / 2.0
+    cy = (sizes[:, 1] - 1) / 2.0
+
+    mats = np.empty((N, 2, 3), dtype="float64")
+    mats[:, 0, 0] = cos_t * flip_x
+    mats[:, 0, 1] = -sin_t
+    mats[:, 1, 0] = sin_t * flip_x
+    mats[:, 1, 1] = cos_t
+    # translation that keeps the crop center fixed, plus the random shift
+    mats[:, 0, 2] = cx + shift[:, 0] - (mats[:, 0, 0] * cx + mats[:, 0, 1] * cy)
+    mats[:, 1, 2] = cy + shift[:, 1] - (mats[:, 1, 0] * cx + mats[:, 1, 1] * cy)
+    return mats
+
+
+def augment_crops(
+    crops,
+    K=5,
+    max_rotation=15.0,
+    scale_range=(0.9, 1.1),
+    max_shift=0.1,
+    flip=True,
+    seed=None,
+    n_threads=4,
+    chunk_size=64,
+    writer=None,
+    border_mode=cv2.BORDER_REFLECT_101,
+):
+    """
+    Generates K randomized affine variants of each crop. This is a generator,
+    so crops are consumed, warped, and yielded in chunks, and the full set of
+    augmented images never needs to be held in memory.
+
+    Parameters
+    ----------
+    crops: iterable of pyvision3 images
+        For example, the output of crop_regions(...). Entries that are None
+        (such as out-of-bounds crops) are skipped.
+    K: integer
+        The number of variants to generate per crop
+    max_rotation, scale_range, max_shift, flip:
+        Control the random transformations, see random_affine_matrices(...)
+    seed: integer or None
+        Seed for the random generator, for reproducible augmentations
+    n_threads: integer
+        The number of threads used to perform the warps
+    chunk_size: integer
+        How many crops to read from the input before drawing their random
+        matrices and submitting their warps to the thread pool.
+    writer: function or None
+        Optional callable with signature writer(crop_idx, k, image), which will be
+        called from the worker threads as soon as each variant is ready, so that
+        encoding and saving the results also happens in parallel. The writer must
+        therefore be thread-safe. See image_dir_writer(...).
+    border_mode: cv2 border mode
+        How pixels outside the source crop are filled, default is cv2.BORDER_REFLECT_101
+
+    Returns
+    -------
+    Yields tuples (crop_idx, k, image) in order, where crop_idx is the index of the
+    source crop in the input, k is the variant number, and image is a pyvision3
+    image with the same size as the source crop. The .metadata of each image
+    has a key "augment_matrix" holding the 2x3 matrix that was applied.
+    """
+    rng = np.random.RandomState(seed)
+
+    def _warp(crop_idx, k, crop, mat):
+        warped = cv2.warpAffine(crop.data, mat, crop.size, borderMode=border_mode)
+        out = pv3.Image(warped)
+        out.metadata = crop.metadata.copy()
+        out.metadata["augment_matrix"] = mat
+        if writer is not None:
+            writer(crop_idx, k, out)
+        return (crop_idx, k, out)
+
+    def _chunks():
+        chunk = []
+        for crop_idx, crop in enumerate(crops):
+            if crop is None:
+                continue
+            chunk.append((crop_idx, crop))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    max_pending = max(1, 2 * n_threads * K)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = deque()
+        for chunk in _chunks():
+            sizes = np.repeat([crop.size for (_, crop) in chunk], K, axis=0)
+            mats = random_affine_matrices(
+                len(sizes),
+                sizes,
+                max_rotation=max_rotation,
+                scale_range=scale_range,
+                max_shift=max_shift,
+                flip=flip,
+                rng=rng,
+            )
+            for i, (crop_idx, crop) in enumerate(chunk):
+                for k in range(K):
+                    mat = mats[i * K + k]
+                    pending.append(pool.submit(_warp, crop_idx, k, crop, mat))
+                    # don't let the queue of results grow without bound
+                    while len(pending) > max_pending:
+                        yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def image_dir_writer(out_dir, prefix="aug", ext=".png"):
+    """
+    Creates a thread-safe writer function, for use with augment_crops(...),
+    that saves each variant to its own image file in the output directory.
+
+    Parameters
+    ----------
+    out_dir: str
+        The output directory, which will be created if it doesn't exist
+    prefix: str
+        The file name prefix
+    ext: str
+        The file extension, which determines the image format, default is ".png"
+
+    Returns
+    -------
+    A function writer(crop_idx, k, image) that saves the image (without
+    annotations) as out_dir/<prefix>_<crop_idx>_<k><ext>
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    def writer(crop_idx, k, image):
+        fn = "{}_{:06d}_{:02d}{}".format(prefix, crop_idx, k, ext)
+        image.save(os.path.join(out_dir, fn), as_annotated=False)
+
+    return writer
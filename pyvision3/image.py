@@ -33,6 +33,7 @@ except ImportError:
 
 from .pv_exceptions import OutOfBoundsError, ImageAnnotationError
 from .geometry import in_bounds, integer_bounds, Rect
+from .affine import AffineChain
 
 
 class Image(object):
@@ -103,12 +104,37 @@ class Image(object):
         self.size = (self.width, self.height)
         self.nchannels = self.data.shape[2] if len(self.data.shape) == 3 else 1
 
-        # Annotation data is a separate BGR image array.
-        self.annotation_data = (
-            self.data.copy()
-            if self.nchannels == 3
-            else cv2.cvtColor(self.data, cv2.COLOR_GRAY2BGR)
-        )
+        # Annotation data is a separate BGR image array, which is only
+        # allocated when first used. See the annotation_data property.
+        self._annotation_data = None
+
+    @property
+    def annotation_data(self):
+        """
+        The annotation layer, a separate BGR image array. It is allocated as a
+        copy of the image data on first use, so images that are never annotated
+        (such as frames in a buffer, or intermediate results) don't pay for it.
+        """
+        if self._annotation_data is None:
+            self._annotation_data = (
+                self.data.copy()
+                if self.nchannels == 3
+                else cv2.cvtColor(self.data, cv2.COLOR_GRAY2BGR)
+            )
+        return self._annotation_data
+
+    @annotation_data.setter
+    def annotation_data(self, value):
+        self._annotation_data = value
+
+    def has_annotation_layer(self):
+        """
+        Returns
+        -------
+        True if the annotation layer has been allocated, which happens when
+        the image is annotated or the annotation_data is otherwise accessed.
+        """
+        return self._annotation_data is not None
 
     def __str__(self):
         txt = "Pyvision3 Image: {}".format(self.desc)
@@ -177,14 +203,16 @@ class Image(object):
         else:
             tmp_img = self.data.copy()
 
-        # this works because the annotation_data was initialized as a copy of the
-        # source data. Annotations draw on this copy, and when we alpha-blend, those pixels
-        # that were not changed by an annotation will blend back to full intensity.
-        # i.e., if there were no annotations on pixel x, (1-alpha)*I(x) + (alpha)*A(x) = I(x)
-        # because A(x) == I(x) where not otherwise annotated.
-        tmp_img = cv2.addWeighted(
-            tmp_img, 1.0 - alpha, self.annotation_data, alpha, 0.0
-        )
+        if self.has_annotation_layer():
+            # this works because the annotation_data was initialized as a copy of the
+            # source data. Annotations draw on this copy, and when we alpha-blend, those
+            # pixels that were not changed by an annotation will blend back to full
+            # intensity. i.e., if there were no annotations on pixel x,
+            # (1-alpha)*I(x) + (alpha)*A(x) = I(x) because A(x) == I(x) where not
+            # otherwise annotated.
+            tmp_img = cv2.addWeighted(
+                tmp_img, 1.0 - alpha, self.annotation_data, alpha, 0.0
+            )
 
         if as_type == "PV":
             return Image(tmp_img)
@@ -483,7 +511,8 @@ class Image(object):
         """
         new_data = self.data.copy()
         new_img = Image(new_data)
-        new_img.annotation_data = self.annotation_data.copy()
+        if self.has_annotation_layer():
+            new_img.annotation_data = self.annotation_data.copy()
         new_img.metadata = self.metadata.copy()
         return new_img
 
@@ -516,6 +545,22 @@ class Image(object):
         crop_image.metadata["crop_bounds"] = (minx, miny, maxx, maxy)
         return crop_image
 
+    def affine_chain(self):
+        """
+        Starts a lazy chain of affine operations on this image. Operations such as
+        translate, rotate, resize, and crop are combined into a single matrix, and
+        the image is only resampled once, when apply() is called on the chain.
+
+        Returns
+        -------
+        A pyvision3 AffineChain object
+
+        Example
+        -------
+        tile = img.affine_chain().rotate(30).resize((320, 240)).crop(rect).apply()
+        """
+        return AffineChain(self)
+
     def resize(self, new_size, keep_aspect=False, as_type="PV"):
         """
         Returns a copy of the image after resizing to a new size.
@@ -703,3 +748,85 @@ def matplot_fig_to_image(fig):
     img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
     plot.close(fig)
     return Image(img)
+
+
+def images_to_tensor(
+    images,
+    size,
+    layout="NCHW",
+    dtype="float32",
+    mean=None,
+    std=None,
+    out=None,
+    to_rgb=True,
+):
+    """
+    Converts a sequence of images into a normalized batch tensor, such as the
+    input to a neural network. Resizing, BGR-to-RGB channel reordering, and
+    normalization are fused: each image is resized (if required) into one reusable
+    scratch array, and then written with its channels reordered and normalized
+    directly into the output, without any other temporary arrays.
+
+    Parameters
+    ----------
+    images: sequence of pyvision3 images or ndarrays
+        Single channel images are expanded to three channels.
+    size: tuple (w, h)
+        The size of each image in the tensor
+    layout: str in ("NCHW", "NHWC")
+        The order of the dimensions of the output tensor
+    dtype: numpy data type
+        The data type of the output tensor, default is float32
+    mean: tuple of 3 floats, or None
+    std: tuple of 3 floats, or None
+        Each pixel value x is normalized as (x / 255.0 - mean) / std, with the
+        mean and std given per channel, in the output channel order. If None,
+        the mean is 0 and the std is 1, so values are simply scaled to [0, 1].
+    out: ndarray or None
+        An optional, contiguous output array with the correct shape and dtype,
+        so that the same memory can be reused from one batch to the next.
+    to_rgb: boolean
+        If True (default), the output channels are in RGB order, otherwise they
+        are in the BGR order of opencv.
+
+    Returns
+    -------
+    The output tensor, an ndarray of shape (N, 3, h, w) or (N, h, w, 3)
+    """
+    if layout not in ("NCHW", "NHWC"):
+        raise ValueError("Unknown layout: {}".format(layout))
+    (w, h) = size
+    n = len(images)
+    shape = (n, 3, h, w) if layout == "NCHW" else (n, h, w, 3)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape or not out.flags["C_CONTIGUOUS"]:
+        raise ValueError(
+            "Output tensor must be contiguous, with shape {}".format(shape)
+        )
+
+    mean = np.zeros(3) if mean is None else np.asarray(mean, dtype="float64")
+    std = np.ones(3) if std is None else np.asarray(std, dtype="float64")
+    scale = (1.0 / (255.0 * std)).astype(out.dtype)
+    offset = (-mean / std).astype(out.dtype)
+
+    # source channel for each output channel
+    channels = [2, 1, 0] if to_rgb else [0, 1, 2]
+    scratch = None
+    for i, img in enumerate(images):
+        data = img.data if isinstance(img, Image) else img
+        if data.shape[0:2] != (h, w):
+            scratch_shape = (h, w) + data.shape[2:]
+            if scratch is None or scratch.shape != scratch_shape:
+                scratch = np.empty(scratch_shape, dtype=data.dtype)
+            data = cv2.resize(data, (w, h), dst=scratch)
+
+        # each channel is written directly from a view of the source channel, and
+        # a single channel image is the source of all three
+        for c, src_c in enumerate(channels):
+            src = data if data.ndim == 2 else data[:, :, src_c]
+            dst = out[i, c] if layout == "NCHW" else out[i, :, :, c]
+            np.multiply(src, scale[c], out=dst, casting="unsafe")
+            np.add(dst, offset[c], out=dst, casting="unsafe")
+
+    return out
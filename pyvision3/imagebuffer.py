@@ -4,6 +4,12 @@ Modified: Mar 10, 2016
     Modified for Pyvision 3
 Author: Stephen O'Hara
 """
+import functools
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
 import numpy as np
 import pyvision3 as pv3
 
@@ -24,11 +30,231 @@ class ImageBuffer:
         @param N: how many image frames to buffer
         """
         self._data = [None for _ in range(N)]
+        self._head = 0  # the slot to be written next, which holds the oldest item
         self._count = 0
         self._max = N
+        self._sequence = 0  # total number of images ever added
+        # optional (N, h, w) ring of grayscale frames, see keep_gray_stack()
+        self._keep_gray = False
+        self._gray = None
+        self._gray_size = None
+        self._gray_scale = None
+        self._gray_crop = None
+        # objects notified of each gray frame entering/leaving the window
+        self._observers = []
+        self._evicted = None
+        self._stats = None
+
+    def _slot(self, key):
+        """
+        Internal method that maps a position in the buffer, where 0 is the oldest
+        and -1 the most recent item, to the slot in the underlying storage.
+        """
+        if key < 0:
+            key += self._max
+        if not 0 <= key < self._max:
+            raise IndexError("ImageBuffer index out of range")
+        return (self._head + key) % self._max
+
+    def _get(self, slot):
+        """
+        Internal method to retrieve the item stored in the given slot. Subclasses
+        that use a different storage strategy override this and _put.
+        """
+        return self._data[slot]
+
+    def _put(self, slot, image):
+        """
+        Internal method to store an image in the given slot.
+        """
+        self._data[slot] = image
+
+    def _ordered(self, ring):
+        """
+        Internal method that returns an array with one row per slot (such as an
+        (N, h, w) stack) in buffer order, oldest first, including only the filled
+        slots. This is a zero-copy view unless the ring has wrapped around, in which
+        case it is a single copy.
+        """
+        if self._count < self._max:
+            return ring[0 : self._count]
+        if self._head == 0:
+            return ring
+        return np.concatenate((ring[self._head :], ring[0 : self._head]))
+
+    def _filled(self, ring):
+        """
+        Internal method that returns a view of the filled slots of a ring array,
+        in storage order rather than buffer order.
+        """
+        return ring if self._count == self._max else ring[0 : self._count]
+
+    def _put_gray(self, slot, image):
+        """
+        Internal method to convert an image to grayscale (resizing if required)
+        directly into the given slot of the gray stack.
+        """
+        data = image.data
+        if self._gray_crop is not None:
+            (x, y, w, h) = self._gray_crop
+            data = data[y : y + h, x : x + w]
+        size = (data.shape[1], data.shape[0])
+        if self._gray is None:
+            (w, h) = size if self._gray_size is None else self._gray_size
+            if self._gray_size is None and self._gray_scale is not None:
+                w = max(1, int(round(w * self._gray_scale)))
+                h = max(1, int(round(h * self._gray_scale)))
+            self._gray = self._allocate_gray((self._max, h, w))
+        (h, w) = self._gray.shape[1:3]
+        dst = self._gray[slot]
+        if (w, h) == size:
+            if data.ndim == 3:
+                cv2.cvtColor(data, cv2.COLOR_BGR2GRAY, dst=dst)
+            else:
+                dst[...] = data
+        else:
+            if data.ndim == 3:
+                data = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+            cv2.resize(data, (w, h), dst=dst, interpolation=cv2.INTER_AREA)
+
+    def _allocate_gray(self, shape):
+        """
+        Internal method to allocate the array for the gray stack.
+        """
+        return np.zeros(shape, dtype="uint8")
+
+    def keep_gray_stack(self, size=None, scale=None, crop=None):
+        """
+        Keeps a grayscale, optionally resized, copy of every frame up to date as
+        frames are added, so that each frame is converted exactly once, and the
+        stack is available from as_image_stack_BW() and get_gray() without any
+        further conversions. Frames already in the buffer are converted now.
+        Background subtraction models call this on the buffer they are given.
+        The gray stack is shared by all the users of the buffer, so once it is
+        kept, requesting a different size, scale or crop raises a ValueError,
+        rather than changing it under the models that already use it.
+        @param size: A tuple (w,h) for the size of the grayscale frames. If None,
+        the size of the first image in the buffer is used.
+        @param scale: If size is None, an optional factor applied to the size of
+        the first image, such as 0.5 to keep the stack at half resolution.
+        @param crop: An optional rectangle (x,y,w,h) of the frames, such as the
+        bounding box of a region of interest, to which the frames are cropped
+        before they are converted (and resized). The size and scale then apply
+        to the cropped frames.
+        """
+        size = None if size is None else tuple(size)
+        scale = None if scale == 1 else scale
+        crop = None if crop is None else tuple(crop)
+        settings = (size, scale, crop)
+        current = (self._gray_size, self._gray_scale, self._gray_crop)
+        if self._keep_gray:
+            if settings != current:
+                raise ValueError(
+                    "The gray stack is already kept with size {}, scale {} and "
+                    "crop {}, so it can't be kept with size {}, scale {} and "
+                    "crop {}.".format(*(current + settings))
+                )
+            return
+        self._keep_gray = True
+        (self._gray_size, self._gray_scale, self._gray_crop) = settings
+        self._gray = None
+        for slot in range(self._max):
+            image = self._get(slot)
+            if image is not None:
+                self._put_gray(slot, image)
+        self._evicted = None
+        self._reset_observers()
+
+    def _reset_observers(self):
+        stack = None if self._gray is None else self._filled(self._gray)
+        for observer in self._observers:
+            observer.reset(stack)
+
+    def add_gray_observer(self, observer):
+        """
+        Registers an object that is notified as each grayscale frame enters the
+        window of the buffer, and as the oldest one leaves it, so that it can
+        maintain some state incrementally. The gray stack is enabled if required.
+        The observer must implement two methods:
+        observer.reset(stack): called now, and whenever the gray stack is rebuilt
+        or the buffer is cleared, with the (n, h, w) stack of the frames in
+        the buffer (in storage order), or None if there are none.
+        observer.push(gray_in, gray_out, stack): called by add(), with the new
+        gray frame, the frame that left the window (None until the buffer is full),
+        and the updated stack.
+        @param observer: the object to notify
+        """
+        if not self._keep_gray:
+            self.keep_gray_stack()
+        self._observers.append(observer)
+        observer.reset(None if self._gray is None else self._filled(self._gray))
+
+    def remove_gray_observer(self, observer):
+        """
+        Stops notifying an observer registered with add_gray_observer().
+        @param observer: the object to stop notifying
+        """
+        self._observers.remove(observer)
+
+    def track_stats(self):
+        """
+        Maintains per-pixel sum, sum of squares, min and max of the grayscale frames
+        in the buffer, updated in O(1) per frame as frames enter and leave the window.
+        Afterwards, mean(), var() and range() are available without recomputing
+        over the whole stack.
+        """
+        if self._stats is None:
+            self._stats = _WindowStats()
+            self.add_gray_observer(self._stats)
+
+    def _tracked_stats(self):
+        """
+        Internal method that returns the statistics kept by track_stats(), or
+        raises a ValueError if they aren't available.
+        """
+        if self._stats is None:
+            raise ValueError("Statistics are not tracked, call track_stats() first.")
+        if self._count == 0:
+            raise ValueError("The buffer is empty.")
+        return self._stats
+
+    def mean(self):
+        """
+        @return: the per-pixel mean of the grayscale frames in the buffer, as a
+        float32 array. Requires track_stats().
+        """
+        return self._tracked_stats().mean()
+
+    def var(self):
+        """
+        @return: the per-pixel (population) variance of the grayscale frames in the
+        buffer, as a float32 array. Requires track_stats().
+        """
+        return self._tracked_stats().var()
+
+    def range(self):
+        """
+        @return: the per-pixel range (max - min) of the grayscale frames in the
+        buffer, as a uint8 array. Requires track_stats().
+        """
+        return self._tracked_stats().range()
+
+    def get_gray(self, key):
+        """
+        @param key: the position in the buffer, where 0 is the oldest and -1 the most
+        recent frame.
+        @return: the grayscale version of the frame, as an ndarray. If a gray stack
+        is being kept, this is a view into the stack (so it will be overwritten once
+        N more frames are added) and it has the size of the gray stack.
+        """
+        if self._gray is not None:
+            return self._gray[self._slot(key)]
+        return self[key].as_grayscale(as_type="CV")
 
     def __getitem__(self, key):
-        return self._data[key]
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(self._max))]
+        return self._get(self._slot(key))
 
     def __len__(self):
         """
@@ -45,7 +271,9 @@ class ImageBuffer:
 
     def clear(self):
         self._data = [None for _ in range(self._max)]
+        self._head = 0
         self._count = 0
+        self._reset_observers()
 
     def get_count(self):
         """
@@ -55,29 +283,58 @@ class ImageBuffer:
         """
         return self._count
 
+    def get_sequence_number(self):
+        """
+        The sequence number is the total number of images that have been added to
+        the buffer, so it also identifies the most recent image. Unlike get_count(),
+        it keeps increasing after the buffer is full, and is not reset by clear().
+        """
+        return self._sequence
+
     def get_data(self):
-        return self._data
+        """
+        @return: a list of the items in the buffer, oldest first. Until the buffer
+        is full, the list is padded at the start with None.
+        """
+        return self[:]
 
     def first(self):
-        return self._data[0]
+        return self[0]
 
     def last(self):
-        return self._data[-1]
+        return self[-1]
 
     def middle(self):
         mid = int(self._count / 2)
-        return self._data[mid]
+        return self[mid]
 
     def add(self, image):
         """
-        add an image to the buffer, will kick out the oldest of the buffer is full
+        add an image to the buffer, will kick out the oldest of the buffer is full.
+        This is O(1), the oldest slot of the ring is simply overwritten.
         @param  image: image to add to buffer
         """
-        self._data.pop(0)  # remove last, if just beginning, this will be None
-        self._data.append(image)
+        slot = self._head
+        gray_out = None
+        if self._observers and self.is_full():
+            # keep the gray frame that is about to leave the window
+            if self._evicted is None:
+                self._evicted = self._gray[slot].copy()
+            else:
+                np.copyto(self._evicted, self._gray[slot])
+            gray_out = self._evicted
+
+        self._put(slot, image)
+        if self._keep_gray:
+            self._put_gray(slot, image)
+        self._head = (self._head + 1) % self._max
         self._count += 1
         if self._count > self._max:
             self._count = self._max
+        self._sequence += 1
+
+        for observer in self._observers:
+            observer.push(self._gray[slot], gray_out, self._filled(self._gray))
 
     def fill(self, source):
         """
@@ -104,25 +361,130 @@ class ImageBuffer:
 
         return
 
-    def as_image_stack_BW(self, size=None):
+    def get_state(self, encoding=".jpg", quality=90):
+        """
+        Returns the contents of the buffer as a dictionary of numpy arrays, which
+        can be saved with numpy.savez_compressed and restored with set_state(), such
+        as to checkpoint a background model that depends on the buffer. The frames
+        are stored encoded, while the gray stack, if one is kept, is stored as is,
+        so that the statistics computed from it are restored exactly.
+        @param encoding: ".jpg" or ".png", the encoding of the frames
+        @param quality: the JPEG quality (0-100), only used if encoding is ".jpg"
+        @return: a dictionary of numpy arrays
+        """
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality] if encoding == ".jpg" else []
+        keys = list(range(self._max - self._count, self._max))  # oldest first
+        encoded = []
+        for key in keys:
+            (ok, payload) = cv2.imencode(encoding, self[key].data, params)
+            if not ok:
+                raise ValueError("Unable to encode image as {}".format(encoding))
+            encoded.append(payload.reshape(-1))
+
+        state = {
+            "sequence": np.array(self._sequence),
+            "frames": np.concatenate(encoded) if encoded else np.zeros(0, "uint8"),
+            "frame_lengths": np.array([len(p) for p in encoded], dtype="int64"),
+        }
+        if self._keep_gray:
+            # None is stored as an empty array
+            state["gray_size"] = np.array(self._gray_size or [], dtype="int64")
+            scale = [] if self._gray_scale is None else [self._gray_scale]
+            state["gray_scale"] = np.array(scale, dtype="float64")
+            state["gray_crop"] = np.array(self._gray_crop or [], dtype="int64")
+            if self._gray is not None:
+                state["gray"] = self._gray[[self._slot(key) for key in keys]]
+        return state
+
+    def set_state(self, state):
+        """
+        Replaces the contents of the buffer with those saved by get_state(). If
+        the state includes a gray stack, it is kept with the same settings as
+        when it was saved, and the observers of the gray stack are reset from it.
+        @param state: a dictionary of numpy arrays, as returned by get_state()
+        """
+        lengths = state["frame_lengths"]
+        if len(lengths) > self._max:
+            raise ValueError(
+                "The state has {} frames, more than the buffer holds".format(
+                    len(lengths)
+                )
+            )
+        payloads = np.split(state["frames"], np.cumsum(lengths)[:-1])
+        self.clear()
+        if "gray_size" in state:
+            self._keep_gray = True
+            scale = state["gray_scale"]
+            self._gray_size = tuple(int(v) for v in state["gray_size"]) or None
+            self._gray_scale = float(scale[0]) if scale.size else None
+            self._gray_crop = tuple(int(v) for v in state["gray_crop"]) or None
+            self._gray = None
+
+        for (slot, payload) in enumerate(payloads[0 : len(lengths)]):
+            image = pv3.Image(cv2.imdecode(payload, cv2.IMREAD_UNCHANGED))
+            self._put(slot, image)
+            if self._keep_gray:
+                self._put_gray(slot, image)
+        self._count = len(lengths)
+        self._head = self._count % self._max
+        self._sequence = int(state["sequence"])
+        if "gray" in state and self._gray is not None:
+            self._gray[0 : self._count] = state["gray"]
+        self._evicted = None
+        self._reset_observers()
+
+    def as_image_stack_BW(self, size=None, ordered=True):
         """
         Outputs an image buffer as a 3D numpy array ("stack") of grayscale images.
         @param size: A tuple (w,h) indicating the output size of each frame.
-        If None, then the size of the first image in the buffer will be used.
+        If None, then the size of the first image in the buffer will be used,
+        or the size of the gray stack, if one is being kept (see keep_gray_stack).
+        @param ordered: If False, and a gray stack is being kept, the frames may be
+        returned in storage order instead of buffer order. This is an O(1) view of
+        the gray stack, useful for order-independent statistics like the median.
         @return: a 3D array (stack) of the gray scale version of the images
         in the buffer. The dimensions of the stack are (N,w,h), where N is
         the number of images (buffer size), w and h are the width and height
         of each image.        
         """
+        stack = self._gray_view(size, ordered)
+        if stack is not None:
+            return stack
+        return self._stack_BW(self._window_images(), size)
+
+    def _gray_view(self, size, ordered):
+        """
+        Internal method that returns the gray stack for as_image_stack_BW(), or
+        None if there is no gray stack of the requested size.
+        """
+        if self._gray is None:
+            return None
+        (h, w) = self._gray.shape[1:3]
+        if size is not None and tuple(size) != (w, h):
+            return None
+        if not ordered:
+            return self._filled(self._gray)
+        return self._ordered(self._gray)
+
+    def _window_images(self):
+        """
+        Internal method that returns a list of the images in the buffer, oldest
+        first, without the empty slots at the start.
+        """
+        return self[self._max - self._count :]
+
+    def _stack_BW(self, images, size):
+        """
+        Internal method that converts a list of images to a stack of grayscale
+        frames of the given size, or the size of the last image if None.
+        """
         if size is None:
-            img0 = self[0]
-            (w, h) = img0.size
+            (w, h) = images[-1].size
         else:
             (w, h) = size
 
-        f = self.get_count()
-        stack = np.zeros((f, h, w), dtype="uint8")
-        for i, img in enumerate(self._data):
+        stack = np.zeros((len(images), h, w), dtype="uint8")
+        for i, img in enumerate(images):
             # if img is not (w,h) in size, then resize first
             sz = img.size
             if (w, h) != sz:
@@ -134,8 +496,48 @@ class ImageBuffer:
 
         return stack
 
+    def as_tensor(
+        self,
+        size=None,
+        layout="NCHW",
+        dtype="float32",
+        mean=None,
+        std=None,
+        out=None,
+        to_rgb=True,
+    ):
+        """
+        Outputs the images in the buffer, oldest first, as a normalized batch tensor,
+        such as the input to a neural network. See pv3.images_to_tensor(...).
+        @param size: A tuple (w,h) indicating the size of each frame in the tensor.
+        If None, then the size of the most recent image in the buffer will be used.
+        @param layout: "NCHW" or "NHWC"
+        @param dtype: the data type of the tensor, default is float32
+        @param mean: per-channel means (in output channel order) subtracted after
+        scaling the pixel values to [0,1], or None
+        @param std: per-channel standard deviations the result is divided by, or None
+        @param out: an optional contiguous array, of the correct shape and dtype,
+        that will be reused to hold the output.
+        @param to_rgb: if True (default), the channels are in RGB order.
+        @return: an ndarray of shape (N,3,h,w) or (N,h,w,3), where N is the number
+        of images in the buffer.
+        """
+        images = self._window_images()
+        if size is None:
+            size = images[-1].size
+        return pv3.images_to_tensor(
+            images,
+            size,
+            layout=layout,
+            dtype=dtype,
+            mean=mean,
+            std=std,
+            out=out,
+            to_rgb=to_rgb,
+        )
+
     def as_montage(self, layout, tile_size=None, **kwargs):
-        (w, h) = self[0].size
+        (w, h) = self[-1].size
         if tile_size is None:
             tw = w // 5
             th = h // 5
@@ -143,7 +545,8 @@ class ImageBuffer:
             th = 24 if th < 24 else th
             tile_size = (tw, th)
 
-        im = pv3.ImageMontage(self._data, layout=layout, tile_size=tile_size, **kwargs)
+        images = self._window_images()
+        im = pv3.ImageMontage(images, layout=layout, tile_size=tile_size, **kwargs)
         return im
 
     def show(self, N=10, window_title="Image Buffer", pos=None, delay=0):
@@ -153,7 +556,7 @@ class ImageBuffer:
         @param pos: The window position
         @param delay: The window display duration 
         """
-        if self[0] is None:
+        if self._count == 0:
             return
 
         if N <= self._count:
@@ -161,3 +564,431 @@ class ImageBuffer:
         else:
             im = self.as_montage(layout=(1, self._count))
         im.show(window_title=window_title, pos=pos, delay=delay)
+
+
+class _WindowStats(object):
+    """
+    Per-pixel running statistics over the window of an ImageBuffer, kept up to
+    date as a gray stack observer. See ImageBuffer.track_stats().
+    """
+
+    def __init__(self):
+        self._n = 0
+        self._sum = None
+
+    def reset(self, stack):
+        self._n = 0 if stack is None else len(stack)
+        if self._n == 0:
+            self._sum = None
+            return
+        shape = stack.shape[1:3]
+        self._allocate(shape)
+        self._min[...] = stack.min(axis=0)
+        self._max[...] = stack.max(axis=0)
+        for frame in stack:
+            self._add(frame)
+
+    def _allocate(self, shape):
+        self._sum = np.zeros(shape, dtype="int32")
+        self._sumsq = np.zeros(shape, dtype="int32")
+        self._min = np.full(shape, 255, dtype="uint8")
+        self._max = np.zeros(shape, dtype="uint8")
+        self._tmp = np.empty(shape, dtype="int32")
+
+    def _add(self, frame, sign=1):
+        np.multiply(frame, frame, out=self._tmp, dtype="int32")
+        if sign > 0:
+            np.add(self._sum, frame, out=self._sum)
+            np.add(self._sumsq, self._tmp, out=self._sumsq)
+        else:
+            np.subtract(self._sum, frame, out=self._sum)
+            np.subtract(self._sumsq, self._tmp, out=self._sumsq)
+
+    def push(self, gray_in, gray_out, stack):
+        if self._sum is None:
+            self._allocate(gray_in.shape)
+        self._add(gray_in)
+
+        if gray_out is None:
+            self._n += 1
+            np.minimum(self._min, gray_in, out=self._min)
+            np.maximum(self._max, gray_in, out=self._max)
+            return
+
+        self._add(gray_out, sign=-1)
+        # where the outgoing frame held the min (or max), and the incoming frame
+        # doesn't replace it, the extreme has to be found again from the stack
+        stale_min = (gray_out == self._min) & (gray_in > gray_out)
+        stale_max = (gray_out == self._max) & (gray_in < gray_out)
+        np.minimum(self._min, gray_in, out=self._min)
+        np.maximum(self._max, gray_in, out=self._max)
+        for (stale, extreme, func) in (
+            (stale_min, self._min, np.min),
+            (stale_max, self._max, np.max),
+        ):
+            (ys, xs) = np.nonzero(stale)
+            if len(ys) > 0:
+                extreme[ys, xs] = func(stack[:, ys, xs], axis=0)
+
+    def mean(self):
+        return (self._sum / self._n).astype("float32")
+
+    def var(self):
+        mean = self._sum / self._n
+        return (self._sumsq / self._n - mean * mean).astype("float32")
+
+    def range(self):
+        return self._max - self._min
+
+
+def _synchronized(method):
+    """
+    Decorator for the methods of ThreadSafeImageBuffer that must hold the lock.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._cond:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class ThreadSafeImageBuffer(ImageBuffer):
+    """
+    An ImageBuffer that can be shared between threads, such as a decoding thread
+    that adds frames, and background modeling or recording threads that read them.
+
+    A single writer calls add() as usual. Readers can call wait_for_new() to
+    block until a new frame is added, and snapshot() to get a consistent set of
+    first/middle/last images along with the sequence number of the newest frame.
+
+    Readers that build something from the images, such as as_tensor() and
+    as_image_stack_BW() without a gray stack, only hold the lock while they take
+    references to the images, and do the work without it. Arrays derived from the
+    gray stack (as_image_stack_BW, get_gray) are copied while holding the lock,
+    because the gray stack is updated in place by the writer, so they block the
+    writer for the time of one copy.
+
+    The writer holds the lock while add() converts the frame for the gray stack
+    and notifies the gray stack observers, such as the statistics kept by
+    track_stats() and the median tracked by a MedianModel, so that readers never
+    see them half updated. Readers calling the methods of the buffer wait for that.
+    """
+
+    def __init__(self, N=5):
+        """
+        @param N: how many image frames to buffer
+        """
+        ImageBuffer.__init__(self, N)
+        self._cond = threading.Condition(threading.RLock())
+
+    def add(self, image):
+        """
+        add an image to the buffer, and wake any threads waiting for a new frame.
+        @param  image: image to add to buffer
+        """
+        with self._cond:
+            ImageBuffer.add(self, image)
+            self._cond.notify_all()
+
+    def wait_for_new(self, last_seq=None, timeout=None):
+        """
+        Blocks until an image newer than last_seq has been added to the buffer.
+        @param last_seq: the sequence number of the newest frame the caller has seen.
+        If None, wait for the next frame added after this call.
+        @param timeout: the maximum time to wait, in seconds, or None to wait forever
+        @return: the sequence number of the newest frame, or None on timeout
+        """
+        with self._cond:
+            if last_seq is None:
+                last_seq = self._sequence
+            ok = self._cond.wait_for(lambda: self._sequence > last_seq, timeout)
+            return self._sequence if ok else None
+
+    @_synchronized
+    def snapshot(self):
+        """
+        @return: a tuple (sequence_number, first, middle, last), all read at the
+        same instant, so the images are mutually consistent.
+        """
+        return (self._sequence, self.first(), self.middle(), self.last())
+
+    def as_image_stack_BW(self, size=None, ordered=True):
+        with self._cond:
+            stack = self._gray_view(size, ordered)
+            if stack is not None:
+                # unless the stack is already a copy, such as in buffer order
+                if np.may_share_memory(stack, self._gray):
+                    stack = stack.copy()
+                return stack
+            images = ImageBuffer._window_images(self)
+        return self._stack_BW(images, size)
+
+    @_synchronized
+    def get_gray(self, key):
+        gray = ImageBuffer.get_gray(self, key)
+        return gray.copy() if self._gray is not None else gray
+
+    _window_images = _synchronized(ImageBuffer._window_images)
+    __getitem__ = _synchronized(ImageBuffer.__getitem__)
+    is_full = _synchronized(ImageBuffer.is_full)
+    clear = _synchronized(ImageBuffer.clear)
+    get_count = _synchronized(ImageBuffer.get_count)
+    get_sequence_number = _synchronized(ImageBuffer.get_sequence_number)
+    get_data = _synchronized(ImageBuffer.get_data)
+    middle = _synchronized(ImageBuffer.middle)
+    keep_gray_stack = _synchronized(ImageBuffer.keep_gray_stack)
+    get_state = _synchronized(ImageBuffer.get_state)
+    set_state = _synchronized(ImageBuffer.set_state)
+    add_gray_observer = _synchronized(ImageBuffer.add_gray_observer)
+    remove_gray_observer = _synchronized(ImageBuffer.remove_gray_observer)
+    track_stats = _synchronized(ImageBuffer.track_stats)
+    mean = _synchronized(ImageBuffer.mean)
+    var = _synchronized(ImageBuffer.var)
+    range = _synchronized(ImageBuffer.range)
+
+
+class ArrayImageBuffer(ImageBuffer):
+    """
+    An ImageBuffer that stores the pixel data of the frames in one preallocated
+    (N, H, W[, C]) ndarray, used as a ring buffer. Adding a frame copies its pixels
+    into the oldest slot, without any further allocation, and the items returned by
+    first(), middle(), last() and indexing are pyvision3 images wrapping views of
+    the ring array. Annotations of the added images are not stored.
+
+    Because the views share memory with the buffer, a returned image will be
+    overwritten once N more frames have been added. Use image.copy() to keep it
+    for longer.
+    """
+
+    def __init__(self, N=5, frame_shape=None, dtype="uint8"):
+        """
+        @param N: how many image frames to buffer
+        @param frame_shape: the shape of the frame arrays, (H, W) or (H, W, C). If
+        None, the ring array is allocated to fit the first image added.
+        @param dtype: the data type of the ring array
+        """
+        ImageBuffer.__init__(self, N)
+        self._dtype = dtype
+        self._frames = None
+        if frame_shape is not None:
+            self._allocate(frame_shape)
+
+    def _allocate(self, frame_shape):
+        self._frames = np.zeros((self._max,) + tuple(frame_shape), dtype=self._dtype)
+
+    def _get(self, slot):
+        # the list storage of the parent class holds the metadata of each frame
+        metadata = self._data[slot]
+        if metadata is None:
+            return None
+        img = pv3.Image(self._frames[slot])
+        img.metadata = metadata
+        return img
+
+    def _put(self, slot, image):
+        if self._frames is None:
+            self._allocate(image.data.shape)
+        if image.data.shape != self._frames.shape[1:]:
+            raise ValueError(
+                "Image shape {} does not match the buffer's frame shape {}".format(
+                    image.data.shape, self._frames.shape[1:]
+                )
+            )
+        self._frames[slot] = image.data
+        self._data[slot] = image.metadata.copy()
+
+    def as_image_stack_BW(self, size=None, ordered=True):
+        """
+        Outputs an image buffer as a 3D numpy array ("stack") of grayscale images.
+        If the buffer holds grayscale frames and no resizing is required, then
+        the result is a view of the ring array in buffer order, which requires
+        no copy at all if the ring hasn't wrapped around, or a single copy if it has.
+        @param size: A tuple (w,h) indicating the output size of each frame.
+        If None, then the size of the frames in the buffer will be used.
+        @param ordered: If False, the frames may be returned in storage order
+        instead of buffer order, which never requires a copy.
+        @return: a 3D array (stack) of the gray scale version of the images
+        in the buffer. The dimensions of the stack are (N,h,w).
+        """
+        gray = self._frames is not None and self._frames.ndim == 3
+        if gray and self._gray is None and self._frames.dtype == np.uint8:
+            (h, w) = self._frames.shape[1:3]
+            if size is None or tuple(size) == (w, h):
+                if not ordered:
+                    return self._filled(self._frames)
+                return self._ordered(self._frames)
+        return ImageBuffer.as_image_stack_BW(self, size=size, ordered=ordered)
+
+
+class MemmapImageBuffer(ArrayImageBuffer):
+    """
+    An ArrayImageBuffer whose ring array is a memory-mapped file on disk, so that
+    long windows (thousands of high resolution frames) can be buffered without
+    holding them all in RAM. The gray stack, if one is kept, is memory-mapped too.
+    The most recent few frames (the "hot tail") are also kept in memory, so that
+    access to the newest frames never has to touch the disk.
+
+    The API is the same as ImageBuffer: add, fill, first/middle/last,
+    as_image_stack_BW, etc. Once the ring has wrapped around, the stack returned
+    by as_image_stack_BW() in buffer order is copied into a temporary memory-mapped
+    file rather than into memory. Use ordered=False to get a view of the ring
+    instead, where the order of the frames doesn't matter.
+    """
+
+    def __init__(
+        self, N=5, filename=None, frame_shape=None, dtype="uint8", hot_frames=2
+    ):
+        """
+        @param N: how many image frames to buffer
+        @param filename: the path of the file that will hold the ring array. If
+        a gray stack is kept, it is stored in filename + ".gray". If None, anonymous
+        temporary files are used, which are removed automatically.
+        @param frame_shape: the shape of the frame arrays, (H, W) or (H, W, C). If
+        None, the ring array is allocated to fit the first image added.
+        @param dtype: the data type of the ring array
+        @param hot_frames: how many of the most recent frames to also keep in memory
+        """
+        self._filename = filename
+        self._files = []  # temporary files, kept open for the life of the buffer
+        self._hot_frames = hot_frames
+        self._hot = OrderedDict()  # slot -> frame, the most recent last
+        ArrayImageBuffer.__init__(self, N, frame_shape=frame_shape, dtype=dtype)
+
+    def _memmap(self, filename, shape, dtype):
+        if filename is None:
+            tmp = tempfile.TemporaryFile(prefix="pv3_buffer_")
+            self._files.append(tmp)
+            return np.memmap(tmp, dtype=dtype, mode="w+", shape=shape)
+        return np.memmap(filename, dtype=dtype, mode="w+", shape=shape)
+
+    def _ordered(self, ring):
+        if self._count < self._max or self._head == 0:
+            return ArrayImageBuffer._ordered(self, ring)
+        # the mapping outlives the file, which is removed once it is closed
+        with tempfile.TemporaryFile(prefix="pv3_stack_") as tmp:
+            out = np.memmap(tmp, dtype=ring.dtype, mode="w+", shape=ring.shape)
+        n = self._max - self._head
+        out[0:n] = ring[self._head :]
+        out[n:] = ring[0 : self._head]
+        return out
+
+    def _allocate(self, frame_shape):
+        shape = (self._max,) + tuple(frame_shape)
+        self._frames = self._memmap(self._filename, shape, self._dtype)
+
+    def _allocate_gray(self, shape):
+        filename = None if self._filename is None else self._filename + ".gray"
+        return self._memmap(filename, shape, "uint8")
+
+    def _get(self, slot):
+        if slot not in self._hot:
+            return ArrayImageBuffer._get(self, slot)
+        img = pv3.Image(self._hot[slot])
+        img.metadata = self._data[slot]
+        return img
+
+    def _put(self, slot, image):
+        ArrayImageBuffer._put(self, slot, image)
+        if self._hot_frames > 0:
+            # a copy, so that later changes to the caller's frame aren't buffered
+            self._hot[slot] = image.data.copy()
+            # the slot may already be hot, if the buffer holds few frames
+            self._hot.move_to_end(slot)
+            if len(self._hot) > self._hot_frames:
+                self._hot.popitem(last=False)
+
+    def clear(self):
+        ArrayImageBuffer.clear(self)
+        self._hot.clear()
+
+    def flush(self):
+        """
+        Writes any changes in the memory-mapped arrays to disk.
+        """
+        if self._frames is not None:
+            self._frames.flush()
+        if self._gray is not None:
+            self._gray.flush()
+
+
+class CompressedImageBuffer(ImageBuffer):
+    """
+    An ImageBuffer that stores each frame encoded as a JPEG or PNG, or as a
+    downsampled grayscale array, and decodes frames lazily when accessed. A small
+    cache of decoded frames avoids repeated decoding of the frames that are used
+    the most, such as the first, middle, and last.
+
+    This is useful for keeping a long history of frames, such as the pre-roll
+    for event clips, at a small fraction of the memory required to store full
+    BGR images. Annotations of the added images are not stored.
+    """
+
+    def __init__(self, N=5, encoding=".jpg", quality=90, size=None, cache_size=4):
+        """
+        @param N: how many image frames to buffer
+        @param encoding: One of ".jpg", ".png", or "gray". The first two store the
+        frames as encoded bytes, while "gray" stores them as uncompressed grayscale
+        arrays, which is typically used together with the size parameter.
+        @param quality: the JPEG quality (0-100), only used if encoding is ".jpg"
+        @param size: A tuple (w,h). If not None, frames are resized to this size
+        before they are stored.
+        @param cache_size: the number of decoded frames to keep in the cache
+        """
+        if encoding not in (".jpg", ".png", "gray"):
+            raise ValueError("Unknown encoding: {}".format(encoding))
+        ImageBuffer.__init__(self, N)
+        self._encoding = encoding
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, quality] if encoding == ".jpg" else []
+        self._size = None if size is None else tuple(size)
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _get(self, slot):
+        if slot in self._cache:
+            self._cache.move_to_end(slot)
+            return self._cache[slot]
+
+        item = self._data[slot]
+        if item is None:
+            return None
+        (payload, metadata) = item
+        if self._encoding == "gray":
+            img = pv3.Image(payload)
+        else:
+            img = pv3.Image(cv2.imdecode(payload, cv2.IMREAD_UNCHANGED))
+        img.metadata = metadata
+
+        if self._cache_size > 0:
+            self._cache[slot] = img
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return img
+
+    def _put(self, slot, image):
+        self._cache.pop(slot, None)
+        data = image.data
+        if self._encoding == "gray" and image.nchannels == 3:
+            data = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+        if self._size is not None and self._size != (data.shape[1], data.shape[0]):
+            data = cv2.resize(data, self._size, interpolation=cv2.INTER_AREA)
+
+        if self._encoding == "gray":
+            payload = data.copy() if data is image.data else data
+        else:
+            (ok, payload) = cv2.imencode(self._encoding, data, self._params)
+            if not ok:
+                raise ValueError("Unable to encode image as {}".format(self._encoding))
+        self._data[slot] = (payload, image.metadata.copy())
+
+    def clear(self):
+        ImageBuffer.clear(self)
+        self._cache.clear()
+
+    def get_nbytes(self):
+        """
+        @return: the number of bytes used to store the (encoded) frames, not
+        counting the cache of decoded frames.
+        """
+        return sum(item[0].nbytes for item in self._data if item is not None)
@@ -24,6 +24,7 @@ analysis pipelines.
 # pylint: disable=E1101
 
 import cv2
+import numpy as np
 import pyvision3 as pv3
 import sys
 import os
@@ -137,6 +138,82 @@ class VideoInterface(object):
         self.reset()
         print("Completed.")
 
+    def tensor_batches(
+        self,
+        batch_size,
+        size=None,
+        layout="NCHW",
+        dtype="float32",
+        mean=None,
+        std=None,
+        to_rgb=True,
+    ):
+        """
+        Iterates over the remaining frames of the video in batches, each converted
+        into a normalized tensor, such as the input to a neural network. See
+        pv3.images_to_tensor(...) for details of the conversion.
+
+        Parameters
+        ----------
+        batch_size: int
+            The number of frames per batch. The final batch may be smaller.
+        size: tuple (w, h) or None
+            The size of each frame in the tensor. If None, the size of the
+            first frame is used.
+        layout: str in ("NCHW", "NHWC")
+            The order of the dimensions of the output tensor
+        dtype: numpy data type
+            The data type of the output tensor, default is float32
+        mean: tuple of 3 floats, or None
+        std: tuple of 3 floats, or None
+            Per-channel normalization, (x / 255.0 - mean) / std
+        to_rgb: boolean
+            If True (default), the output channels are in RGB order
+
+        Returns
+        -------
+        Yields tuples (frame_nums, tensor), where frame_nums is a list of the frame
+        numbers in the batch. The same output array is reused for every batch,
+        so copy the tensor if it must be kept beyond the next iteration.
+        """
+        out = None
+        frames = []
+        frame_nums = []
+        for frame in self:
+            frames.append(frame)
+            frame_nums.append(self.current_frame_num)
+            if len(frames) < batch_size:
+                continue
+            if out is None:
+                size = frames[0].size if size is None else size
+                (w, h) = size
+                if layout == "NCHW":
+                    shape = (batch_size, 3, h, w)
+                else:
+                    shape = (batch_size, h, w, 3)
+                out = np.empty(shape, dtype=dtype)
+            pv3.images_to_tensor(
+                frames, size, layout, dtype, mean, std, out=out, to_rgb=to_rgb
+            )
+            yield (frame_nums, out)
+            frames = []
+            frame_nums = []
+
+        if frames:
+            size = frames[0].size if size is None else size
+            n = len(frames)
+            tensor = pv3.images_to_tensor(
+                frames,
+                size,
+                layout,
+                dtype,
+                mean,
+                std,
+                out=None if out is None else out[:n],
+                to_rgb=to_rgb,
+            )
+            yield (frame_nums, tensor)
+
     def play(
         self,
         window_title="Pyvision Video",
@@ -4,26 +4,184 @@ Author: Stephen O'Hara
 Modified: Mar 11, 2016
     For pyvision3 compatibility.
 """
+import os
+from collections import deque
 import numpy as np
 import pyvision3 as pv3
 import math
-
-# import cv2
+import cv2
+import shapely.geometry as sg
 
 # Constants used to identify a background subtraction method,
 # useful, for example, for specifying which method to use in the
 # MotionDetector class.
 BG_SUBTRACT_STATIC = "BG_SUBTRACT_STATIC"  # static bg model image
 BG_SUBTRACT_FRAME_DIFF = "BG_SUBTRACT_FD"  # frame difference
-# BG_SUBTRACT_MCFD = "BG_SUBTRACT_MCFD"         # motion compensated frame difference
+BG_SUBTRACT_MCFD = "BG_SUBTRACT_MCFD"  # motion compensated frame difference
 BG_SUBTRACT_MEDIAN = "BG_SUBTRACT_MM"  # median model
 BG_SUBTRACT_APPROX_MEDIAN = "BG_SUBTRACT_AM"  # approx median
+BG_SUBTRACT_RUNNING_GAUSSIAN = "BG_SUBTRACT_RG"  # running gaussian
+BG_SUBTRACT_SAMPLES = "BG_SUBTRACT_SAMPLES"  # sample consensus (ViBe)
+BG_SUBTRACT_MOG2 = "BG_SUBTRACT_MOG2"  # opencv gaussian mixture model
+BG_SUBTRACT_KNN = "BG_SUBTRACT_KNN"  # opencv k-nearest neighbors model
+
+
+def scaled_size(size, scale):
+    """
+    Returns
+    -------
+    The size (w, h) of a frame of the given size, scaled by the given factor and
+    rounded, as used for the processing resolution of the background models.
+    """
+    (w, h) = size
+    if scale == 1:
+        return (w, h)
+    return (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+
+
+def _as_polygons(polygons):
+    """
+    Internal function that returns a list of shapely polygons, given None, a single
+    polygon, or a list of polygons, each a shapely polygon or a sequence of (x, y)
+    points.
+    """
+    if polygons is None:
+        return []
+    if isinstance(polygons, sg.Polygon):
+        return [polygons]
+    return [p if isinstance(p, sg.Polygon) else sg.Polygon(p) for p in polygons]
+
+
+def _fill_polygon(mask, polygon, value):
+    # the interior rings are holes, as filled by cv2.fillPoly
+    rings = [polygon.exterior] + list(polygon.interiors)
+    points = [np.rint(np.array(r.coords)[:, 0:2]).astype("int32") for r in rings]
+    cv2.fillPoly(mask, points, value)
 
-# TODO: Port the motion compensated frame differencer from old pyvision3 + OpticFlow
+
+def roi_mask(size, roi=None, exclude=None):
+    """
+    Rasterizes a region of interest of the frames into a mask.
+
+    Parameters
+    ----------
+    size: tuple (w, h)
+        The size of the mask
+    roi: polygon, list of polygons, or None
+        The polygons, in the coordinates of the frames, whose union is the region
+        of interest. Each is a shapely polygon or a sequence of (x, y) points.
+        If None, the region of interest is the whole frame.
+    exclude: polygon, list of polygons, or None
+        Polygons that are excluded from the region of interest.
+
+    Returns
+    -------
+    A uint8 ndarray of shape (h, w), which is 255 in the region of interest and 0
+    elsewhere
+    """
+    (w, h) = size
+    if roi is None:
+        mask = np.full((h, w), 255, dtype="uint8")
+    else:
+        mask = np.zeros((h, w), dtype="uint8")
+        for polygon in _as_polygons(roi):
+            _fill_polygon(mask, polygon, 255)
+    for polygon in _as_polygons(exclude):
+        _fill_polygon(mask, polygon, 0)
+    return mask
+
+
+def roi_bounds(roi, exclude=None):
+    """
+    Returns
+    -------
+    The tight bounding box (x, y, w, h), in the coordinates of the frames, of the
+    region of interest (see roi_mask), or None if roi is None, in which case the
+    region of interest is the whole frame.
+    """
+    if roi is None:
+        return None
+    polygons = _as_polygons(roi)
+    w = max(int(math.ceil(p.bounds[2])) + 1 for p in polygons)
+    h = max(int(math.ceil(p.bounds[3])) + 1 for p in polygons)
+    rect = cv2.boundingRect(roi_mask((max(1, w), max(1, h)), polygons, exclude))
+    if rect[2] == 0 or rect[3] == 0:
+        raise ValueError("The region of interest is empty.")
+    return rect
+
+
+def roi_view(array, rect):
+    """
+    Returns
+    -------
+    A view of an array of the full resolution of the frames, cropped to the
+    bounding box (x, y, w, h) of a region of interest (see roi_bounds), or the
+    array itself if rect is None.
+    """
+    if rect is None:
+        return array
+    (x, y, w, h) = rect
+    return array[y : y + h, x : x + w]
+
+
+def save_checkpoint(filename, state):
+    """
+    Saves a dictionary of numpy arrays, such as the state of a background model,
+    to a compressed numpy (.npz) file. The file is written under a temporary name
+    and then renamed, so an existing checkpoint is never left half written if the
+    process dies while saving.
+    """
+    tmp = "{}.tmp".format(filename)
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **state)
+    os.replace(tmp, filename)
+
+
+def load_checkpoint(filename):
+    """
+    Returns
+    -------
+    The dictionary of numpy arrays saved by save_checkpoint()
+    """
+    with np.load(filename) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def _soft_threshold_lut(thresh):
+    d = np.arange(256, dtype="float64")
+    weights = 1 - math.e ** (-d / thresh)  # exp weighting
+    return (weights * 255).astype("uint8")
+
+
+def _background_gray(bg_image):
+    """
+    Internal function that returns the grayscale version of a background image as
+    a uint8 ndarray. Other data types, such as the float64 result of np.median over
+    a stack of frames, are rounded and clipped.
+    """
+    bg = bg_image.as_grayscale(as_type="CV")
+    if bg.dtype != np.uint8:
+        bg = np.clip(np.rint(bg), 0, 255).astype("uint8")
+    return bg
 
 
 class AbstractBGModel:
-    def __init__(self, image_buffer, thresh=80, soft_thresh=False):
+    # subclasses that read the frames from the buffer directly set this to False,
+    # so that the buffer doesn't keep a grayscale copy of every frame
+    _uses_gray_stack = True
+    # subclasses that can compute the difference image in a window of the frame,
+    # without keeping any state that must see every pixel, set this to True
+    _supports_window = False
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
         """
         Parameters
         ----------
@@ -36,10 +194,97 @@ class AbstractBGModel:
             A noise threshold to remove very small differences.
         soft_thresh: boolean
             Selects whether soft thresholding is used
+        processing_scale: float
+            The background model is computed at this fraction of the resolution of
+            the frames, such as 0.5 or 0.25, which is much faster for large frames.
+            The buffer keeps its gray stack at this resolution, and the difference
+            image and foreground mask are also at this resolution.
+        roi: polygon, list of polygons, or None
+            The region of interest of the frames (see roi_mask). If given, the
+            frames are cropped to its bounding box as they are converted for the
+            gray stack, so the model, the difference image and the foreground mask
+            only cover the bounding box (see get_roi_rect), and the foreground
+            mask is zero outside of the region of interest.
+        exclude: polygon, list of polygons, or None
+            Regions of the frames, such as those of swaying trees or a busy road,
+            where the foreground mask is always zero.
         """
         self._image_buffer = image_buffer
         self._threshold = thresh
         self._softThreshold = soft_thresh
+        self._scale = processing_scale
+        self._window = None
+        self._buffers = {}
+        self._lut = None
+        self._lut_thresh = None
+        self._roi = roi
+        self._exclude = exclude
+        self._roi_rect = roi_bounds(roi, exclude)
+        self._roi_mask = None  # at the processing resolution, rasterized on first use
+        self._observers = []  # gray stack observers registered with the buffer
+
+        # the buffer converts each frame to grayscale once, as it is added
+        if self._uses_gray_stack:
+            image_buffer.keep_gray_stack(scale=processing_scale, crop=self._roi_rect)
+
+    def get_processing_scale(self):
+        """
+        Returns
+        -------
+        The fraction of the resolution of the frames at which the model is computed
+        """
+        return self._scale
+
+    def _observe(self, observer):
+        """
+        Internal method that registers a gray stack observer with the buffer (see
+        ImageBuffer.add_gray_observer), which is removed again by detach().
+        """
+        self._image_buffer.add_gray_observer(observer)
+        self._observers.append(observer)
+
+    def detach(self):
+        """
+        Stops the image buffer from updating any state that the model keeps
+        incrementally, such as before the model is replaced by a new one for the
+        same buffer. The model can't be used afterwards.
+        """
+        for observer in self._observers:
+            self._image_buffer.remove_gray_observer(observer)
+        self._observers = []
+
+    def get_roi_rect(self):
+        """
+        Returns
+        -------
+        The bounding box (x, y, w, h) of the region of interest, in the coordinates
+        of the frames, which is the part of the frames covered by the model, or None
+        if the model covers the whole frame.
+        """
+        return self._roi_rect
+
+    def _roi_processing_mask(self, shape):
+        """
+        Internal method that returns the mask of the region of interest, cropped to
+        its bounding box and at the processing resolution, or None if there are
+        no regions of interest or exclusion.
+        """
+        if self._roi is None and self._exclude is None:
+            return None
+        if self._roi_mask is None or self._roi_mask.shape != shape:
+            size = self._image_buffer.last().size
+            mask = roi_view(roi_mask(size, self._roi, self._exclude), self._roi_rect)
+            self._roi_mask = cv2.resize(
+                mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST
+            )
+        return self._roi_mask
+
+    def _processing_size(self, size):
+        """
+        Internal method that returns the size (w, h) at which a frame of the given
+        size is processed, which matches the size of the gray stack of the buffer.
+        """
+        return scaled_size(size, self._scale)
 
     def _compute_bg_diff(self):
         """
@@ -48,35 +293,162 @@ class AbstractBGModel:
 
         Returns
         -------
-        A numpy single channel ndarray representing the difference image
+        A numpy single channel uint8 ndarray representing the absolute difference
+        image. It may be one of the buffers returned by _get_buffer(...).
         """
         raise NotImplementedError
 
-    def foreground_mask(self):
+    def _get_state(self):
+        """
+        Internal method that returns the state of the model, not counting the
+        contents of the image buffer, as a dictionary of numpy arrays. Subclasses
+        that keep state between frames override this and _set_state.
+        """
+        return {}
+
+    def _set_state(self, state):
+        """
+        Internal method that restores the state returned by _get_state().
+        """
+        pass
+
+    def get_state(self, include_buffer=True):
+        """
+        Parameters
+        ----------
+        include_buffer: boolean
+            Selects whether the contents of the image buffer are included
+
+        Returns
+        -------
+        The state of the model, as a dictionary of numpy arrays, in which the keys
+        of the state of the image buffer (see ImageBuffer.get_state) are prefixed
+        with "buffer_", and those of the model with "model_".
+        """
+        state = {"model": np.array(type(self).__name__)}
+        for (key, value) in self._get_state().items():
+            state["model_" + key] = value
+        if include_buffer:
+            for (key, value) in self._image_buffer.get_state().items():
+                state["buffer_" + key] = value
+        return state
+
+    def set_state(self, state, include_buffer=True):
+        """
+        Restores the state returned by get_state(), to a model of the same class,
+        created with the same parameters.
+
+        Parameters
+        ----------
+        state: dict
+            The state, as returned by get_state()
+        include_buffer: boolean
+            Selects whether the contents of the image buffer are restored, if the
+            state includes them
+        """
+        name = str(state["model"])
+        if name != type(self).__name__:
+            raise ValueError(
+                "Can't restore the state of a {} to a {}".format(
+                    name, type(self).__name__
+                )
+            )
+        buffer_state = {k[7:]: v for (k, v) in state.items() if k[0:7] == "buffer_"}
+        if include_buffer and buffer_state:
+            self._image_buffer.set_state(buffer_state)
+        self._set_state({k[6:]: v for (k, v) in state.items() if k[0:6] == "model_"})
+
+    def save_state(self, filename):
+        """
+        Saves the state of the model and of its image buffer to a compressed numpy
+        (.npz) file, from which it can be restored by load_state(), such as when
+        the process is restarted, rather than waiting for the buffer to fill and
+        the model to learn the background again.
+        """
+        save_checkpoint(filename, self.get_state())
+
+    def load_state(self, filename):
+        """
+        Restores the state of the model and of its image buffer saved by
+        save_state(), to a model of the same class, created with the same parameters.
+        """
+        self.set_state(load_checkpoint(filename))
+
+    def _get_buffer(self, name, shape):
+        """
+        Internal method that returns a preallocated uint8 array, identified by name,
+        so that the difference and mask images are written into the same memory
+        for every frame. A new array is only allocated if the shape changes.
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = np.zeros(shape, dtype="uint8")
+            self._buffers[name] = buf
+        return buf
+
+    def _crop(self, array):
+        """
+        Internal method that returns a view of the current window of an array of
+        the processing resolution, or the array itself if there is no window.
+        """
+        if self._window is None:
+            return array
+        (x, y, w, h) = self._window
+        return array[y : y + h, x : x + w]
+
+    def _soft_threshold_lut(self):
         """
+        Internal method that returns the 256-entry lookup table mapping each
+        absolute difference d to 255 * (1 - e^(-d/thresh)), built once for the
+        current threshold.
+        """
+        if self._lut is None or self._lut_thresh != self._threshold:
+            self._lut = _soft_threshold_lut(self._threshold)
+            self._lut_thresh = self._threshold
+        return self._lut
+
+    def foreground_mask(self, as_type="PV", window=None):
+        """
+        Parameters
+        ----------
+        as_type: str in ("CV", "PV"), default is "PV"
+        window: tuple (x, y, w, h) or None
+            If given, and the model supports it, the mask is only updated within
+            this rectangle (at the processing resolution), and the rest of the mask
+            is left as it was for the previous frame. This is used by the
+            MotionDetector to skip the regions of the frame that haven't changed.
+            Models that keep per-pixel state ignore the window. If there is a region
+            of interest, the window is relative to its bounding box.
+
         Returns
         -------
-        A mask image indicating which pixels are considered foreground. Returns an ndarray
-        of type uint8. For some methods, the mask will be binary (consisting only of the values 0 or 255),
-        or if soft threshold is used, then the full range of intensities will be returned.
+        A mask indicating which pixels are considered foreground, as a uint8 ndarray
+        if as_type is "CV", or else a pyvision3 image wrapped around the same.
+        It covers the bounding box of the region of interest, if there is one.
+        For some methods, the mask will be binary (consisting only of the values
+        0 or 255), or if soft threshold is used, then the full range of intensities
+        will be returned.
 
         Note
         ----
         One may wish to perform additional morphological operations
-            on the foreground mask prior to use.
+            on the foreground mask prior to use. The mask is written into
+            the same array for every frame, so copy it if it must be kept.
         """
+        self._window = window if self._supports_window else None
         diff = self._compute_bg_diff()
+        mask = self._get_buffer("mask", diff.shape)
+        (diff_win, mask_win) = (self._crop(diff), self._crop(mask))
         if self._softThreshold:
-            mask = 1 - math.e ** (
-                -(1.0 * diff) / self._threshold
-            )  # element-wise exp weighting
+            cv2.LUT(diff_win, self._soft_threshold_lut(), dst=mask_win)
         else:
-            mask = np.absolute(diff) > self._threshold
-            # mu = np.mean(diff)
-            # sigma = np.std(diff)
-            # mask = np.absolute((diff-mu)/sigma) > self._threshold
-        mask = (mask * 255).astype("uint8")
-        return pv3.Image(mask)
+            cv2.threshold(
+                diff_win, self._threshold, 255, cv2.THRESH_BINARY, dst=mask_win
+            )
+        roi = self._roi_processing_mask(mask.shape)
+        if roi is not None:
+            cv2.bitwise_and(mask_win, self._crop(roi), dst=mask_win)
+        return mask if as_type == "CV" else pv3.Image(mask)
 
 
 class StaticModel(AbstractBGModel):
@@ -84,25 +456,52 @@ class StaticModel(AbstractBGModel):
     Uses a single static image as the fixed background model
     """
 
-    def __init__(self, image_buffer, bg_image=None, thresh=80, soft_thresh=False):
+    _supports_window = True
+
+    def __init__(
+        self,
+        image_buffer,
+        bg_image=None,
+        thresh=80,
+        soft_thresh=False,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
         """
         Parameters
         ----------
         bg_image: pyvision3 Image
-            The image that will serve as the background model
+            The image that will serve as the background model. If its data type
+            isn't uint8, its values are rounded to the nearest integer in [0, 255].
         """
         if bg_image is None:
             raise ValueError(
                 "You must supply a background image for use with the StaticModel"
             )
         AbstractBGModel.__init__(
-            self, image_buffer, thresh=thresh, soft_thresh=soft_thresh
+            self,
+            image_buffer,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
         )
-        self._bg_array = bg_image.as_grayscale(as_type="CV")
+        self._bg_array = roi_view(_background_gray(bg_image), self._roi_rect)
+        bg_size = (self._bg_array.shape[1], self._bg_array.shape[0])
+        size = self._processing_size(bg_size)
+        if size != bg_size:
+            self._bg_array = cv2.resize(
+                self._bg_array, size, interpolation=cv2.INTER_AREA
+            )
 
     def _compute_bg_diff(self):
-        cur_img_array = self._image_buffer.last().as_grayscale(as_type="CV")
-        delta = np.absolute(cur_img_array - self._bg_array)
+        cur_img_array = self._image_buffer.get_gray(-1)
+        delta = self._get_buffer("diff", cur_img_array.shape)
+        cv2.absdiff(
+            self._crop(cur_img_array), self._crop(self._bg_array), dst=self._crop(delta)
+        )
         return delta
 
 
@@ -120,25 +519,240 @@ class FrameDifferenceModel(AbstractBGModel):
     abs(Middle-First) AND abs(Last-Middle).
     """
 
+    _supports_window = True
+
     def _compute_bg_diff(self):
-        prev_img = self._image_buffer.first().as_grayscale(as_type="CV")
-        cur_img = self._image_buffer.middle().as_grayscale(as_type="CV")
-        next_img = self._image_buffer.last().as_grayscale(as_type="CV")
+        mid = int(self._image_buffer.get_count() / 2)
+        prev_img = self._image_buffer.get_gray(0)
+        cur_img = self._image_buffer.get_gray(mid)
+        next_img = self._image_buffer.get_gray(-1)
 
-        delta1 = np.absolute(cur_img - prev_img)  # frame diff 1
-        delta2 = np.absolute(next_img - cur_img)  # frame diff 2
+        delta1 = self._get_buffer("diff", cur_img.shape)
+        delta2 = self._get_buffer("diff2", cur_img.shape)
+        (prev_img, cur_img, next_img) = map(self._crop, (prev_img, cur_img, next_img))
+        (win1, win2) = (self._crop(delta1), self._crop(delta2))
+        cv2.absdiff(cur_img, prev_img, dst=win1)  # frame diff 1
+        cv2.absdiff(next_img, cur_img, dst=win2)  # frame diff 2
 
         # use element-wise minimum of the two difference images, which is what
         # gets compared to threshold to yield foreground mask
-        return np.minimum(delta1, delta2)
+        cv2.min(win1, win2, dst=win1)
+        return delta1
+
+
+class MotionCompensatedFrameDifferenceModel(AbstractBGModel):
+    """
+    Frame differencing for moving cameras, such as pan-tilt-zoom or vehicle mounted
+    cameras. The global motion of the scene between each pair of consecutive
+    frames is estimated as an affine transform (rotation, uniform scale and
+    translation), from sparse corner features tracked by pyramidal Lucas-Kanade
+    optical flow at a low resolution, with RANSAC to reject the features on moving
+    objects. The first and last frames of the buffer are warped into the
+    coordinates of the middle (key) frame, with the composition of the transforms
+    of the frames in between, and then differenced as by the FrameDifferenceModel.
+
+    The transform of each pair of consecutive frames is estimated once, when the
+    newer frame enters the buffer, and kept while both frames are in the buffer.
+    Where a warped frame doesn't cover the key frame, there is no difference.
+    """
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        motion_scale=0.5,
+        max_features=200,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
+        """
+        Parameters
+        ----------
+        motion_scale: float
+            The features are tracked at this fraction of the processing resolution
+        max_features: int
+            The maximum number of corner features tracked between two frames
+        """
+        AbstractBGModel.__init__(
+            self,
+            image_buffer,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+        self._motion_scale = motion_scale
+        self._max_features = max_features
+        self._seq = None  # the sequence number of the newest frame with a transform
+        self._small = None  # the newest frame, at the resolution of the features
+        # 3x3 transforms from the coordinates of each frame to those of the next
+        self._transforms = deque(maxlen=max(0, len(image_buffer) - 1))
+        self._vectors = np.zeros((0, 2, 2), dtype="float32")
+
+    def _update_transforms(self):
+        """
+        Internal method that estimates the transforms of the frames that have
+        entered the buffer since the last call.
+        """
+        seq = self._image_buffer.get_sequence_number()
+        count = self._image_buffer.get_count()
+        n_new = count if self._seq is None else min(seq - self._seq, count)
+        if n_new == count:
+            self._small = None
+            self._transforms.clear()
+        for key in range(-n_new, 0):
+            gray = self._image_buffer.get_gray(key)
+            size = scaled_size((gray.shape[1], gray.shape[0]), self._motion_scale)
+            small = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+            if self._small is not None:
+                self._transforms.append(self._estimate(self._small, small, gray.shape))
+            self._small = small
+        self._seq = seq
+
+    def _estimate(self, prev, cur, shape):
+        """
+        Internal method that returns the 3x3 transform, at the processing resolution
+        of the given shape, from the coordinates of the prev frame to those of the
+        cur frame, both at the resolution of the features.
+        """
+        identity = np.eye(3)
+        self._vectors = np.zeros((0, 2, 2), dtype="float32")
+        pts = cv2.goodFeaturesToTrack(prev, self._max_features, 0.01, 5)
+        if pts is None or len(pts) < 6:
+            return identity
+        (nxt, status, _) = cv2.calcOpticalFlowPyrLK(prev, cur, pts, None)
+        tracked = status.reshape(-1) == 1
+        if np.count_nonzero(tracked) < 6:
+            return identity
+        (pts, nxt) = (pts[tracked], nxt[tracked])
+        (affine, inliers) = cv2.estimateAffinePartial2D(
+            pts, nxt, method=cv2.RANSAC, ransacReprojThreshold=0.5
+        )
+        if affine is None:
+            return identity
+
+        # from the pixel centers at the resolution of the features to those at
+        # the processing resolution, x_small = (x + 0.5) * s - 0.5
+        sx = prev.shape[1] / float(shape[1])
+        sy = prev.shape[0] / float(shape[0])
+        to_small = np.array(
+            [[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5], [0, 0, 1]]
+        )
+        to_full = np.linalg.inv(to_small)
+        vectors = np.stack((pts, nxt), axis=1)[inliers.reshape(-1) == 1]
+        vectors = vectors.reshape(-1, 2) * to_full[[0, 1], [0, 1]] + to_full[0:2, 2]
+        self._vectors = vectors.reshape(-1, 2, 2).astype("float32")
+        return to_full.dot(np.vstack((affine, [0, 0, 1]))).dot(to_small)
+
+    def get_transforms(self):
+        """
+        Returns
+        -------
+        A list of 2x3 affine matrices, one for each pair of consecutive frames in
+        the buffer, oldest first, which map the coordinates (at the processing
+        resolution) of the older frame of the pair to those of the newer one.
+        """
+        return [t[0:2] for t in self._transforms]
+
+    def get_motion_vectors(self):
+        """
+        Returns
+        -------
+        A float32 array of shape (n, 2, 2), with the positions (x, y), at the
+        processing resolution, of the n features of the last motion estimate that
+        are consistent with the global motion, in the previous frame and in the
+        newest frame of the buffer.
+        """
+        return self._vectors
+
+    def _warp(self, img, transform, name, key_img, inverse=False):
+        """
+        Internal method that warps a frame into the coordinates of the key frame,
+        leaving the key frame's own values where the frame doesn't cover it, so
+        that there is no difference there.
+        """
+        # no warp if no pixel would move by more than a small fraction
+        (h, w) = img.shape
+        corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]])
+        if np.abs(corners.dot((transform - np.eye(3)).T)).max() < 0.05:
+            return img
+        warped = self._get_buffer(name, key_img.shape)
+        np.copyto(warped, key_img)
+        flags = cv2.INTER_LINEAR | (cv2.WARP_INVERSE_MAP if inverse else 0)
+        cv2.warpAffine(
+            img,
+            transform[0:2],
+            (img.shape[1], img.shape[0]),
+            dst=warped,
+            flags=flags,
+            borderMode=cv2.BORDER_TRANSPARENT,
+        )
+        return warped
+
+    def _compute_bg_diff(self):
+        self._update_transforms()
+        transforms = list(self._transforms)
+        mid = int(self._image_buffer.get_count() / 2)
+        prev_img = self._image_buffer.get_gray(0)
+        cur_img = self._image_buffer.get_gray(mid)
+        next_img = self._image_buffer.get_gray(-1)
+
+        # the transforms from the first frame to the middle one, and from the
+        # middle frame to the last one
+        to_mid = np.eye(3)
+        for t in transforms[0:mid]:
+            to_mid = t.dot(to_mid)
+        from_mid = np.eye(3)
+        for t in transforms[mid:]:
+            from_mid = t.dot(from_mid)
+        prev_img = self._warp(prev_img, to_mid, "prev", cur_img)
+        next_img = self._warp(next_img, from_mid, "next", cur_img, inverse=True)
+
+        delta1 = self._get_buffer("diff", cur_img.shape)
+        delta2 = self._get_buffer("diff2", cur_img.shape)
+        cv2.absdiff(cur_img, prev_img, dst=delta1)
+        cv2.absdiff(next_img, cur_img, dst=delta2)
+        cv2.min(delta1, delta2, dst=delta1)
+        return delta1
 
 
 class MedianModel(AbstractBGModel):
     """
     Uses median pixel values of the images in a buffer to
     approximate a background model.
+
+    The median is not recomputed over the whole stack for each frame. Instead,
+    it is tracked as each frame enters and the oldest frame leaves, and only the
+    pixels whose median changed are selected from the stack again. The result is
+    identical to np.median over the stack, and any other quantile is available.
     """
 
+    _supports_window = True
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
+        AbstractBGModel.__init__(
+            self,
+            image_buffer,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+        self._order_stats = _SlidingOrderStatistics(len(image_buffer))
+        self._observe(self._order_stats)
+
     def _get_median_vals(self):
         """
         Returns
@@ -146,16 +760,30 @@ class MedianModel(AbstractBGModel):
         A numpy ndarray representing the gray-scale median values of the image stack.
         If you want a pyvision3 image, just wrap the result in pv3.Image(result).
         """
-        self._imageStack = self._image_buffer.as_image_stack_BW()
-        medians = np.median(
-            self._imageStack, axis=0
-        )  # median of each pixel jet in stack
-        return medians
+        return self._order_stats.median()
+
+    def get_quantile(self, q):
+        """
+        Parameters
+        ----------
+        q: float in the range [0, 1]
+            The quantile to compute, e.g. 0.5 for the median
+
+        Returns
+        -------
+        A float64 ndarray with the q-th quantile of each pixel over the images in
+        the buffer, using linear interpolation between the nearest values, as
+        np.quantile(...) does by default.
+        """
+        return self._order_stats.quantile(q)
 
     def _compute_bg_diff(self):
-        img_gray = self._image_buffer.last().as_grayscale(as_type="CV")
-        img_BG = self._get_median_vals()
-        return img_gray - img_BG
+        # the difference is taken from the median rounded to the nearest integer
+        img_gray = self._image_buffer.get_gray(-1)
+        img_BG = self._order_stats.rounded_median()
+        delta = self._get_buffer("diff", img_gray.shape)
+        cv2.absdiff(self._crop(img_gray), self._crop(img_BG), dst=self._crop(delta))
+        return delta
 
 
 class ApproximateMedianModel(MedianModel):
@@ -165,26 +793,903 @@ class ApproximateMedianModel(MedianModel):
     median image based on the images in the initial image buffer, but
     then only updates the median image using the last (newest) image in the
     buffer.
+
+    The approximate median is kept as a uint8 image, and is updated in place using
+    saturating opencv operations on preallocated arrays, so no temporary arrays
+    are created per frame.
     """
 
-    def __init__(self, image_buffer, thresh=80, soft_thresh=False):
+    _supports_window = False
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        step=1,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
+        """
+        Parameters
+        ----------
+        step: int
+            The maximum amount each pixel of the approximate median is moved toward
+            the value of the newest frame, per frame. Larger steps adapt faster to
+            changes in the background. The median never steps past the new value.
+        """
         if not image_buffer.is_full():
             raise ValueError(
                 "Image Buffer must be full before initializing Approx. Median Filter."
             )
-        MedianModel.__init__(self, image_buffer, thresh, soft_thresh)
-        self._medians = self._get_median_vals()
+        AbstractBGModel.__init__(
+            self,
+            image_buffer,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+        # the initial median is selected once, and no order statistics are tracked
+        order_stats = _SlidingOrderStatistics(len(image_buffer))
+        order_stats.reset(image_buffer.as_image_stack_BW(ordered=False))
+        self._medians = order_stats.rounded_median().copy()
+        self._step = step
+        self._lower = np.empty_like(self._medians)
+        self._upper = np.empty_like(self._medians)
 
     def _update_median(self):
-        cur_img = self._image_buffer.last()
-        cur_mat = cur_img.as_grayscale(as_type="CV")
-        median = self._medians
-        up = (cur_mat > median) * 1.0
-        down = (cur_mat < median) * 1.0
-        self._medians = self._medians + up - down
+        # median = clip(cur, median - step, median + step), which moves each pixel
+        # of the median toward the current value by at most step
+        cur_mat = self._image_buffer.get_gray(-1)
+        cv2.subtract(self._medians, self._step, dst=self._lower)
+        cv2.add(self._medians, self._step, dst=self._upper)
+        cv2.max(cur_mat, self._lower, dst=self._lower)
+        cv2.min(self._lower, self._upper, dst=self._medians)
+
+    def _get_median_vals(self):
+        return self._medians
+
+    def get_quantile(self, q):
+        """
+        Parameters
+        ----------
+        q: float
+            Only 0.5 is supported, as the approximate median is the only quantile
+            the model keeps.
+
+        Returns
+        -------
+        A float64 ndarray with the approximate median of each pixel
+        """
+        if q != 0.5:
+            raise ValueError("ApproximateMedianModel only approximates the median.")
+        return self._medians.astype("float64")
+
+    def _get_state(self):
+        return {"medians": self._medians}
+
+    def _set_state(self, state):
+        self._medians = state["medians"].astype("uint8")
+        self._lower = np.empty_like(self._medians)
+        self._upper = np.empty_like(self._medians)
 
     def _compute_bg_diff(self):
         self._update_median()
-        img_gray = self._image_buffer.last().as_grayscale(as_type="CV")
-        img_BG = self._medians
-        return img_gray - img_BG
+        img_gray = self._image_buffer.get_gray(-1)
+        delta = self._get_buffer("diff", img_gray.shape)
+        return cv2.absdiff(img_gray, self._medians, dst=delta)
+
+
+class RunningGaussianModel(AbstractBGModel):
+    """
+    Models each background pixel as a gaussian, whose mean and variance are
+    updated with each new frame, and classifies pixels by their z-score,
+    abs(x - mean) / std. Only the two float32 planes of the mean and variance are
+    kept as state, so this model only needs the newest frame of the image buffer,
+    and a buffer of size 1 is sufficient.
+
+    The difference image is the z-score scaled so that a difference above thresh
+    corresponds to a z-score above z_thresh (exactly so for integer thresholds),
+    which is then compared to thresh as for the other models.
+    """
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        alpha=0.05,
+        z_thresh=2.5,
+        min_std=4.0,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
+        """
+        Parameters
+        ----------
+        alpha: float or None
+            The learning rate of the exponentially weighted mean and variance.
+            If None, the cumulative mean and variance of all frames seen so far
+            are computed instead, using Welford's update, which is appropriate for
+            a fixed background with no lighting changes.
+        z_thresh: float
+            The z-score above which a pixel is considered foreground
+        min_std: float
+            A lower bound on the standard deviation, so that pixels that have
+            been perfectly constant so far don't trigger on the slightest noise.
+        """
+        AbstractBGModel.__init__(
+            self,
+            image_buffer,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+        self._alpha = alpha
+        self._z_thresh = z_thresh
+        self._min_var = min_std * min_std
+        self._n = 0
+        self._mean = None
+        self._var = None
+
+    def _initialize(self, img_gray):
+        self._mean = img_gray.astype("float32")
+        self._var = np.zeros_like(self._mean)
+        self._cur = np.empty_like(self._mean)
+        self._delta = np.empty_like(self._mean)
+        self._tmp = np.empty_like(self._mean)
+        self._n = 1
+
+    def _update_model(self):
+        # self._cur and self._delta (= cur - mean) are set by _compute_bg_diff
+        delta = self._delta
+        if self._alpha is None:
+            # Welford: mean_n = mean + delta / n, and
+            # var_n = var + (delta * (cur - mean_n) - var) / n
+            self._n += 1
+            n = self._n
+            self._mean += delta / n
+            np.subtract(self._cur, self._mean, out=self._tmp)
+            self._tmp *= delta
+            self._tmp -= self._var
+            self._tmp /= n
+            self._var += self._tmp
+        else:
+            # exponentially weighted: var_n = (1 - alpha) * (var + alpha * delta^2)
+            alpha = self._alpha
+            self._n += 1
+            np.multiply(delta, delta, out=self._tmp)
+            self._tmp *= alpha
+            self._var += self._tmp
+            self._var *= 1 - alpha
+            self._mean += alpha * delta
+
+    def _get_state(self):
+        if self._mean is None:
+            return {}
+        return {"mean": self._mean, "var": self._var, "n": np.array(self._n)}
+
+    def _set_state(self, state):
+        if "mean" in state:
+            self._initialize(state["mean"])
+            self._var = state["var"].astype("float32")
+            self._n = int(state["n"])
+
+    def get_mean(self):
+        """
+        Returns
+        -------
+        The float32 array of the per-pixel means of the background model
+        """
+        return self._mean
+
+    def get_var(self):
+        """
+        Returns
+        -------
+        The float32 array of the per-pixel variances of the background model
+        """
+        return self._var
+
+    def _compute_bg_diff(self):
+        img_gray = self._image_buffer.get_gray(-1)
+        diff = self._get_buffer("diff", img_gray.shape)
+        if self._mean is None:
+            self._initialize(img_gray)
+            diff[...] = 0
+            return diff
+
+        # z-score of the new frame with respect to the current model
+        np.copyto(self._cur, img_gray)
+        np.subtract(self._cur, self._mean, out=self._delta)
+        np.maximum(self._var, self._min_var, out=self._tmp)
+        np.sqrt(self._tmp, out=self._tmp)
+        np.divide(self._delta, self._tmp, out=self._tmp)
+        np.absolute(self._tmp, out=self._tmp)
+
+        # scale so that ceil(z * thresh / z_thresh) > thresh iff z > z_thresh
+        self._tmp *= self._threshold / self._z_thresh
+        np.ceil(self._tmp, out=self._tmp)
+        np.minimum(self._tmp, 255, out=self._tmp)
+        np.copyto(diff, self._tmp, casting="unsafe")
+
+        self._update_model()
+        return diff
+
+
+class SampleModel(AbstractBGModel):
+    """
+    A sample consensus background model, in the style of ViBe (Barnich and Van
+    Droogenbroeck, 2011). Each pixel keeps a set of K past values (samples), all
+    stored in one (K, h, w) uint8 array. A pixel is background if at least
+    min_matches of its samples are within radius of the new value. Background
+    pixels are used to update the model at random: about one pixel in every
+    subsample replaces one of its own samples, chosen at random, and also one
+    sample of a random neighbor, which lets the background spread into regions
+    that were uncovered by moving objects. Because samples are replaced at random,
+    the model holds values from a long, varied history, which makes it robust to
+    dynamic backgrounds such as swaying trees and water.
+
+    The difference image is binary (0 or 255), so the threshold has no effect.
+    """
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        n_samples=20,
+        radius=20,
+        min_matches=2,
+        subsample=16,
+        seed=None,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
+        """
+        Parameters
+        ----------
+        n_samples: int
+            The number of samples (K) kept per pixel, at most 255
+        radius: int
+            A sample matches the new value if their absolute difference is
+            less than the radius
+        min_matches: int
+            The number of matching samples required for the pixel to be background
+        subsample: int
+            On average, one out of this many background pixels is used to update
+            the model in each frame
+        seed: int or None
+            Seed for the random generator, for reproducible results
+        """
+        AbstractBGModel.__init__(
+            self,
+            image_buffer,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+        self._n_samples = n_samples
+        self._radius = radius
+        self._min_matches = min_matches
+        self._subsample = subsample
+        self._rng = np.random.RandomState(seed)
+        self._samples = None
+
+    def _initialize(self):
+        """
+        Fills the samples from the frames in the buffer, each shifted by a small
+        random offset, so that the samples of each pixel come from its neighborhood.
+        """
+        stack = self._image_buffer.as_image_stack_BW(ordered=False)
+        (n, h, w) = stack.shape
+        self._samples = np.empty((self._n_samples, h, w), dtype="uint8")
+        offsets = self._rng.randint(-1, 2, size=(self._n_samples, 2))
+        for k in range(self._n_samples):
+            frame = stack[k % n]
+            self._samples[k] = np.roll(frame, tuple(offsets[k]), axis=(0, 1))
+        self._count = np.empty((h, w), dtype="uint8")
+        self._match = np.empty((h, w), dtype="uint8")
+
+    def _get_state(self):
+        if self._samples is None:
+            return {}
+        # the state of the random generator, so that the updates resume exactly
+        (_, keys, pos, _, _) = self._rng.get_state()
+        return {"samples": self._samples, "rng_keys": keys, "rng_pos": np.array(pos)}
+
+    def _set_state(self, state):
+        if "samples" in state:
+            self._samples = state["samples"].astype("uint8")
+            shape = self._samples.shape[1:]
+            self._count = np.empty(shape, dtype="uint8")
+            self._match = np.empty(shape, dtype="uint8")
+            self._rng.set_state(("MT19937", state["rng_keys"], int(state["rng_pos"])))
+
+    def _update_samples(self, img_gray, diff):
+        (n_samples, h, w) = self._samples.shape
+        n_pix = h * w
+        # draw the random subsample of pixels, and keep the background ones
+        pix = self._rng.randint(0, n_pix, size=max(1, n_pix // self._subsample))
+        pix = pix[diff.reshape(-1)[pix] == 0]
+        vals = img_gray.reshape(-1)[pix]
+        samples = self._samples.reshape(n_samples, n_pix)
+
+        # replace a random sample of the pixel itself
+        k = self._rng.randint(0, n_samples, size=len(pix))
+        samples[k, pix] = vals
+
+        # and a random sample of a random 8-connected neighbor
+        ys = np.clip(pix // w + self._rng.randint(-1, 2, size=len(pix)), 0, h - 1)
+        xs = np.clip(pix % w + self._rng.randint(-1, 2, size=len(pix)), 0, w - 1)
+        k = self._rng.randint(0, n_samples, size=len(pix))
+        samples[k, ys * w + xs] = vals
+
+    def _compute_bg_diff(self):
+        if self._samples is None:
+            self._initialize()
+        img_gray = self._image_buffer.get_gray(-1)
+
+        # count the samples within the radius of the new values
+        count = self._count
+        count[...] = 0
+        for sample in self._samples:
+            cv2.absdiff(sample, img_gray, dst=self._match)
+            # 1 where the difference is less than radius, else 0
+            cv2.threshold(
+                self._match, self._radius - 1, 1, cv2.THRESH_BINARY_INV, dst=self._match
+            )
+            cv2.add(count, self._match, dst=count)
+
+        diff = self._get_buffer("diff", img_gray.shape)
+        cv2.compare(count, self._min_matches, cv2.CMP_LT, dst=diff)
+
+        self._update_samples(img_gray, diff)
+        return diff
+
+
+class _OpenCVModel(AbstractBGModel):
+    """
+    Base class for the adapters of the native opencv background subtractors,
+    which keep their own state, and are updated with the newest frame of the
+    buffer, as is, in full color.
+
+    The foreground mask of the opencv subtractor is used as the difference image.
+    It is 255 for foreground pixels and, if shadow detection is enabled, 127 for
+    shadows, so a threshold in the range [127, 255) excludes shadows from the
+    foreground mask, while the default threshold includes them.
+    """
+
+    _uses_gray_stack = False
+
+    def __init__(self, image_buffer, subtractor, learning_rate=-1, **kwargs):
+        AbstractBGModel.__init__(self, image_buffer, **kwargs)
+        self._subtractor = subtractor
+        self._learning_rate = learning_rate
+        self._n_frames = 0
+
+    def _compute_bg_diff(self):
+        frame = roi_view(self._image_buffer.last().data, self._roi_rect)
+        frame_size = (frame.shape[1], frame.shape[0])
+        size = self._processing_size(frame_size)
+        if size != frame_size:
+            resized = self._get_buffer("frame", (size[1], size[0]) + frame.shape[2:])
+            frame = cv2.resize(frame, size, dst=resized, interpolation=cv2.INTER_AREA)
+        diff = self._get_buffer("diff", frame.shape[0:2])
+        self._subtractor.apply(frame, diff, self._learning_rate)
+        self._n_frames += 1
+        return diff
+
+    def background_image(self):
+        """
+        Returns
+        -------
+        A pyvision3 image of the current background model, as computed by opencv,
+        or None if no frames have been processed yet.
+        """
+        # opencv may crash if asked for the background of an empty model
+        if self._n_frames == 0:
+            return None
+        return pv3.Image(self._subtractor.getBackgroundImage())
+
+    def _get_state(self):
+        # opencv can't save the internal state of the subtractor, so only the
+        # background image is kept, from which the model is restarted
+        if self._n_frames == 0:
+            return {}
+        return {"background": self._subtractor.getBackgroundImage()}
+
+    def _set_state(self, state):
+        if "background" in state:
+            self._subtractor.apply(state["background"], None, 1.0)
+            self._n_frames = 1
+
+
+class MOG2Model(_OpenCVModel):
+    """
+    Adapter for the opencv gaussian mixture background subtractor
+    (cv2.createBackgroundSubtractorMOG2), which is implemented in multi-threaded
+    C++, so it is much faster than the numpy models of similar quality. It only
+    needs the newest frame, so a buffer of size 1 is sufficient.
+    """
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        history=500,
+        var_threshold=16,
+        detect_shadows=False,
+        learning_rate=-1,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
+        """
+        Parameters
+        ----------
+        history: int
+            The number of frames that affect the background model
+        var_threshold: float
+            The threshold on the squared Mahalanobis distance between a pixel and
+            the model, to decide whether the pixel is well described by the model
+        detect_shadows: boolean
+            If True, shadows are detected, at some cost in speed
+        learning_rate: float
+            Between 0 and 1, how fast the model adapts. Negative values select an
+            automatic rate based on the history.
+        """
+        subtractor = cv2.createBackgroundSubtractorMOG2(
+            history=history, varThreshold=var_threshold, detectShadows=detect_shadows
+        )
+        _OpenCVModel.__init__(
+            self,
+            image_buffer,
+            subtractor,
+            learning_rate=learning_rate,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+
+
+class KNNModel(_OpenCVModel):
+    """
+    Adapter for the opencv k-nearest neighbors background subtractor
+    (cv2.createBackgroundSubtractorKNN), which is implemented in multi-threaded
+    C++. It only needs the newest frame, so a buffer of size 1 is sufficient.
+    """
+
+    def __init__(
+        self,
+        image_buffer,
+        thresh=80,
+        soft_thresh=False,
+        history=500,
+        dist2_threshold=400.0,
+        detect_shadows=False,
+        learning_rate=-1,
+        processing_scale=1.0,
+        roi=None,
+        exclude=None,
+    ):
+        """
+        Parameters
+        ----------
+        history: int
+            The number of frames that affect the background model
+        dist2_threshold: float
+            The threshold on the squared distance between a pixel and a sample,
+            to decide whether the pixel is close to the sample
+        detect_shadows: boolean
+            If True, shadows are detected, at some cost in speed
+        learning_rate: float
+            Between 0 and 1, how fast the model adapts. Negative values select an
+            automatic rate based on the history.
+        """
+        subtractor = cv2.createBackgroundSubtractorKNN(
+            history=history,
+            dist2Threshold=dist2_threshold,
+            detectShadows=detect_shadows,
+        )
+        _OpenCVModel.__init__(
+            self,
+            image_buffer,
+            subtractor,
+            learning_rate=learning_rate,
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+
+
+# the largest window of the median method that bg_subtract_video vectorizes
+MAX_CHUNK_MEDIAN_WINDOW = 15
+
+_MODEL_CLASSES = {
+    BG_SUBTRACT_STATIC: StaticModel,
+    BG_SUBTRACT_FRAME_DIFF: FrameDifferenceModel,
+    BG_SUBTRACT_MCFD: MotionCompensatedFrameDifferenceModel,
+    BG_SUBTRACT_MEDIAN: MedianModel,
+    BG_SUBTRACT_APPROX_MEDIAN: ApproximateMedianModel,
+    BG_SUBTRACT_RUNNING_GAUSSIAN: RunningGaussianModel,
+    BG_SUBTRACT_SAMPLES: SampleModel,
+    BG_SUBTRACT_MOG2: MOG2Model,
+    BG_SUBTRACT_KNN: KNNModel,
+}
+
+
+def bg_subtract_video(
+    video,
+    method=BG_SUBTRACT_MEDIAN,
+    chunk=64,
+    buff_size=5,
+    thresh=80,
+    soft_thresh=False,
+    processing_scale=1.0,
+    bg_image=None,
+    roi=None,
+    exclude=None,
+    **kwargs
+):
+    """
+    Background subtraction over all the remaining frames of a video, for the batch
+    analysis of recorded files. The frames are converted to grayscale as they are
+    decoded, into one (B, h, w) array per chunk. The static, frame difference and
+    median methods are then computed for the whole chunk at once, with vectorized
+    operations over the time axis, rather than frame by frame through an image
+    buffer and a background model. Their masks are the same as those of the
+    corresponding models, with an image buffer of size buff_size.
+
+    The other methods are recursive, as each frame updates the model used for the
+    next one, so they can't be vectorized over time. For these, the frames are
+    passed through the background model one at a time. So are those of the median
+    method with a window of more than MAX_CHUNK_MEDIAN_WINDOW frames, for which
+    the incremental median of the MedianModel is faster than the sorting network
+    used for a chunk, whose cost grows with the square of the window size.
+
+    Parameters
+    ----------
+    video: pyvision3 VideoInterface
+    method: str
+        One of the BG_SUBTRACT_* constants
+    chunk: int
+        The number of frames processed at once. The memory used by the median
+        method is about (buff_size + 4) * chunk bytes per pixel.
+    buff_size: int
+        The number of frames in the window of the frame difference and median
+        methods, and of the image buffer for the approximate median and sample
+        methods
+    thresh: int
+    soft_thresh: boolean
+    processing_scale: float
+        As for the background models
+    bg_image: pyvision3 Image
+        The background image of the static method
+    roi: polygon, list of polygons, or None
+    exclude: polygon, list of polygons, or None
+        As for the background models, so the masks only cover the bounding box of
+        the region of interest, and are zero outside of it
+    kwargs:
+        Additional keyword args passed onto the constructor of the background
+        model, for the methods that aren't vectorized. The vectorized methods
+        don't take any, and raise a ValueError if given some.
+
+    Returns
+    -------
+    Yields tuples (frame_num, mask), in order, where frame_num is the number of the
+    key frame of the mask, such as the middle frame of the window for the frame
+    difference method, and mask is a uint8 ndarray at the processing resolution.
+    The masks of the vectorized methods are views of an array that is reused for
+    every chunk, so copy a mask if it must be kept.
+    """
+    if method not in _MODEL_CLASSES:
+        raise ValueError("Unknown Background Subtraction Method specified.")
+    vectorized = (BG_SUBTRACT_STATIC, BG_SUBTRACT_FRAME_DIFF, BG_SUBTRACT_MEDIAN)
+    if method not in vectorized or (
+        method == BG_SUBTRACT_MEDIAN and buff_size > MAX_CHUNK_MEDIAN_WINDOW
+    ):
+        kwargs.update(
+            thresh=thresh,
+            soft_thresh=soft_thresh,
+            processing_scale=processing_scale,
+            roi=roi,
+            exclude=exclude,
+        )
+        for result in _model_masks(video, method, buff_size, kwargs):
+            yield result
+        return
+    if kwargs:
+        raise ValueError(
+            "Unsupported arguments for the %s method: %s"
+            % (method, ", ".join(sorted(kwargs)))
+        )
+    if method == BG_SUBTRACT_STATIC:
+        if bg_image is None:
+            raise ValueError("The static method requires a background image")
+        buff_size = 1
+
+    lut = _soft_threshold_lut(thresh) if soft_thresh else None
+    overlap = buff_size - 1  # each chunk starts with the end of the previous one
+    rect = roi_bounds(roi, exclude)
+    region = None  # the mask of the region of interest at the processing resolution
+    stack = None
+    frame_nums = []
+    for frame in video:
+        if stack is None:
+            (w, h) = frame.size if rect is None else rect[2:4]
+            size = scaled_size((w, h), processing_scale)
+            stack = np.empty((chunk + overlap, size[1], size[0]), dtype="uint8")
+            buffers = (np.empty_like(stack[0:chunk]), np.empty_like(stack[0:chunk]))
+            if bg_image is not None:
+                bg = np.empty_like(stack[0])
+                bg_gray = pv3.Image(_background_gray(bg_image))
+                buffers += (_gray_frame(bg_gray, bg, rect),)
+            if roi is not None or exclude is not None:
+                # rasterized, cropped and resized as by the background models
+                region = roi_view(roi_mask(frame.size, roi, exclude), rect)
+                region = cv2.resize(region, size, interpolation=cv2.INTER_NEAREST)
+        _gray_frame(frame, stack[len(frame_nums)], rect)
+        frame_nums.append(video.current_frame_num)
+        if len(frame_nums) == len(stack):
+            masks = _chunk_masks(method, stack, buff_size, thresh, lut, buffers, region)
+            for (key, mask) in masks:
+                yield (frame_nums[key], mask)
+            stack[0:overlap] = stack[chunk:]
+            del frame_nums[0:chunk]
+
+    if len(frame_nums) > overlap:
+        stack = stack[0 : len(frame_nums)]
+        masks = _chunk_masks(method, stack, buff_size, thresh, lut, buffers, region)
+        for (key, mask) in masks:
+            yield (frame_nums[key], mask)
+
+
+def _gray_frame(image, dst, crop=None):
+    # the same conversion as for the gray stack of an ImageBuffer
+    data = roi_view(image.data, crop)
+    if dst.shape == data.shape[0:2]:
+        if data.ndim == 3:
+            cv2.cvtColor(data, cv2.COLOR_BGR2GRAY, dst=dst)
+        else:
+            dst[...] = data
+    else:
+        if data.ndim == 3:
+            data = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+        size = (dst.shape[1], dst.shape[0])
+        cv2.resize(data, size, dst=dst, interpolation=cv2.INTER_AREA)
+    return dst
+
+
+def _median_network(n):
+    """
+    Internal function that returns the compare-exchange pairs (i, i + 1) of an
+    odd-even transposition sort of n values, without those that the middle value(s)
+    of the sorted output don't depend on.
+    """
+    pairs = [(i, i + 1) for r in range(n) for i in range(r % 2, n - 1, 2)]
+    needed = set(((n - 1) // 2, n // 2))
+    pruned = []
+    for (i, j) in reversed(pairs):
+        if i in needed or j in needed:
+            needed.update((i, j))
+            pruned.append((i, j))
+    return pruned[::-1]
+
+
+def _chunk_masks(method, stack, window, thresh, lut, buffers, roi=None):
+    """
+    Internal function that computes the masks of all the complete windows of a
+    stack of gray frames at once, and yields them with the positions of their key
+    frames in the stack. If given, roi is the mask of the region of interest at
+    the processing resolution, outside of which the masks are zeroed.
+    """
+    (n, h, w) = stack.shape
+    b = n - window + 1  # the number of complete windows
+    (diff, tmp) = (buffers[0][0:b], buffers[1][0:b])
+
+    # cv2 functions are applied to the stacks reshaped to 2D, (b * h, w)
+    def flat(array):
+        return array.reshape(-1, w)
+
+    if method == BG_SUBTRACT_STATIC:
+        key = 0
+        bg = buffers[2]
+        # absolute difference without overflow, broadcast over the frames
+        np.subtract(np.maximum(stack, bg), np.minimum(stack, bg), out=diff)
+    elif method == BG_SUBTRACT_FRAME_DIFF:
+        key = window // 2
+        (prev, cur, nxt) = (stack[0:b], stack[key : key + b], stack[window - 1 :])
+        cv2.absdiff(flat(cur), flat(prev), dst=flat(diff))
+        cv2.absdiff(flat(nxt), flat(cur), dst=flat(tmp))
+        cv2.min(flat(diff), flat(tmp), dst=flat(diff))
+    else:
+        key = window - 1
+        # lane i holds the i-th frame of every window, and a sorting network of
+        # min/max operations over whole lanes sorts all the windows at once
+        lanes = [flat(stack[i : i + b]).copy() for i in range(window)]
+        spare = np.empty_like(lanes[0])
+        for (i, j) in _median_network(window):
+            cv2.min(lanes[i], lanes[j], dst=spare)
+            cv2.max(lanes[i], lanes[j], dst=lanes[j])
+            (lanes[i], spare) = (spare, lanes[i])
+        mid = window // 2
+        if window % 2 == 1:
+            np.copyto(flat(tmp), lanes[mid])
+        else:
+            # the mean of the middle two, rounded half to even as by MedianModel
+            cv2.addWeighted(lanes[mid - 1], 0.5, lanes[mid], 0.5, 0, dst=flat(tmp))
+        cv2.absdiff(flat(stack[key:]), flat(tmp), dst=flat(diff))
+
+    if lut is not None:
+        cv2.LUT(flat(diff), lut, dst=flat(diff))
+    else:
+        cv2.threshold(flat(diff), thresh, 255, cv2.THRESH_BINARY, dst=flat(diff))
+    if roi is not None:
+        np.bitwise_and(diff, roi, out=diff)
+    for i in range(b):
+        yield (key + i, diff[i])
+
+
+def _model_masks(video, method, buff_size, kwargs):
+    """
+    Internal function that yields the masks of a video, frame by frame, through
+    an image buffer and a background model.
+    """
+    single = method in (BG_SUBTRACT_RUNNING_GAUSSIAN, BG_SUBTRACT_MOG2, BG_SUBTRACT_KNN)
+    image_buffer = pv3.ImageBuffer(N=1 if single else buff_size)
+    model = None
+    # the key frame of the motion compensated method is the middle of the window
+    key_offset = buff_size - 1 - buff_size // 2 if method == BG_SUBTRACT_MCFD else 0
+    for frame in video:
+        image_buffer.add(frame)
+        if not image_buffer.is_full():
+            continue
+        if model is None:
+            model = _MODEL_CLASSES[method](image_buffer, **kwargs)
+        mask = model.foreground_mask(as_type="CV")
+        yield (video.current_frame_num - key_offset, mask)
+
+
+class _SlidingOrderStatistics(object):
+    """
+    Per-pixel order statistics (such as the median) of the grayscale frames in the
+    window of an ImageBuffer, kept up to date as a gray stack observer (see
+    ImageBuffer.add_gray_observer), with only the frame entering and the frame
+    leaving the window.
+
+    Each requested k-th smallest value is selected from the stack the first time
+    it is requested. From then on, it is tracked along with the number of values
+    below it and equal to it, which each entering and leaving value changes by at
+    most one. Only the pixels whose tracked value is no longer the k-th smallest
+    are selected from the stack again, at a cost of O(N) per pixel however far the
+    value moved, so even a global change of lighting costs no more than a single
+    np.median over the stack. Apart from the stack itself, which the buffer
+    already keeps, this needs 5 bytes per pixel for each tracked statistic.
+    The selection works on a limited number of pixels at a time, so a stack that
+    is memory-mapped (see MemmapImageBuffer) is never read into memory as a whole.
+    """
+
+    def __init__(self, max_count, max_memory=32 * 2 ** 20):
+        """
+        Parameters
+        ----------
+        max_count: int
+            The maximum number of frames in the window (the size of the buffer),
+            which determines the data type of the counts.
+        max_memory: int
+            Approximate cap, in bytes, on the working memory used to select values
+            from the stack.
+        """
+        self._dtype = "int16" if max_count < 2 ** 15 else "int32"
+        self._max_memory = max_memory
+        self._n = 0
+        self._stack = None
+        self._trackers = {}
+
+    def reset(self, stack):
+        self._trackers = {}
+        self._n = 0 if stack is None else len(stack)
+        self._stack = stack
+
+    def push(self, gray_in, gray_out, stack):
+        self._stack = stack
+        if gray_out is None:
+            # the window grew, so the ranks of interest have changed
+            self._n += 1
+            self._trackers = {}
+            return
+
+        vals_in = gray_in.reshape(-1)
+        vals_out = gray_out.reshape(-1)
+        for (k, (value, below, equal)) in self._trackers.items():
+            below += vals_in < value
+            below -= vals_out < value
+            equal += vals_in == value
+            equal -= vals_out == value
+            pix = np.flatnonzero((below > k) | (below + equal <= k))
+            if len(pix) > 0:
+                (value[pix], below[pix], equal[pix]) = self._select(k, pix)
+
+    def _select(self, k, pix=None):
+        """
+        Returns the k-th smallest value of the given pixels (all pixels if None),
+        and the number of values below it and equal to it, from the stack.
+        """
+        values = self._stack.reshape(self._n, -1)
+        n_pix = values.shape[1] if pix is None else len(pix)
+        value = np.empty(n_pix, dtype="uint8")
+        below = np.empty(n_pix, dtype=self._dtype)
+        equal = np.empty(n_pix, dtype=self._dtype)
+        # each column of a chunk is copied once for the partition, and compared
+        # into two boolean arrays
+        step = max(1, self._max_memory // (3 * self._n))
+        for start in range(0, n_pix, step):
+            cols = slice(start, start + step)
+            chunk = values[:, cols] if pix is None else values[:, pix[cols]]
+            value[cols] = np.partition(chunk, k, axis=0)[k]
+            below[cols] = np.count_nonzero(chunk < value[cols], axis=0)
+            equal[cols] = np.count_nonzero(chunk == value[cols], axis=0)
+        return (value, below, equal)
+
+    def kth(self, k):
+        """
+        Returns
+        -------
+        A uint8 array with the k-th smallest value (counting from 0) of each pixel
+        over the frames in the window
+        """
+        if k not in self._trackers:
+            self._trackers[k] = self._select(k)
+        value = self._trackers[k][0]
+        return value.reshape(self._stack.shape[1:3])
+
+    def median(self):
+        """
+        Returns
+        -------
+        A float64 array with the median of each pixel, identical to np.median,
+        which averages the two middle values when the count is even.
+        """
+        n = self._n
+        if n % 2 == 1:
+            return self.kth(n // 2).astype("float64")
+        lo = self.kth(n // 2 - 1).astype("float64")
+        hi = self.kth(n // 2)
+        return (lo + hi) / 2.0
+
+    def rounded_median(self):
+        """
+        Returns
+        -------
+        A uint8 array with the median of each pixel, rounded to the nearest integer
+        (half to even, as np.rint does) when it falls between two values.
+        """
+        n = self._n
+        if n % 2 == 1:
+            return self.kth(n // 2)
+        return cv2.addWeighted(self.kth(n // 2 - 1), 0.5, self.kth(n // 2), 0.5, 0)
+
+    def quantile(self, q):
+        pos = q * (self._n - 1)
+        k = int(math.floor(pos))
+        frac = pos - k
+        lo = self.kth(k).astype("float64")
+        if frac == 0:
+            return lo
+        hi = self.kth(k + 1)
+        return lo + frac * (hi - lo)
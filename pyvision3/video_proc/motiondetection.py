@@ -9,12 +9,26 @@ import pyvision3 as pv3
 from pyvision3 import (
     BG_SUBTRACT_STATIC,
     BG_SUBTRACT_FRAME_DIFF,
+    BG_SUBTRACT_MCFD,
     BG_SUBTRACT_MEDIAN,
     BG_SUBTRACT_APPROX_MEDIAN,
+    BG_SUBTRACT_RUNNING_GAUSSIAN,
+    BG_SUBTRACT_SAMPLES,
+    BG_SUBTRACT_MOG2,
+    BG_SUBTRACT_KNN,
 )
 
+import math
+import os
 import cv2
 import numpy as np
+from pyvision3.video_proc.backgroundsubtract import (
+    scaled_size,
+    roi_bounds,
+    roi_view,
+    save_checkpoint,
+    load_checkpoint,
+)
 
 try:
     import shapely.geometry as sg
@@ -25,6 +39,14 @@ except ImportError:
 MD_BOUNDING_RECTS = "BOUNDING_RECTS"
 MD_STANDARDIZED_RECTS = "STANDARDIZED_RECTS"
 
+# background subtraction methods that keep their own state, and only need the
+# newest frame of the buffer
+_SINGLE_FRAME_METHODS = (
+    BG_SUBTRACT_RUNNING_GAUSSIAN,
+    BG_SUBTRACT_MOG2,
+    BG_SUBTRACT_KNN,
+)
+
 
 class MotionDetector(object):
     """
@@ -45,6 +67,13 @@ class MotionDetector(object):
         buff_size=5,
         rect_type=MD_BOUNDING_RECTS,
         rect_sigma=2.0,
+        processing_scale=1.0,
+        gate_block_size=None,
+        gate_thresh=3.0,
+        roi=None,
+        exclude=None,
+        checkpoint_path=None,
+        checkpoint_interval=1000,
         **kwargs
     ):
         """
@@ -63,7 +92,39 @@ class MotionDetector(object):
           define rules to further limit motion detection results based on the geometry
           of the bounding boxes.
         buff_size: Only used if image_buffer==None. This controls the size of the
-          internal image buffer.
+          internal image buffer. The running gaussian, MOG2 and KNN methods keep
+          their own state, and only need the newest frame, so for these methods
+          the internal buffer has a single frame.
+        processing_scale: The background model, morphology and contours are computed
+          at this fraction of the resolution of the frames, such as 0.5 or 0.25,
+          which is much faster for large frames. The results (rects, polygons, masks,
+          and foreground pixels) are still given at the full resolution.
+        gate_block_size: If not None, block-level change gating is enabled, with
+          blocks of this size (in pixels at the processing resolution). Each frame
+          is first compared to the previous one at a low resolution, computing
+          the mean absolute difference of each block. For the models that depend
+          only on the frames in the buffer (static, frame difference and median),
+          only the region of the blocks that changed within the span of the buffer
+          is passed through the background model and morphology, and the previous
+          mask is reused elsewhere. If no block has changed, the previous results
+          are kept. The other models keep their own state, which must be updated
+          with every frame, so they always process the whole frame. A frame that is exactly equal to
+          the previous one (such as from a stalled camera feed) is skipped
+          outright, without even being added to the buffer. See gating_stats().
+        gate_thresh: The mean absolute difference (in gray levels) above which a
+          block is considered to have changed.
+        roi: A polygon or list of polygons (shapely polygons or sequences of (x, y)
+          points) that make up the region of interest of the frames. Only the
+          bounding box of the region of interest is processed, and there are no
+          detections outside of it. See backgroundsubtract.roi_mask.
+        exclude: A polygon or list of polygons of regions of the frames where there
+          are no detections.
+        checkpoint_path: If not None, the state of the background model and of the
+          image buffer is saved to this file (see save_state) every
+          checkpoint_interval frames, and if the file already exists, the state
+          is loaded from it now. This way, when the process is restarted, the
+          detection resumes at once, instead of waiting for the buffer to fill.
+        checkpoint_interval: The number of frames between checkpoints
         kwargs: additional keyword args will be passed onto the constructor of the background
             subtraction object
 
@@ -72,13 +133,21 @@ class MotionDetector(object):
         Until the image buffer is full, the result of the motion detection will be
           nothing. See documentation on the detect(img) method of this class.
         """
-        self._fgMask = None
+        self._fgMask = None  # at the processing resolution, of the roi bounding box
+        self._binary = None  # the mask before any convex hulls are filled in
+        self._fgMaskFull = None  # full resolution, computed when requested
+        self._scale = processing_scale
+        self._roi = roi
+        self._exclude = exclude
+        self._roi_rect = roi_bounds(roi, exclude)
         self._minArea = min_area
         self._filter = rect_filter
         self._threshold = thresh
         self._softThreshold = False  # soft_thresh
 
         if image_buffer is None:
+            if method in _SINGLE_FRAME_METHODS:
+                buff_size = 1
             self._image_buffer = pv3.ImageBuffer(N=buff_size)
         else:
             self._image_buffer = image_buffer
@@ -94,30 +163,153 @@ class MotionDetector(object):
 
         self._kwargs = kwargs  # passed onto background subtractor initialization
 
+        self._gate_block = gate_block_size
+        self._gate_thresh = gate_thresh
+        self._gate_prev = None  # previous low resolution gray frame
+        self._block_age = None  # frames since each block last changed
+        self._gate_stats = {
+            "frames": 0,
+            "frozen": 0,
+            "static": 0,
+            "gated": 0,
+            "full": 0,
+            "active_fraction": 1.0,
+        }
+
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_seq = 0  # sequence number of the last checkpoint
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self.load_state()
+
     def _init_bg_subtract(self):
         kwargs = self._kwargs
-        kwargs = {"thresh": self._threshold, "soft_thresh": False}
+        kwargs = {
+            "thresh": self._threshold,
+            "soft_thresh": False,
+            "processing_scale": self._scale,
+            "roi": self._roi,
+            "exclude": self._exclude,
+        }
         kwargs.update(self._kwargs)
 
         if self._method == BG_SUBTRACT_FRAME_DIFF:
             self._bgSubtract = pv3.FrameDifferenceModel(self._image_buffer, **kwargs)
         elif self._method == BG_SUBTRACT_STATIC:
             self._bgSubtract = pv3.StaticModel(self._image_buffer, **kwargs)
-        # elif self._method == BG_SUBTRACT_MCFD:
-        #    self._bgSubtract = pv.MotionCompensatedFrameDifferencer(self._image_buffer, self._threshold)
+        elif self._method == BG_SUBTRACT_MCFD:
+            self._bgSubtract = pv3.MotionCompensatedFrameDifferenceModel(
+                self._image_buffer, **kwargs
+            )
         elif self._method == BG_SUBTRACT_MEDIAN:
             self._bgSubtract = pv3.MedianModel(self._image_buffer, **kwargs)
         elif self._method == BG_SUBTRACT_APPROX_MEDIAN:
             self._bgSubtract = pv3.ApproximateMedianModel(self._image_buffer, **kwargs)
+        elif self._method == BG_SUBTRACT_RUNNING_GAUSSIAN:
+            self._bgSubtract = pv3.RunningGaussianModel(self._image_buffer, **kwargs)
+        elif self._method == BG_SUBTRACT_SAMPLES:
+            self._bgSubtract = pv3.SampleModel(self._image_buffer, **kwargs)
+        elif self._method == BG_SUBTRACT_MOG2:
+            self._bgSubtract = pv3.MOG2Model(self._image_buffer, **kwargs)
+        elif self._method == BG_SUBTRACT_KNN:
+            self._bgSubtract = pv3.KNNModel(self._image_buffer, **kwargs)
         else:
             raise ValueError("Unknown Background Subtraction Method specified.")
 
     def _compute_contours(self):
-        mask_array = self._fgMask.as_grayscale(as_type="CV")
-        _, contours, _ = cv2.findContours(
+        mask_array = self._fgMask.data
+        # opencv 3 returns (image, contours, hierarchy), opencv 4+ omits the image
+        contours = cv2.findContours(
             mask_array, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-        )
-        self._contours = contours
+        )[-2]
+        self._contours = [self._to_full_res(c) for c in contours]
+
+    def _to_full_res(self, points):
+        """
+        Maps an array of integer points from the processing resolution (relative to
+        the bounding box of the region of interest) to the full resolution of the
+        frames, aligning the centers of the pixels.
+        """
+        if self._scale != 1:
+            points = np.rint((points + 0.5) / self._scale - 0.5).astype("int32")
+        if self._roi_rect is not None:
+            points = points + np.array(self._roi_rect[0:2], dtype="int32")
+        return points
+
+    def _to_processing_res(self, points):
+        if self._roi_rect is not None:
+            points = points - np.array(self._roi_rect[0:2], dtype="int32")
+        if self._scale != 1:
+            points = np.rint((points + 0.5) * self._scale - 0.5).astype("int32")
+        return points
+
+    def _gate(self, img):
+        """
+        Compares the frame to the previous one, block by block, at low resolution.
+
+        Returns
+        -------
+        The window (x, y, w, h), at the processing resolution (and relative to the
+        bounding box of the region of interest, if any), of the blocks that have
+        changed within the span of the buffer, plus a margin of one block. The
+        window is empty if no blocks have changed.
+        """
+        data = roi_view(img.data, self._roi_rect)
+        (pw, ph) = scaled_size((data.shape[1], data.shape[0]), self._scale)
+        nbx = int(math.ceil(pw / float(self._gate_block)))
+        nby = int(math.ceil(ph / float(self._gate_block)))
+
+        # 4x4 samples per block are enough to measure the change of the block
+        small = cv2.resize(data, (4 * nbx, 4 * nby), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        prev = self._gate_prev
+        self._gate_prev = small
+        if prev is None or prev.shape != small.shape:
+            self._block_age = np.zeros((nby, nbx), dtype="int32")
+            return (0, 0, pw, ph)
+
+        diff = cv2.absdiff(small, prev).astype("float32")
+        block_mad = cv2.resize(diff, (nbx, nby), interpolation=cv2.INTER_AREA)
+        changed = block_mad > self._gate_thresh
+        self._block_age += 1
+        self._block_age[changed] = 0
+        active = self._block_age < len(self._image_buffer)
+        n_active = np.count_nonzero(active)
+        self._gate_stats["active_fraction"] = float(n_active) / active.size
+        if not active.any():
+            return (0, 0, 0, 0)
+
+        (ys, xs) = np.nonzero(active)
+        x0 = int(math.floor((xs.min() - 1) * pw / float(nbx)))
+        y0 = int(math.floor((ys.min() - 1) * ph / float(nby)))
+        x1 = int(math.ceil((xs.max() + 2) * pw / float(nbx)))
+        y1 = int(math.ceil((ys.max() + 2) * ph / float(nby)))
+        (x0, y0, x1, y1) = (max(0, x0), max(0, y0), min(pw, x1), min(ph, y1))
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def _is_duplicate(self, img):
+        """
+        Returns True if the frame is exactly equal, at full resolution, to the
+        last frame added to the buffer.
+        """
+        last = self._image_buffer.last()
+        if last is None or last.data.shape != img.data.shape:
+            return False
+        return cv2.norm(last.data, img.data, cv2.NORM_INF) == 0
+
+    def gating_stats(self):
+        """
+        Returns
+        -------
+        A dictionary of statistics of the block-level change gating, with the
+        number of frames processed ("frames"), the number skipped as duplicates
+        ("frozen"), those with no changed blocks ("static"), those processed in
+        a window of changed blocks ("gated"), and those processed in full ("full"),
+        and the fraction of the blocks that were active in the last frame
+        ("active_fraction"). See the gate_block_size parameter.
+        """
+        return dict(self._gate_stats)
 
     def _compute_convex_hulls(self):
         hulls = []
@@ -166,6 +358,25 @@ class MotionDetector(object):
         the buffer, which is not always the most recent image, depending on background
         subtraction method.
         """
+        n_components = self._detect(img, convex_hulls)
+        seq = self._image_buffer.get_sequence_number()
+        if (
+            self._checkpoint_path is not None
+            and seq - self._checkpoint_seq >= self._checkpoint_interval
+        ):
+            self.save_state()
+        return n_components
+
+    def _detect(self, img, convex_hulls):
+        window = None
+        if self._gate_block is not None:
+            self._gate_stats["frames"] += 1
+            if self._is_duplicate(img):
+                # a duplicate frame, which would only corrupt the background model
+                self._gate_stats["frozen"] += 1
+                return -1 if self._bgSubtract is None else len(self._contours)
+            window = self._gate(img)
+
         self._image_buffer.add(img)
         if not self._image_buffer.is_full():
             return -1
@@ -176,34 +387,113 @@ class MotionDetector(object):
 
         # update current annotation image from buffer, as appropriate for
         # the different methods
-        if self._method == BG_SUBTRACT_FRAME_DIFF:
+        if self._method in (BG_SUBTRACT_FRAME_DIFF, BG_SUBTRACT_MCFD):
             self._annotateImg = self._image_buffer.middle()
-        # elif self._method == BG_SUBTRACT_MCFD:
-        #    self._annotateImg = self._image_buffer.middle()
         else:
             self._annotateImg = self._image_buffer.last()
 
-        mask = self._bgSubtract.foreground_mask()
-        cv_binary = mask.as_grayscale(as_type="CV")
-
-        # morphology
-        cv_binary = cv2.blur(cv_binary, (5, 5))
-        cv_binary = cv2.dilate(cv_binary, (5, 5))
-        cv_binary = cv2.erode(cv_binary, (5, 5))
+        if not self._bgSubtract._supports_window:
+            # the model must see every frame in full to keep its state up to date
+            window = None
+        if window is not None and self._binary is not None:
+            if window[2] == 0 or window[3] == 0:
+                # nothing has changed, so the previous results still hold
+                self._gate_stats["static"] += 1
+                return len(self._contours)
+            self._gate_stats["gated"] += 1
+        elif self._gate_block is not None:
+            self._gate_stats["full"] += 1
+            window = None
+
+        mask = self._bgSubtract.foreground_mask(as_type="CV", window=window)
+
+        # morphology, only within the window, if there is one
+        if window is None:
+            cv_binary = self._morphology(mask)
+        else:
+            # the mask outside of the window is that of the previous frame, before
+            # any convex hulls were filled in
+            (x, y, w, h) = window
+            cv_binary = self._binary.copy()
+            cv_binary[y : y + h, x : x + w] = self._morphology(
+                mask[y : y + h, x : x + w]
+            )
+        self._binary = cv_binary
 
         # update the foreground mask
         self._fgMask = pv3.Image(cv_binary)
+        self._fgMaskFull = None
 
         # update the detected foreground contours
         self._compute_contours()
         self._compute_convex_hulls()
 
         if convex_hulls:
+            cv_binary = cv_binary.copy()
             for hull in self._convexHulls:
+                hull = self._to_processing_res(hull)
                 cv2.fillConvexPoly(cv_binary, hull, (255, 255, 255))
+            self._fgMask = pv3.Image(cv_binary)
 
         return len(self._contours)
 
+    def save_state(self, filename=None):
+        """
+        Saves the state of the background model and of the image buffer to a
+        compressed numpy (.npz) file, from which a motion detector created with
+        the same parameters can resume, with load_state().
+
+        Parameters
+        ----------
+        filename: str or None
+            If None, the checkpoint_path given to the constructor is used.
+        """
+        filename = self._checkpoint_path if filename is None else filename
+        if self._bgSubtract is None:
+            # the buffer is still filling
+            state = {"model": np.array("")}
+            for (key, value) in self._image_buffer.get_state().items():
+                state["buffer_" + key] = value
+        else:
+            state = self._bgSubtract.get_state()
+        save_checkpoint(filename, state)
+        self._checkpoint_seq = self._image_buffer.get_sequence_number()
+
+    def load_state(self, filename=None):
+        """
+        Restores the state saved by save_state(). If the buffer is full, as it is
+        unless the state was saved while it was still filling, detect() resumes
+        making detections from the next frame.
+
+        Parameters
+        ----------
+        filename: str or None
+            If None, the checkpoint_path given to the constructor is used.
+        """
+        filename = self._checkpoint_path if filename is None else filename
+        state = load_checkpoint(filename)
+        if self._bgSubtract is not None:
+            # the new model replaces this one, which must no longer be updated
+            self._bgSubtract.detach()
+        buffer_state = {k[7:]: v for (k, v) in state.items() if k[0:7] == "buffer_"}
+        self._image_buffer.set_state(buffer_state)
+        self._checkpoint_seq = self._image_buffer.get_sequence_number()
+        self._bgSubtract = None
+        self._fgMask = None
+        self._binary = None
+        self._fgMaskFull = None
+        self._contours = []
+        self._gate_prev = None
+        if self._image_buffer.is_full():
+            self._init_bg_subtract()
+            if str(state["model"]):
+                self._bgSubtract.set_state(state, include_buffer=False)
+
+    def _morphology(self, mask):
+        cv_binary = cv2.blur(mask, (5, 5))
+        cv_binary = cv2.dilate(cv_binary, (5, 5))
+        return cv2.erode(cv_binary, (5, 5))
+
     def key_frame(self):
         """
         Returns
@@ -220,11 +510,27 @@ class MotionDetector(object):
         Returns
         -------
         A binary pv.Image representing the foreground pixels
-        as determined by the selected background subtraction method.
+        as determined by the selected background subtraction method, at the full
+        resolution of the frames.
         @note: You must call the detect() method before foreground_mask() to
         get the updated mask.
         """
-        return self._fgMask
+        if self._fgMask is None:
+            return None
+        if self._scale == 1 and self._roi_rect is None:
+            return self._fgMask
+        if self._fgMaskFull is None:
+            (w, h) = self._annotateImg.size
+            mask = np.zeros((h, w), dtype="uint8")
+            roi = roi_view(mask, self._roi_rect)
+            cv2.resize(
+                self._fgMask.data,
+                (roi.shape[1], roi.shape[0]),
+                dst=roi,
+                interpolation=cv2.INTER_NEAREST,
+            )
+            self._fgMaskFull = pv3.Image(mask)
+        return self._fgMaskFull
 
     def foreground_pixels(self, bg_color=None):
         """
@@ -248,7 +554,7 @@ class MotionDetector(object):
             return None
 
         # binary mask selecting foreground regions
-        mask = self._fgMask.as_grayscale(as_type="CV")
+        mask = self.foreground_mask().data
 
         # full color source image
         image = self._annotateImg.data
@@ -424,6 +730,7 @@ class MotionDetector(object):
         rect_color=pv3.RGB_RED,
         contour_color=pv3.RGB_BLACK,
         convex_hull_color=pv3.RGB_CYAN,
+        flow_color=None,
     ):
         """
         Draws detection results on an image (key_frame) specified by the user. Specify
@@ -437,6 +744,8 @@ class MotionDetector(object):
         rect_color: tuple (r,g,b) for detection rectangles, or None
         contour_color: tuple (r,g,b) for detection contours, or None
         convex_hull_color: tuple (r,g,b) for convex hulls, or None
+        flow_color: tuple (r,g,b) for the motion vectors of the features used to
+            estimate the camera motion, or None
 
         Returns
         -------
@@ -448,7 +757,8 @@ class MotionDetector(object):
         Notes
         -----
         1. You must call detect() prior to annotate_frame() to see updated results.
-        2. Optical flow is only shown if method was MCFD. Optical flow not yet implemented
+        2. Motion vectors are only shown if the method is BG_SUBTRACT_MCFD. They are
+           the feature motion from the previous frame to the newest frame.
         """
         if key_frame is None and self._annotateImg is None:
             return None
@@ -467,9 +777,9 @@ class MotionDetector(object):
             for poly in self.convex_hulls():
                 key_frame.annotate_shape(poly, color=convex_hull_color, thickness=1)
 
-        # TODO: Update this after porting OpticFlow and MCFD code to pyvision3 3
-        # if (flow_color is not None) and (self._method == pv.BG_SUBTRACT_MCFD):
-        #    flow = self._bgSubtract.getOpticalFlow()
-        #    flow.annotate_frame(key_frame, type="TRACKING", color=flow_color)
+        if flow_color is not None and self._method == BG_SUBTRACT_MCFD:
+            vectors = np.rint(self._bgSubtract.get_motion_vectors()).astype("int32")
+            for (pt1, pt2) in self._to_full_res(vectors):
+                key_frame.annotate_line(tuple(pt1), tuple(pt2), color=flow_color)
 
         return key_frame
@@ -1,4 +1,7 @@
+import os
+import tempfile
 import unittest
+import cv2
 import pyvision3 as pv3
 import numpy as np
 
@@ -90,6 +93,141 @@ class TestAffine(unittest.TestCase):
         block_2 = self.test_img.data[100:110, 200:210, :]
         self.assertTrue(np.allclose(block_1, block_2))
 
+    def test_affine_chain(self):
+        print("\nTesting lazy affine chain")
+        # a chain with a single translation is the same as AffineTranslate
+        out = self.test_img.affine_chain().translate(200, 100).apply()
+        out2 = pv3.AffineTranslate(200, 100)(self.test_img)
+        self.assertTupleEqual(out.size, self.test_img.size)
+        self.assertTrue(np.allclose(out.data, out2.data))
+
+        # translate then crop should pick out the source pixels at the origin
+        rect = pv3.Rect(200, 100, 50, 40)
+        out = self.test_img.affine_chain().translate(200, 100).crop(rect).apply()
+        self.assertTupleEqual(out.size, (50, 40))
+        self.assertTrue(np.allclose(out.data, self.test_img.data[0:40, 0:50, :]))
+
+        # resize only should match cv2.resize, within rounding
+        half_size = (self.test_w // 2, self.test_h // 2)
+        out = self.test_img.affine_chain().resize(half_size).apply()
+        out2 = self.test_img.resize(half_size)
+        self.assertTupleEqual(out.size, out2.size)
+        diff = np.abs(out.data.astype("int") - out2.data.astype("int"))
+        self.assertLessEqual(diff.max(), 1)
+
+        # output size follows the scaling steps in the chain
+        chain = self.test_img.affine_chain().translate(10, 20).rotate(30).scale(0.5)
+        self.assertTupleEqual(
+            chain.size, (round(self.test_w * 0.5), round(self.test_h * 0.5))
+        )
+        # the image center is the fixed point of a rotation about the center
+        chain = self.test_img.affine_chain().rotate(30)
+        ctr = np.array([self.test_cx, self.test_cy, 1.0])
+        self.assertTrue(np.allclose(np.dot(chain.get_augmented_matrix(), ctr), ctr))
+
+    def test_affine_annotations(self):
+        print("\nTesting affine warp of annotations and geometry")
+        img = self.test_img.copy()
+        img.annotate_rect((10, 10), (40, 40), color=pv3.RGB_RED, thickness=-1)
+        aff = pv3.AffineTranslate(200, 100)
+        out = aff(img)
+
+        # the filled rectangle moved along with the pixels
+        self.assertTupleEqual(tuple(out.annotation_data[125, 225, :]), (0, 0, 255))
+        self.assertTrue(np.allclose(out.data[100:110, 200:210], img.data[0:10, 0:10]))
+
+        # points, rects and polygons are transformed consistently
+        pts = aff.transform_points([(0, 0), (10, 20)])
+        self.assertTrue(np.allclose(pts, [(200, 100), (210, 120)]))
+        orig_pts = aff.transform_points(pts, invert=True)
+        self.assertTrue(np.allclose(orig_pts[1], (10, 20)))
+
+        rects = aff.transform_rects([(0, 0, 10, 20), (5, 5, 1, 1)])
+        self.assertTrue(np.allclose(rects, [(200, 100, 10, 20), (205, 105, 1, 1)]))
+
+        rot = pv3.AffineRotation(90, (100, 100))
+        rect = rot.transform_rects([(10, 20, 30, 40)])[0]
+        self.assertTrue(np.allclose(rect[2:], (40, 30)))
+
+        polys = aff.transform_polygons([pv3.POLY_SLEEPYCAT, [(0, 0), (5, 0), (5, 5)]])
+        self.assertTrue(np.allclose(polys[0].bounds[0:2], (477, 191)))
+        self.assertTrue(np.allclose(polys[1][2], (205, 105)))
+
+    def test_affine_warp_tiled(self):
+        print("\nTesting tiled affine warp")
+        aff = pv3.AffineRotation(
+            theta_degrees=30, image_size=self.test_img.size, dest_size="fit"
+        )
+        out = aff(self.test_img, annotations=False)
+
+        # tiled warp into a memory-mapped output file should match the single warp
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, "warped.dat")
+            out2 = aff.warp_tiled(self.test_img.data, out=fn, tile_size=(200, 150))
+            self.assertTrue(isinstance(out2, np.memmap))
+            self.assertTupleEqual(out2.shape, out.data.shape)
+            diff = np.abs(out.data.astype("int") - out2.astype("int"))
+            self.assertLessEqual(diff.max(), 1)
+            del out2
+
+        # working memory cap determines the tile size
+        out3 = aff.warp_tiled(self.test_img, max_memory=2 ** 20)
+        diff = np.abs(out.data.astype("int") - out3.astype("int"))
+        self.assertLessEqual(diff.max(), 1)
+
+        # the tiles read enough source pixels for the wider lanczos kernel
+        aff = pv3.AffineTransformer(np.array([[2.0, 0, -0.5], [0, 2.0, 0.25]]))
+        out = cv2.warpAffine(
+            self.test_img.data,
+            aff.affine_matrix,
+            self.test_img.size,
+            flags=cv2.INTER_LANCZOS4,
+        )
+        out4 = aff.warp_tiled(
+            self.test_img, interpolation=cv2.INTER_LANCZOS4, tile_size=(64, 48)
+        )
+        self.assertTrue(np.array_equal(out, out4))
+
+    def test_affine_from_points(self):
+        print("\nTesting affine from points")
+        # recover a known transformation from exact correspondences
+        mat = np.array([[0.9, -0.2, 15.0], [0.3, 1.1, -4.0]])
+        src = np.array([[0, 0], [100, 0], [0, 50], [80, 90], [33, 12]], dtype="float")
+        dst = np.dot(src, mat[:, 0:2].T) + mat[:, 2]
+        aff = pv3.AffineFromPoints(src, dst)
+        self.assertTrue(np.allclose(aff.affine_matrix, mat))
+
+        # batched solution for many sets of points
+        rng = np.random.RandomState(0)
+        mats = rng.normal(size=(1000, 2, 3))
+        srcs = rng.uniform(0, 100, size=(1000, 6, 2))
+        lin_t = mats[:, :, 0:2].transpose(0, 2, 1)
+        dsts = np.matmul(srcs, lin_t) + mats[:, np.newaxis, :, 2]
+        self.assertTrue(np.allclose(pv3.affine_from_points_batch(srcs, dsts), mats))
+
+        # a single set of source points is used with every destination set
+        dsts = np.matmul(srcs[0], lin_t) + mats[:, np.newaxis, :, 2]
+        batch = pv3.affine_from_points_batch(srcs[0], dsts)
+        self.assertTrue(np.allclose(batch, mats))
+
+        # a rect mapped onto the destination frame is a crop and resize in one warp
+        rect = pv3.Rect(200, 100, 300, 200)
+        out = pv3.AffineFromRect(rect, (150, 100))(self.test_img)
+        out2 = self.test_img.crop(rect).resize((150, 100))
+        diff = np.abs(out.data.astype("int") - out2.data.astype("int"))
+        self.assertLessEqual(diff.max(), 1)
+
+        # align two translated copies of the template to the canonical frame
+        template = np.array([(10, 10), (50, 10), (30, 40)])
+        point_sets = [template + (200, 100), template + (400, 300)]
+        crops = pv3.align_to_template(self.test_img, point_sets, template, (64, 64))
+        self.assertEqual(len(crops), 2)
+        self.assertTrue(np.all(crops[1].data == self.test_img.data[300:364, 400:464]))
+        images = [self.test_img] * 3
+        self.assertRaises(
+            ValueError, pv3.align_to_template, images, point_sets, template, (64, 64)
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,367 @@
+import itertools
+import math
+import os
+import tempfile
+import unittest
+import cv2
+import numpy as np
+import pyvision3 as pv3
+
+
+class TestBackgroundSubtract(unittest.TestCase):
+    def test_median_model_exact(self):
+        print("\nTesting MedianModel Against np.median")
+        for ib in (pv3.ImageBuffer(N=5), pv3.ImageBuffer(N=6), pv3.MemmapImageBuffer()):
+            N = len(ib)
+            vid = pv3.Video(pv3.VID_PRIUS, size=(160, 120))
+            ib.fill(vid)
+            model = pv3.MedianModel(ib)
+            if isinstance(ib, pv3.MemmapImageBuffer):
+                # select from the memory-mapped stack 500 pixels at a time
+                model._order_stats._max_memory = 3 * N * 500
+            # run well past the point where frames start leaving the window, with
+            # a global change of lighting that moves the median of every pixel
+            for i in range(3 * N):
+                frame = next(vid)
+                if i >= N:
+                    frame = pv3.Image(cv2.add(frame.data, 60))
+                ib.add(frame)
+                stack = ib.as_image_stack_BW()
+                self.assertTrue(
+                    np.array_equal(model._get_median_vals(), np.median(stack, axis=0))
+                )
+            q = model.get_quantile(0.25)
+            self.assertTrue(np.allclose(q, np.quantile(stack, 0.25, axis=0)))
+
+    def test_approx_median_update(self):
+        print("\nTesting ApproximateMedianModel Update")
+        vid = pv3.Video(pv3.VID_PRIUS, size=(160, 120))
+        ib = pv3.ImageBuffer(N=6)
+        ib.fill(vid)
+        model = pv3.ApproximateMedianModel(ib, step=4)
+        expected = model._get_median_vals().astype("int32")
+        stack = ib.as_image_stack_BW()
+        self.assertTrue(np.array_equal(expected, np.rint(np.median(stack, axis=0))))
+        for _ in range(10):
+            ib.add(next(vid))
+            model.foreground_mask()
+            # move toward the new frame by at most step, without overshooting
+            cur = ib.get_gray(-1).astype("int32")
+            expected = np.clip(cur, expected - 4, expected + 4)
+        medians = model._get_median_vals()
+        self.assertEqual(medians.dtype, np.uint8)
+        self.assertTrue(np.array_equal(medians, expected))
+        self.assertTrue(np.array_equal(model.get_quantile(0.5), expected))
+        with self.assertRaises(ValueError):
+            model.get_quantile(0.25)
+
+    def _frames(self, values, shape=(4, 6)):
+        # gray frames, each with a constant left half and a constant right half
+        frames = []
+        for (left, right) in values:
+            mat = np.empty(shape, dtype="uint8")
+            mat[:, : shape[1] // 2] = left
+            mat[:, shape[1] // 2 :] = right
+            frames.append(pv3.Image(mat))
+        return frames
+
+    def _mask(self, left, right, shape=(4, 6)):
+        expected = np.empty(shape, dtype="uint8")
+        expected[:, : shape[1] // 2] = left
+        expected[:, shape[1] // 2 :] = right
+        return expected
+
+    def test_static_model_diff(self):
+        print("\nTesting StaticModel Absolute Difference")
+        (bg, cur) = self._frames([(200, 200), (10, 190)])
+        ib = pv3.ImageBuffer(N=1)
+        ib.add(cur)
+        model = pv3.StaticModel(ib, bg_image=bg, thresh=80)
+        # 10 - 200 must not wrap around to 66, which is below the threshold
+        mask = model.foreground_mask().as_grayscale(as_type="CV")
+        self.assertTrue(np.array_equal(mask, self._mask(255, 0)))
+
+        # a float background, such as np.median over frames, is rounded, so the
+        # right half differs by 190 - 110 = 80, which is not above the threshold
+        bg = np.empty((4, 6), dtype="float64")
+        (bg[:, 0:3], bg[:, 3:6]) = (130.4, 109.6)
+        model = pv3.StaticModel(ib, bg_image=pv3.Image(bg), thresh=80)
+        mask = model.foreground_mask().as_grayscale(as_type="CV")
+        self.assertTrue(np.array_equal(mask, self._mask(255, 0)))
+
+    def test_frame_difference_model_diff(self):
+        print("\nTesting FrameDifferenceModel Absolute Difference")
+        ib = pv3.ImageBuffer(N=3)
+        for img in self._frames([(200, 100), (10, 120), (200, 220)]):
+            ib.add(img)
+        model = pv3.FrameDifferenceModel(ib, thresh=80)
+        mask = model.foreground_mask().as_grayscale(as_type="CV")
+        self.assertTrue(np.array_equal(mask, self._mask(255, 0)))
+
+    def test_median_model_diff(self):
+        print("\nTesting MedianModel Absolute Difference")
+        ib = pv3.ImageBuffer(N=3)
+        for img in self._frames([(100, 100), (100, 100), (10, 150)]):
+            ib.add(img)
+        for model in (pv3.MedianModel(ib), pv3.ApproximateMedianModel(ib)):
+            mask = model.foreground_mask().as_grayscale(as_type="CV")
+            self.assertTrue(np.array_equal(mask, self._mask(255, 0)))
+
+    def test_soft_threshold(self):
+        print("\nTesting Soft Threshold Lookup Table")
+        bg = pv3.Image(np.zeros((16, 16), dtype="uint8"))
+        cur = pv3.Image(np.arange(256, dtype="uint8").reshape(16, 16))
+        ib = pv3.ImageBuffer(N=1)
+        ib.add(cur)
+        model = pv3.StaticModel(ib, bg_image=bg, thresh=40, soft_thresh=True)
+        mask = model.foreground_mask(as_type="CV")
+        diff = cur.data * 1.0
+        expected = ((1 - math.e ** (-diff / 40)) * 255).astype("uint8")
+        self.assertTrue(np.array_equal(mask, expected))
+        self.assertFalse(model.foreground_mask().has_annotation_layer())
+
+    def test_running_gaussian_model(self):
+        print("\nTesting RunningGaussianModel")
+        rng = np.random.RandomState(0)
+        frames = [rng.randint(90, 111, size=(8, 8)).astype("uint8") for _ in range(20)]
+        ib = pv3.ImageBuffer(N=1)
+        model = pv3.RunningGaussianModel(ib, alpha=None, z_thresh=3.0, min_std=1.0)
+        for mat in frames:
+            ib.add(pv3.Image(mat))
+            model.foreground_mask()
+
+        # with alpha=None, the model holds the mean and variance of all frames
+        stack = np.array(frames, dtype="float64")
+        self.assertTrue(np.allclose(model.get_mean(), stack.mean(axis=0), atol=1e-3))
+        self.assertTrue(np.allclose(model.get_var(), stack.var(axis=0), atol=1e-2))
+
+        # a bright object is foreground, the rest of the frame is not
+        mat = frames[0].copy()
+        mat[2:5, 2:5] = 250
+        ib.add(pv3.Image(mat))
+        mask = model.foreground_mask(as_type="CV")
+        expected = np.zeros((8, 8), dtype="uint8")
+        expected[2:5, 2:5] = 255
+        self.assertTrue(np.array_equal(mask, expected))
+
+    def test_sample_model(self):
+        print("\nTesting SampleModel")
+        # a flickering background, where each pixel alternates between two values,
+        # such as water, which a single mean or median can't model
+        rng = np.random.RandomState(0)
+        base = rng.randint(0, 2, size=(32, 32)) * 60 + 100
+        flicker = [base.astype("uint8"), (260 - base).astype("uint8")]
+        ib = pv3.ImageBuffer(N=4)
+        for i in range(4):
+            ib.add(pv3.Image(flicker[i % 2]))
+        model = pv3.SampleModel(ib, seed=0)
+        for i in range(20):
+            ib.add(pv3.Image(flicker[i % 2]))
+            mask = model.foreground_mask(as_type="CV")
+            self.assertEqual(np.count_nonzero(mask), 0)
+
+        # an object appears
+        mat = flicker[0].copy()
+        mat[10:20, 10:20] = 10
+        ib.add(pv3.Image(mat))
+        mask = model.foreground_mask(as_type="CV")
+        expected = np.zeros((32, 32), dtype="uint8")
+        expected[10:20, 10:20] = 255
+        self.assertTrue(np.array_equal(mask, expected))
+
+    def test_opencv_models(self):
+        print("\nTesting MOG2Model and KNNModel")
+        rng = np.random.RandomState(0)
+        bg = pv3.Image(pv3.IMG_DRIVEWAY).resize((160, 120), as_type="CV")
+        for factory in (pv3.MOG2Model, pv3.KNNModel):
+            ib = pv3.ImageBuffer(N=1)
+            model = factory(ib)
+            self.assertIsNone(model.background_image())
+            for _ in range(30):
+                noise = rng.randint(-2, 3, size=bg.shape)
+                frame = np.clip(bg + noise, 0, 255).astype("uint8")
+                ib.add(pv3.Image(frame))
+                mask = model.foreground_mask(as_type="CV")
+            self.assertLess(np.count_nonzero(mask), 10)
+            # the frames are used as is, without a gray stack
+            self.assertIsNone(ib._gray)
+
+            frame[40:80, 60:100] = 255 - frame[40:80, 60:100]
+            ib.add(pv3.Image(frame))
+            mask = model.foreground_mask(as_type="CV")
+            self.assertGreater(np.count_nonzero(mask[40:80, 60:100]), 1200)
+            self.assertTupleEqual(model.background_image().size, (160, 120))
+
+    def test_region_of_interest(self):
+        print("\nTesting Background Models With a Region of Interest")
+        bg = np.full((60, 80), 50, dtype="uint8")
+        frame = np.full((60, 80), 200, dtype="uint8")
+        roi = [pv3.Rect(10, 20, 40, 30)]
+        exclude = [[(30, 0), (80, 0), (80, 60), (30, 60)], pv3.Rect(15, 25, 5, 5)]
+        bounds = pv3.video_proc.backgroundsubtract.roi_bounds(roi, exclude)
+        # the exclusion shrinks the bounding box
+        self.assertTupleEqual(bounds, (10, 20, 20, 30))
+
+        ib = pv3.ImageBuffer(N=1)
+        model = pv3.StaticModel(ib, bg_image=pv3.Image(bg), roi=roi, exclude=exclude)
+        ib.add(pv3.Image(frame))
+        mask = model.foreground_mask(as_type="CV")
+        # only the bounding box of the region of interest is processed
+        self.assertTupleEqual(model.get_roi_rect(), bounds)
+        self.assertTupleEqual(ib.get_gray(-1).shape, (30, 20))
+        expected = np.full((30, 20), 255, dtype="uint8")
+        expected[5:10, 5:10] = 0
+        self.assertTrue(np.array_equal(mask, expected))
+
+    def test_shared_buffer_geometry(self):
+        print("\nTesting Background Models Sharing an Image Buffer")
+        vid = pv3.Video(pv3.VID_PRIUS, size=(160, 120))
+        ib = pv3.ImageBuffer(N=5)
+        ib.fill(vid)
+        median = pv3.MedianModel(ib, processing_scale=0.5)
+        # models of the same geometry share the gray stack, others can't change it
+        pv3.FrameDifferenceModel(ib, processing_scale=0.5)
+        with self.assertRaises(ValueError):
+            pv3.FrameDifferenceModel(ib)
+        with self.assertRaises(ValueError):
+            roi = [pv3.Rect(0, 0, 80, 60)]
+            pv3.StaticModel(ib, bg_image=ib.last(), processing_scale=0.5, roi=roi)
+        ib.add(next(vid))
+        self.assertTupleEqual(median.foreground_mask(as_type="CV").shape, (60, 80))
+
+    def test_save_load_state(self):
+        print("\nTesting Background Model Checkpoints")
+        models = [
+            (pv3.MedianModel, 5, {}),
+            (pv3.ApproximateMedianModel, 5, {"processing_scale": 0.5}),
+            (pv3.RunningGaussianModel, 1, {"roi": [pv3.Rect(20, 10, 100, 80)]}),
+            (pv3.SampleModel, 5, {"seed": 0}),
+        ]
+        vid = pv3.Video(pv3.VID_PRIUS, size=(160, 120))
+        frames = [next(vid) for _ in range(20)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "state.npz")
+            for (factory, N, kwargs) in models:
+                ib = pv3.ImageBuffer(N=N)
+                ib.fill(frames)
+                model = factory(ib, **kwargs)
+                for frame in frames[N:12]:
+                    ib.add(frame)
+                    model.foreground_mask()
+                model.save_state(filename)
+
+                # a new model, whose buffer starts with other frames
+                ib2 = pv3.ImageBuffer(N=N)
+                ib2.fill(frames[::-1])
+                model2 = factory(ib2, **kwargs)
+                model2.load_state(filename)
+                self.assertEqual(ib2.get_sequence_number(), ib.get_sequence_number())
+                for frame in frames[12:]:
+                    ib.add(frame)
+                    ib2.add(frame)
+                    mask = model.foreground_mask(as_type="CV")
+                    mask2 = model2.foreground_mask(as_type="CV")
+                    self.assertTrue(np.array_equal(mask, mask2), factory.__name__)
+
+            # the state of one model can't be loaded into another
+            model = pv3.FrameDifferenceModel(ib)
+            with self.assertRaises(ValueError):
+                model.load_state(filename)
+
+    def test_bg_subtract_video(self):
+        print("\nTesting bg_subtract_video Against the Background Models")
+        bg_image = pv3.Video(pv3.VID_PRIUS, size=(160, 120)).next()
+        roi = {
+            "roi": [[(40, 0), (120, 0), (120, 60), (70, 60)]],
+            "exclude": [[(81, 0), (100, 0), (100, 20), (81, 20)]],
+        }
+        cases = [
+            (pv3.BG_SUBTRACT_MEDIAN, 5, {"thresh": 20}),
+            (pv3.BG_SUBTRACT_MEDIAN, 4, {"soft_thresh": True, "thresh": 20}),
+            (pv3.BG_SUBTRACT_FRAME_DIFF, 5, {"thresh": 4}),
+            (pv3.BG_SUBTRACT_MCFD, 5, {"thresh": 4}),
+            (pv3.BG_SUBTRACT_STATIC, 1, {"bg_image": bg_image}),
+            (pv3.BG_SUBTRACT_RUNNING_GAUSSIAN, 1, {"processing_scale": 0.5}),
+            (pv3.BG_SUBTRACT_MEDIAN, 5, dict(roi, thresh=20, processing_scale=0.5)),
+            (pv3.BG_SUBTRACT_FRAME_DIFF, 3, dict(roi, thresh=4)),
+            (pv3.BG_SUBTRACT_STATIC, 1, dict(roi, bg_image=bg_image)),
+            (pv3.BG_SUBTRACT_RUNNING_GAUSSIAN, 1, dict(roi)),
+        ]
+        for (method, N, kwargs) in cases:
+            # the masks of a model, fed frame by frame through an image buffer
+            vid = pv3.Video(pv3.VID_PRIUS, size=(160, 120))
+            ib = pv3.ImageBuffer(N=N)
+            model = None
+            expected = []
+            for _ in range(30):
+                ib.add(next(vid))
+                if ib.is_full():
+                    if model is None:
+                        model_class = pv3.video_proc.backgroundsubtract._MODEL_CLASSES
+                        model = model_class[method](ib, **kwargs)
+                    mask = model.foreground_mask(as_type="CV")
+                    expected.append((vid.current_frame_num, mask.copy()))
+
+            # a chunk size that doesn't divide the number of frames
+            vid = pv3.Video(pv3.VID_PRIUS, size=(160, 120))
+            results = pv3.bg_subtract_video(
+                vid, method, chunk=7, buff_size=N, **kwargs
+            )
+            masks = [(n, m.copy()) for (n, m) in itertools.islice(results, 30)]
+            masks = masks[0 : len(expected)]
+            if method in (pv3.BG_SUBTRACT_FRAME_DIFF, pv3.BG_SUBTRACT_MCFD):
+                # the key frame is the middle frame of the buffer
+                expected = [(n - N // 2, m) for (n, m) in expected]
+            for ((n, mask), (n2, mask2)) in zip(masks, expected):
+                self.assertEqual(n, n2)
+                self.assertTrue(np.array_equal(mask, mask2), method)
+            self.assertGreater(sum(np.count_nonzero(m) for (_, m) in masks), 0, method)
+
+        # the vectorized methods don't silently ignore the options of the models
+        vid = pv3.Video(pv3.VID_PRIUS, size=(160, 120))
+        with self.assertRaises(ValueError):
+            next(pv3.bg_subtract_video(vid, pv3.BG_SUBTRACT_MEDIAN, rate=0.5))
+
+    def test_motion_compensated_frame_difference(self):
+        print("\nTesting MotionCompensatedFrameDifferenceModel on a Panning Camera")
+        # the camera pans by (3, 1) pixels per frame over a still scene, while a
+        # square object moves left by 12 pixels per frame
+        scene = pv3.Image(pv3.IMG_DRIVEWAY).resize((400, 300), as_type="CV")
+        frames = []
+        for i in range(12):
+            frame = scene[10 + i : 250 + i, 10 + 3 * i : 330 + 3 * i].copy()
+            x = 250 - 12 * i
+            frame[100:130, x : x + 30] = 255 - frame[100:130, x : x + 30]
+            frames.append(pv3.Image(frame))
+
+        masks = {}
+        for model_class in (
+            pv3.FrameDifferenceModel,
+            pv3.MotionCompensatedFrameDifferenceModel,
+        ):
+            ib = pv3.ImageBuffer(N=5)
+            for img in frames:
+                ib.add(img)
+            model = model_class(ib, thresh=30)
+            masks[model_class] = model.foreground_mask(as_type="CV")
+
+        transforms = model.get_transforms()
+        self.assertEqual(len(transforms), 4)
+        for transform in transforms:
+            self.assertEqual(transform.shape, (2, 3))
+            self.assertTrue(np.allclose(transform[:, 2], (-3, -1), atol=0.2))
+        vectors = model.get_motion_vectors()
+        self.assertEqual(vectors.shape[1:], (2, 2))
+        self.assertGreater(len(vectors), 20)
+
+        # the pan is cancelled out, but the square in the middle frame is not
+        fd_mask = masks[pv3.FrameDifferenceModel]
+        mcfd_mask = masks[pv3.MotionCompensatedFrameDifferenceModel]
+        square = np.count_nonzero(mcfd_mask[100:130, 142:172])
+        outside = np.count_nonzero(mcfd_mask) - square
+        self.assertLess(50 * outside, np.count_nonzero(fd_mask))
+        self.assertGreater(square, 150)
+
+
+if __name__ == "__main__":
+    unittest.main()
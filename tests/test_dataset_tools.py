@@ -4,7 +4,10 @@ author: Stephen O'Hara
 created: April 14, 2016
 """
 
+import os
+import tempfile
 import unittest
+import numpy as np
 import pyvision3 as pv3
 import shapely.geometry as sg
 
@@ -31,6 +34,36 @@ class TestDatasetTools(unittest.TestCase):
         self.assertTrue(len(crops2) == 2)
         self.assertTupleEqual(crops2[0].size, (300, 300))
 
+    def test_augment_crops(self):
+        print("\nTest 'augment_crops' function")
+        img = pv3.Image(pv3.IMG_SLEEPYCAT)
+        shapes_list = [pv3.Rect(100, 100, 80, 60), pv3.Rect(300, 200, 40, 50)]
+        crops = pv3.crop_regions(img, shapes_list) + [None]
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            writer = pv3.image_dir_writer(out_dir)
+            results = list(pv3.augment_crops(crops, K=3, seed=42, writer=writer))
+            self.assertEqual(len(os.listdir(out_dir)), 6)
+
+        # results stream back in order, and each variant has its crop's size
+        self.assertListEqual(
+            [(c, k) for (c, k, _) in results],
+            [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)],
+        )
+        self.assertTupleEqual(results[4][2].size, crops[1].size)
+
+        # the same seed yields the same augmentations
+        results2 = list(pv3.augment_crops(crops, K=3, seed=42, n_threads=2))
+        for (_, _, im1), (_, _, im2) in zip(results, results2):
+            self.assertTrue(np.all(im1.data == im2.data))
+
+        # with all of the randomness turned off, the variants equal the crops
+        identity = pv3.augment_crops(
+            crops, K=2, max_rotation=0, scale_range=(1, 1), max_shift=0, flip=False
+        )
+        for crop_idx, _, im in identity:
+            self.assertTrue(np.all(im.data == crops[crop_idx].data))
+
 
 if __name__ == "__main__":
     unittest.main()
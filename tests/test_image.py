@@ -59,6 +59,17 @@ class TestImage(unittest.TestCase):
         self.assertTupleEqual(tuple(img.annotation_data[256, 256, :]), (255, 0, 0))
         self.assertTupleEqual(tuple(img.annotation_data[281, 281, :]), (0, 255, 255))
 
+    def test_annotation_layer(self):
+        print("\nTest Image annotation layer is allocated on first use")
+        img = pv3.Image(pv3.IMG_DRIVEWAY)
+        self.assertFalse(img.has_annotation_layer())
+        self.assertTrue(np.all(img.as_annotated(as_type="CV") == img.data))
+
+        img.annotate_point((10, 10), color=pv3.RGB_RED)
+        self.assertTrue(img.has_annotation_layer())
+        self.assertTupleEqual(tuple(img.annotation_data[10, 10, :]), (0, 0, 255))
+        self.assertTrue(img.copy().has_annotation_layer())
+
 
 if __name__ == "__main__":
     unittest.main()
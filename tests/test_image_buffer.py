@@ -1,4 +1,9 @@
+import os
+import tempfile
+import threading
 import unittest
+from unittest import mock
+import numpy as np
 import pyvision3 as pv3
 
 
@@ -39,6 +44,236 @@ class TestImageBuffer(unittest.TestCase):
         # im_img = im.as_image()
         # im_img.save("test.jpg")
 
+    def test_array_buffer(self):
+        print("\nTesting ArrayImageBuffer ring buffer")
+        ib = pv3.ArrayImageBuffer(N=5)
+        frames = [pv3.Image(np.full((24, 32), i, dtype="uint8")) for i in range(8)]
+        for frame in frames[0:3]:
+            ib.add(frame)
+        self.assertFalse(ib.is_full())
+        self.assertIsNone(ib.first())
+        self.assertListEqual(list(ib.as_image_stack_BW()[:, 0, 0]), [0, 1, 2])
+
+        for frame in frames[3:]:
+            ib.add(frame)
+        self.assertTrue(ib.is_full())
+        self.assertEqual(ib.first()[0, 0], 3)
+        self.assertEqual(ib.middle()[0, 0], 5)
+        self.assertEqual(ib.last()[0, 0], 7)
+        self.assertEqual(ib[-2][0, 0], 6)
+
+        # items are views into the ring array, not copies
+        self.assertTrue(np.shares_memory(ib.last().data, ib[4].data))
+        self.assertFalse(ib.last().has_annotation_layer())
+
+        # the stack is in buffer order, a view once the ring is back at its start
+        stack = ib.as_image_stack_BW()
+        self.assertListEqual(list(stack[:, 0, 0]), [3, 4, 5, 6, 7])
+        ib.add(frames[0])
+        ib.add(frames[1])
+        stack = ib.as_image_stack_BW()
+        self.assertListEqual(list(stack[:, 0, 0]), [5, 6, 7, 0, 1])
+        self.assertTrue(np.shares_memory(stack, ib.last().data))
+
+        # frames of a different shape are rejected
+        self.assertRaises(ValueError, ib.add, pv3.Image(np.zeros((10, 10), "uint8")))
+
+        # clearing empties the slots, and the stack only shows new frames
+        ib.clear()
+        self.assertEqual(ib.get_count(), 0)
+        self.assertIsNone(ib.last())
+        ib.add(frames[2])
+        self.assertListEqual(list(ib.as_image_stack_BW()[:, 0, 0]), [2])
+
+    def test_buffer_gray_stack(self):
+        print("\nTesting Image Buffer incremental gray stack")
+        vid = pv3.Video(pv3.VID_PRIUS, size=(320, 240))
+        ib = pv3.ImageBuffer(N=10)
+        for _ in range(4):
+            ib.add(vid.next())
+        ib.keep_gray_stack(size=(160, 120))  # converts frames already in buffer
+        for _ in range(13):
+            ib.add(vid.next())
+
+        # the gray stack matches converting the frames in buffer order
+        stack = ib.as_image_stack_BW()
+        self.assertTupleEqual(stack.shape, (10, 120, 160))
+        expected = ib.last().as_grayscale().resize((160, 120), as_type="CV")
+        self.assertLessEqual(np.abs(stack[-1].astype("int") - expected).max(), 1)
+        self.assertTrue(np.all(ib.get_gray(-1) == stack[-1]))
+        self.assertTrue(np.all(ib.get_gray(0) == stack[0]))
+
+        # unordered access is a view of the same storage, with the same frames
+        raw = ib.as_image_stack_BW(ordered=False)
+        self.assertTrue(np.shares_memory(raw, ib.as_image_stack_BW(ordered=False)))
+        self.assertTrue(np.all(np.sort(raw, axis=0) == np.sort(stack, axis=0)))
+
+        # a stack kept from an empty buffer converts the frames added later
+        ib = pv3.ImageBuffer(N=3)
+        ib.keep_gray_stack()
+        ib.fill([vid.next() for _ in range(3)])
+        raw = ib.as_image_stack_BW(ordered=False)
+        self.assertTupleEqual(raw.shape, (3, 240, 320))
+        self.assertTrue(np.shares_memory(raw, ib.as_image_stack_BW(ordered=False)))
+
+    def test_memmap_buffer(self):
+        print("\nTesting MemmapImageBuffer")
+        vid = pv3.Video(pv3.VID_PRIUS, size=(320, 240))
+        frames = [vid.next() for _ in range(25)]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, "ring.dat")
+            ib = pv3.MemmapImageBuffer(N=20, filename=fn, hot_frames=3)
+            ib.keep_gray_stack()
+            ib.fill(frames)
+            self.assertEqual(os.path.getsize(fn), 20 * 240 * 320 * 3)
+            self.assertTrue(os.path.exists(fn + ".gray"))
+
+            # newest frames come from the in-memory hot tail, older ones from disk
+            self.assertNotIsInstance(ib.last().data, np.memmap)
+            self.assertTrue(np.all(ib.last().data == frames[19].data))
+            self.assertFalse(np.shares_memory(ib.last().data, frames[19].data))
+            self.assertIsInstance(ib.first().data, np.memmap)
+            self.assertTrue(np.all(ib.first().data == frames[0].data))
+
+            for frame in frames[20:]:
+                ib.add(frame)
+            self.assertTrue(np.all(ib.middle().data == frames[15].data))
+            # the ring has wrapped, so the ordered stack is a copy, made on disk
+            stack = ib.as_image_stack_BW()
+            self.assertIsInstance(stack, np.memmap)
+            self.assertTupleEqual(stack.shape, (20, 240, 320))
+            expected = frames[5].as_grayscale(as_type="CV")
+            self.assertTrue(np.all(stack[0] == expected))
+            del ib, stack
+
+        # a hot tail as long as the buffer, so slots are hot again when reused
+        ib = pv3.MemmapImageBuffer(N=2)
+        for frame in frames[0:5]:
+            ib.add(frame)
+            self.assertNotIsInstance(ib.last().data, np.memmap)
+            self.assertTrue(np.all(ib.last().data == frame.data))
+        self.assertNotIsInstance(ib.first().data, np.memmap)
+        self.assertTrue(np.all(ib.first().data == frames[3].data))
+
+    def test_compressed_buffer(self):
+        print("\nTesting CompressedImageBuffer")
+        vid = pv3.Video(pv3.VID_PRIUS, size=(320, 240))
+        frames = [vid.next() for _ in range(12)]
+        raw_nbytes = 10 * frames[0].data.nbytes
+
+        # png is lossless
+        ib = pv3.CompressedImageBuffer(N=10, encoding=".png")
+        ib.fill(frames)
+        self.assertTrue(np.all(ib.first().data == frames[0].data))
+        self.assertIs(ib.last(), ib.last())  # decoded once, then cached
+        self.assertLess(ib.get_nbytes(), raw_nbytes)
+
+        # jpeg is lossy, but close
+        ib = pv3.CompressedImageBuffer(N=10, encoding=".jpg", quality=90)
+        for frame in frames:
+            ib.add(frame)
+        diff = np.abs(ib.last().data.astype("int") - frames[-1].data)
+        self.assertLess(diff.mean(), 3.0)
+        self.assertLess(ib.get_nbytes(), raw_nbytes / 4)
+
+        # downsampled grayscale
+        ib = pv3.CompressedImageBuffer(N=10, encoding="gray", size=(160, 120))
+        ib.fill(frames)
+        self.assertTupleEqual(ib.middle().data.shape, (120, 160))
+        self.assertTupleEqual(ib.as_image_stack_BW().shape, (10, 120, 160))
+        self.assertEqual(ib.get_nbytes(), 10 * 160 * 120)
+
+    def test_buffer_stats(self):
+        print("\nTesting Image Buffer sliding-window statistics")
+        rng = np.random.RandomState(0)
+        frames = [pv3.Image(rng.randint(0, 256, (30, 40), "uint8")) for _ in range(25)]
+        ib = pv3.ImageBuffer(N=7)
+        with self.assertRaisesRegex(ValueError, "track_stats"):
+            ib.mean()
+        ib.add(frames[0])
+        ib.track_stats()
+        for frame in frames[1:]:
+            ib.add(frame)
+            stack = ib.as_image_stack_BW().astype("float64")
+            self.assertTrue(np.allclose(ib.mean(), stack.mean(axis=0), atol=1e-4))
+            self.assertTrue(np.allclose(ib.var(), stack.var(axis=0), atol=1e-2))
+            self.assertTrue(np.all(ib.range() == np.ptp(stack, axis=0)))
+        ib.clear()
+        with self.assertRaisesRegex(ValueError, "empty"):
+            ib.var()
+
+    def test_thread_safe_buffer(self):
+        print("\nTesting ThreadSafeImageBuffer")
+        ib = pv3.ThreadSafeImageBuffer(N=9)
+        ib.keep_gray_stack()
+        frames = [pv3.Image(np.full((8, 8), i, dtype="uint8")) for i in range(200)]
+
+        def writer():
+            for frame in frames:
+                ib.add(frame)
+
+        # nothing new arrives without a writer
+        self.assertIsNone(ib.wait_for_new(timeout=0.01))
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        seq = 0
+        while seq < len(frames):
+            new_seq = ib.wait_for_new(seq, timeout=5.0)
+            self.assertIsNotNone(new_seq)
+            self.assertGreater(new_seq, seq)
+            seq = new_seq
+            (snap_seq, first, middle, last) = ib.snapshot()
+            # the frames in a snapshot are consistent with its sequence number
+            self.assertEqual(last[0, 0], snap_seq - 1)
+            if snap_seq >= 9:
+                self.assertEqual(first[0, 0], snap_seq - 9)
+                self.assertEqual(middle[0, 0], snap_seq - 5)
+        thread.join()
+
+        self.assertEqual(ib.get_sequence_number(), 200)
+        stack = ib.as_image_stack_BW()
+        self.assertListEqual(list(stack[:, 0, 0]), list(range(191, 200)))
+
+        # a tensor is built without holding the lock, so the writer isn't blocked
+        images_to_tensor = pv3.images_to_tensor
+
+        def add_while_building(images, size, **kwargs):
+            thread = threading.Thread(target=ib.add, args=(frames[0],))
+            thread.start()
+            thread.join(timeout=5.0)
+            self.assertFalse(thread.is_alive())
+            return images_to_tensor(images, size, **kwargs)
+
+        with mock.patch("pyvision3.images_to_tensor", add_while_building):
+            X = ib.as_tensor()
+        self.assertEqual(ib.get_sequence_number(), 201)
+        self.assertTrue(np.allclose(X[:, 0, 0, 0] * 255, np.arange(191, 200)))
+
+    def test_as_tensor(self):
+        print("\nTesting Image Buffer 'as_tensor' Method")
+        vid = pv3.Video(pv3.VID_PRIUS, size=(320, 240))
+        ib = pv3.ImageBuffer(N=4)
+        ib.fill(vid)
+
+        mean = (0.485, 0.456, 0.406)
+        std = (0.229, 0.224, 0.225)
+        X = ib.as_tensor(size=(64, 48), mean=mean, std=std)
+        self.assertTupleEqual(X.shape, (4, 3, 48, 64))
+        self.assertEqual(X.dtype, np.float32)
+
+        # compare against the straightforward, unfused computation
+        rgb = ib[0].resize((64, 48), as_type="CV")[:, :, ::-1] / 255.0
+        expected = ((rgb - mean) / std).transpose(2, 0, 1)
+        self.assertTrue(np.allclose(X[0], expected, atol=1e-5))
+
+        # reuse the output array, with the NHWC layout
+        out = np.empty((4, 48, 64, 3), dtype="float32")
+        Y = ib.as_tensor(size=(64, 48), layout="NHWC", mean=mean, std=std, out=out)
+        self.assertIs(Y, out)
+        self.assertTrue(np.allclose(Y.transpose(0, 3, 1, 2), X))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,224 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pyvision3 as pv3
+
+
+class TestMotionDetection(unittest.TestCase):
+    def test_running_gaussian_detection(self):
+        print("\nTesting MotionDetector With Running Gaussian Model")
+        bg = pv3.Image(pv3.IMG_DRIVEWAY).resize((320, 240), as_type="CV")
+        rng = np.random.RandomState(0)
+        md = pv3.MotionDetector(method=pv3.BG_SUBTRACT_RUNNING_GAUSSIAN, min_area=50)
+
+        # a single frame buffer is enough, so there is a result from the first frame
+        self.assertEqual(len(md._image_buffer), 1)
+        for _ in range(30):
+            noise = rng.randint(-3, 4, size=bg.shape)
+            frame = np.clip(bg + noise, 0, 255).astype("uint8")
+            self.assertGreaterEqual(md.detect(pv3.Image(frame)), 0)
+        self.assertEqual(len(md.get_rects()), 0)
+
+        # an object appears in front of the background
+        frame[100:140, 200:240] = 255 - frame[100:140, 200:240]
+        md.detect(pv3.Image(frame))
+        rects = md.get_rects()
+        self.assertEqual(len(rects), 1)
+        self.assertTrue(rects[0].contains(pv3.Point(220, 120)))
+
+    def test_processing_scale(self):
+        print("\nTesting MotionDetector 'processing_scale' Parameter")
+        bg = pv3.Image(pv3.IMG_DRIVEWAY).resize((320, 240), as_type="CV")
+        frame = bg.copy()
+        frame[100:140, 200:240] = 255 - frame[100:140, 200:240]
+
+        rects = {}
+        for scale in (1.0, 0.5):
+            md = pv3.MotionDetector(
+                method=pv3.BG_SUBTRACT_STATIC,
+                bg_image=pv3.Image(bg),
+                min_area=50,
+                processing_scale=scale,
+                buff_size=1,
+            )
+            md.detect(pv3.Image(frame))
+            rects[scale] = md.get_rects()
+            # outputs are at full resolution
+            self.assertTupleEqual(md.foreground_mask().size, (320, 240))
+            self.assertTupleEqual(md.foreground_pixels().size, (320, 240))
+
+        self.assertEqual(len(rects[0.5]), 1)
+        full = np.array(rects[1.0][0].bounds)
+        half = np.array(rects[0.5][0].bounds)
+        self.assertLessEqual(np.abs(full - half).max(), 3)
+
+    def test_change_gating(self):
+        print("\nTesting MotionDetector Block-Level Change Gating")
+        bg = pv3.Image(pv3.IMG_DRIVEWAY).resize((320, 240), as_type="CV")
+        frames = []
+        for i in range(12):
+            frame = bg.copy()
+            x = 40 + 15 * i
+            frame[100:140, x : x + 40] = 255 - frame[100:140, x : x + 40]
+            frames.append(frame)
+        # a slight flicker of the scene, without motion
+        for i in range(8):
+            frames.append(np.clip(bg.astype("int16") + i % 2, 0, 255).astype("uint8"))
+
+        results = {}
+        masks = {}
+        for gate in (None, 16):
+            md = pv3.MotionDetector(
+                method=pv3.BG_SUBTRACT_FRAME_DIFF, min_area=50, gate_block_size=gate
+            )
+            results[gate] = []
+            masks[gate] = []
+            for (i, frame) in enumerate(frames):
+                md.detect(pv3.Image(frame), convex_hulls=True)
+                results[gate].append([r.bounds for r in md.get_rects()])
+                if md.foreground_mask() is not None:
+                    masks[gate].append(md.foreground_mask().data)
+                if gate is not None and i in (6, 11):
+                    # a stalled feed repeats frames, which are skipped
+                    for _ in range(2):
+                        md.detect(pv3.Image(frame.copy()))
+            stats = md.gating_stats()
+
+        self.assertEqual(stats["frames"], len(frames) + 4)
+        self.assertEqual(stats["frozen"], 4)
+        self.assertGreater(stats["gated"], 0)
+        self.assertGreater(stats["static"], 0)
+        self.assertLess(stats["active_fraction"], 1)
+
+        # skipping frozen frames and static regions doesn't change the detections
+        self.assertGreater(sum(len(r) for r in results[16]), 0)
+        self.assertListEqual(results[16], results[None])
+        for (mask, mask2) in zip(masks[16], masks[None]):
+            self.assertTrue(np.array_equal(mask, mask2))
+
+        # frames that differ only by a little sensor noise aren't duplicates
+        rng = np.random.RandomState(0)
+        md = pv3.MotionDetector(method=pv3.BG_SUBTRACT_MEDIAN, gate_block_size=16)
+        for _ in range(10):
+            noise = rng.randint(-1, 2, size=bg.shape)
+            count = md.detect(pv3.Image(np.clip(bg + noise, 0, 255).astype("uint8")))
+        self.assertEqual(md.gating_stats()["frozen"], 0)
+        self.assertEqual(count, 0)  # the buffer is full
+
+    def test_change_gating_stateful_model(self):
+        print("\nTesting MotionDetector Change Gating with a Stateful Model")
+        bg = pv3.Image(pv3.IMG_DRIVEWAY).resize((320, 240), as_type="CV")
+        counts = {}
+        for gate in (None, 16):
+            rng = np.random.RandomState(0)
+            md = pv3.MotionDetector(
+                method=pv3.BG_SUBTRACT_RUNNING_GAUSSIAN,
+                min_area=50,
+                gate_block_size=gate,
+            )
+            counts[gate] = []
+            for i in range(60):
+                # an object that stops moving at frame 20, in a slightly noisy scene
+                frame = bg + rng.normal(0, 1.5, bg.shape)
+                x = 40 + 10 * min(i, 20)
+                frame[100:140, x : x + 40] = 255 - frame[100:140, x : x + 40]
+                frame = np.clip(frame, 0, 255).astype("uint8")
+                counts[gate].append(md.detect(pv3.Image(frame)))
+
+        # the model learns the stopped object as background, even though the
+        # blocks stopped changing
+        self.assertGreater(counts[16][15], 0)
+        self.assertEqual(counts[16][-1], 0)
+        self.assertListEqual(counts[16], counts[None])
+
+    def test_region_of_interest(self):
+        print("\nTesting MotionDetector With a Region of Interest")
+        bg = pv3.Image(pv3.IMG_DRIVEWAY).resize((320, 240), as_type="CV")
+        frame = bg.copy()
+        frame[100:140, 200:240] = 255 - frame[100:140, 200:240]
+        frame[30:60, 20:60] = 255 - frame[30:60, 20:60]
+
+        rects = {}
+        for roi in (None, [pv3.Rect(150, 80, 120, 100)]):
+            md = pv3.MotionDetector(
+                method=pv3.BG_SUBTRACT_STATIC,
+                bg_image=pv3.Image(bg),
+                min_area=50,
+                buff_size=1,
+                processing_scale=0.5,
+                roi=roi,
+                exclude=[pv3.Rect(250, 80, 20, 20)],
+            )
+            md.detect(pv3.Image(frame))
+            rects[roi is None] = sorted(r.bounds for r in md.get_rects())
+            mask = md.foreground_mask().data
+            self.assertTupleEqual(mask.shape, (240, 320))
+            self.assertGreater(np.count_nonzero(mask[100:140, 200:240]), 1000)
+            self.assertEqual(np.count_nonzero(mask[80:100, 250:270]), 0)
+
+        # the object outside of the region of interest isn't detected, and the other
+        # object is found in the same place
+        self.assertEqual(len(rects[True]), 2)
+        self.assertListEqual(rects[False], rects[True][1:])
+        self.assertEqual(np.count_nonzero(mask[30:60, 20:60]), 0)
+
+    def test_checkpoint(self):
+        print("\nTesting MotionDetector Checkpoint and Warm Start")
+        vid = pv3.Video(pv3.VID_PRIUS, size=(320, 240))
+        frames = [next(vid) for _ in range(30)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "md.npz")
+            kwargs = {
+                "method": pv3.BG_SUBTRACT_MEDIAN,
+                "buff_size": 9,
+                "min_area": 50,
+                "checkpoint_path": filename,
+                "checkpoint_interval": 10,
+            }
+            md = pv3.MotionDetector(**kwargs)
+            for frame in frames[0:10]:
+                md.detect(frame)
+            self.assertTrue(os.path.exists(filename))
+
+            # a restarted detector picks up from the checkpoint at frame 10, and
+            # loading it again replaces the model, which no longer observes the buffer
+            md2 = pv3.MotionDetector(**kwargs)
+            md2.load_state()
+            self.assertEqual(len(md2._image_buffer._observers), 1)
+            counts = []
+            for frame in frames[10:]:
+                counts.append(md.detect(frame))
+                self.assertEqual(md2.detect(frame), counts[-1])
+                self.assertListEqual(
+                    [r.bounds for r in md2.get_rects()],
+                    [r.bounds for r in md.get_rects()],
+                )
+            self.assertGreater(max(counts), 0)
+
+    def test_motion_compensated_detection(self):
+        print("\nTesting MotionDetector with a Panning Camera")
+        scene = pv3.Image(pv3.IMG_DRIVEWAY).resize((400, 300), as_type="CV")
+        md = pv3.MotionDetector(method=pv3.BG_SUBTRACT_MCFD, min_area=50)
+        for i in range(12):
+            frame = scene[10 + i : 250 + i, 10 + 3 * i : 330 + 3 * i].copy()
+            x = 250 - 12 * i
+            frame[100:130, x : x + 30] = 255 - frame[100:130, x : x + 30]
+            count = md.detect(pv3.Image(frame))
+            if i < 4:
+                continue
+
+            # only the square in the middle frame of the buffer is detected
+            self.assertGreater(count, 0)
+            x = 250 - 12 * (i - 2)
+            for rect in md.get_rects():
+                (minx, miny, maxx, maxy) = rect.bounds
+                self.assertTrue(x - 4 <= minx and maxx <= x + 34, i)
+                self.assertTrue(96 <= miny and maxy <= 134, i)
+
+        annotated = md.annotate_frame(flow_color=pv3.RGB_GREEN)
+        self.assertTupleEqual(annotated.size, (320, 240))
+
+
+if __name__ == "__main__":
+    unittest.main()
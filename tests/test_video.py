@@ -47,6 +47,16 @@ class TestVideo(unittest.TestCase):
         self.assertTupleEqual(imgA.size, (320, 240))
         self.assertTrue(np.all(imgA.data == X[30, :, :]))
 
+    def test_video_tensor_batches(self):
+        print("\nTest Video 'tensor_batches' Method")
+        vid = pv3.VideoFromImageStack(np.zeros((10, 24, 32), dtype="uint8") + 255)
+        batches = [(nums, X.copy()) for (nums, X) in vid.tensor_batches(4)]
+        self.assertEqual(len(batches), 3)
+        self.assertListEqual(batches[0][0], [1, 2, 3, 4])
+        self.assertTupleEqual(batches[0][1].shape, (4, 3, 24, 32))
+        self.assertTupleEqual(batches[-1][1].shape, (2, 3, 24, 32))
+        self.assertTrue(np.allclose(batches[-1][1], 1.0))
+
 
 if __name__ == "__main__":
     unittest.main()